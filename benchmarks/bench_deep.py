@@ -0,0 +1,39 @@
+"""
+Measure --fd-relative on a deep tree: a chain of nested directories, each with a few files, listed with -R and -lR,
+with the directories opened and the entries statted by their paths, and relative to the descriptors of their parents.
+
+By path, the kernel walks all the components of a path for each directory it opens and each entry it stats, so the
+cost per entry grows with the depth. Relative to a descriptor, it only looks up a single name.
+
+    python -m benchmarks.bench_deep --depth 200 --files-per-dir 20
+"""
+import argparse
+import pathlib
+import tempfile
+
+import pyls
+from benchmarks.generators import make_deep_chain
+from benchmarks.timing import best_time, consume
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--depth", type=int, default=200)
+    parser.add_argument("--files-per-dir", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="pyls_bench_") as tmp:
+        root = pathlib.Path(tmp)
+        make_deep_chain(root, args.depth, args.files_per_dir)
+        for name, options in [("-R", dict(recursive=True)), ("-lR", dict(recursive=True, list_format=True))]:
+            by_path = pyls.Config(paths=[str(root)], **options)
+            by_fd = pyls.Config(paths=[str(root)], fd_relative=True, **options)
+            paths = best_time(lambda: consume(pyls.Lister(by_path).lines()), args.repeat)
+            fds = best_time(lambda: consume(pyls.Lister(by_fd).lines()), args.repeat)
+            print(f"{name:4} paths {paths * 1000:8.2f} ms   --fd-relative {fds * 1000:8.2f} ms   "
+                  f"speedup {paths / fds:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
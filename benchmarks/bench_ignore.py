@@ -0,0 +1,54 @@
+"""
+Measure what --ignore saves on a tree full of ignored directories: a number of projects, each with a few source files
+and a large node_modules directory, listed with -R and -lSR, with and without --ignore node_modules.
+
+Ignored names are matched as they are read from the directory, so the ignored directories are neither statted, sorted
+nor entered, and the listing with --ignore should take about as long as a tree without them.
+
+    python -m benchmarks.bench_ignore --projects 20 --packages 50 --files-per-package 20
+"""
+import argparse
+import pathlib
+import tempfile
+
+import pyls
+from benchmarks.timing import best_time, consume
+
+
+def make_projects(root: pathlib.Path, projects: int, packages: int, files_per_package: int):
+    """ Make the projects, each with a src directory and a node_modules directory of packages. """
+    for p in range(projects):
+        project = root / f"project_{p:03d}"
+        (project / "src").mkdir(parents=True)
+        for i in range(10):
+            (project / "src" / f"module_{i}.js").write_bytes(b"x" * i)
+        for k in range(packages):
+            package = project / "node_modules" / f"package_{k:03d}"
+            package.mkdir(parents=True)
+            for i in range(files_per_package):
+                (package / f"file_{i:03d}.js").touch()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--projects", type=int, default=20)
+    parser.add_argument("--packages", type=int, default=50)
+    parser.add_argument("--files-per-package", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="pyls_bench_") as tmp:
+        root = pathlib.Path(tmp)
+        make_projects(root, args.projects, args.packages, args.files_per_package)
+        for name, options in [("-R", dict(recursive=True)),
+                              ("-lSR", dict(recursive=True, list_format=True, sort_by_size=True))]:
+            all_config = pyls.Config(paths=[str(root)], **options)
+            ignore_config = pyls.Config(paths=[str(root)], ignore_patterns=["node_modules"], **options)
+            full = best_time(lambda: consume(pyls.Lister(all_config).lines()), args.repeat)
+            ignored = best_time(lambda: consume(pyls.Lister(ignore_config).lines()), args.repeat)
+            print(f"{name:5} all {full:8.3f} s   --ignore node_modules {ignored:8.3f} s   "
+                  f"speedup {full / ignored:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Measure the memory used per entry when listing a large flat directory with pyls.
+
+The peak of the memory traced by tracemalloc while the output is produced is divided by the number of entries. The
+output lines themselves are discarded as they are produced, so they do not count.
+
+    python -m benchmarks.bench_memory --entries 100000
+"""
+import argparse
+import pathlib
+import tempfile
+import tracemalloc
+
+import pyls
+
+
+def peak_bytes_per_entry(root: pathlib.Path, num_entries: int, **config) -> float:
+    """ Return the peak traced memory while listing root with the given options, divided by the number of entries. """
+    pyls.CONFIG = pyls.Config(paths=[str(root)], **config)
+    tracemalloc.start()
+    for _ in pyls.ls_lines():
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / num_entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=100_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="pyls_bench_") as tmp:
+        root = pathlib.Path(tmp)
+        for i in range(args.entries):
+            (root / f"file_{i:07d}.txt").touch()
+
+        modes = {
+            "": {},
+            "-S": dict(sort_by_size=True),
+            "-l": dict(list_format=True),
+            "-lS": dict(list_format=True, sort_by_size=True),
+        }
+        for name, config in modes.items():
+            per_entry = peak_bytes_per_entry(root, args.entries, **config)
+            print(f"{'pyls ' + name:9} {per_entry:7.0f} bytes/entry")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Measure the time to list a page of a large directory with list_page, compared to a full listing of the directory.
+
+The first page reads and sorts the whole directory to build its index, so it costs about as much as a full listing.
+Later pages of the unchanged directory are served from the index, and should take about the same time whether they
+are near the start or near the end of the directory.
+
+    python -m benchmarks.bench_pages --files 100000 --limit 100 -l
+"""
+import argparse
+import os
+import pathlib
+import tempfile
+import time
+
+import pyls
+from benchmarks.generators import make_flat
+from benchmarks.timing import best_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", type=pathlib.Path, default=None, help="existing directory to list")
+    parser.add_argument("--files", type=int, default=100_000)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("-l", dest="list_format", action="store_true", help="use the long list format")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="pyls_bench_") as tmp:
+        root = args.root
+        if root is None:
+            root = pathlib.Path(tmp) / "flat"
+            root.mkdir()
+            make_flat(root, args.files)
+            # The index of a directory which was modified within the last two seconds is not kept.
+            os.utime(root, (time.time() - 60, time.time() - 60))
+
+        config = pyls.Config(paths=[str(root)], list_format=args.list_format)
+        full = best_time(lambda: pyls.Lister(config).string(), args.repeat)
+        print(f"{'full listing':24} {full * 1000:9.2f} ms")
+
+        def first_page():
+            pyls.Lister(config).list_page(str(root), limit=args.limit)
+
+        print(f"{'first page, no index':24} {best_time(first_page, args.repeat) * 1000:9.2f} ms")
+
+        lister = pyls.Lister(config)
+        cursors = [None]
+        while True:
+            _, cursor = lister.list_page(str(root), after=cursors[-1], limit=args.limit)
+            if cursor is None:
+                break
+            cursors.append(cursor)
+        for name, cursor in [("second page", cursors[1 % len(cursors)]),
+                             ("middle page", cursors[len(cursors) // 2]),
+                             ("last page", cursors[-1])]:
+            seconds = best_time(lambda: lister.list_page(str(root), after=cursor, limit=args.limit), args.repeat)
+            print(f"{name:24} {seconds * 1000:9.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Compare the serial traversal of pyls -R with the parallel traversal using --jobs.
+
+By default, the benchmark runs on a generated directory tree in a temporary directory. Since the parallel traversal
+mainly helps on file systems with a high latency per system call (e.g. NFS), an existing tree can be used instead:
+
+    python -m benchmarks.bench_parallel --root /mnt/nfs/some/tree --jobs 1 4 16
+"""
+import argparse
+import pathlib
+import tempfile
+
+import pyls
+from benchmarks.generators import make_tree
+from benchmarks.timing import best_time, consume
+
+
+def time_listing(root: pathlib.Path, jobs: int, list_format: bool, repeat: int) -> float:
+    """ Return the best wall clock time of repeat runs of pyls -R over the tree. """
+    pyls.CONFIG = pyls.Config(paths=[str(root)], recursive=True, list_format=list_format, jobs=jobs)
+    return best_time(lambda: consume(pyls.ls_lines()), repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", type=pathlib.Path, default=None, help="existing tree to list")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--files-per-dir", type=int, default=50)
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="pyls_bench_") as tmp:
+        root = args.root
+        if root is None:
+            root = pathlib.Path(tmp)
+            make_tree(root, args.depth, args.fanout, args.files_per_dir)
+
+        for list_format in (False, True):
+            mode = "-lR" if list_format else "-R"
+            serial = None
+            for jobs in args.jobs:
+                elapsed = time_listing(root, jobs, list_format, args.repeat)
+                if serial is None:
+                    serial = elapsed
+                print(f"{mode:4} jobs={jobs:<3} {elapsed * 1000:9.1f} ms  speedup {serial / elapsed:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Measure how a recursive listing of a single tree scales with the number of worker processes of --processes, which
+list the subtrees below the root in parallel and send their output back to the main process in one piece each.
+
+The output lines are hashed rather than written, and the hash is checked to be the same for all numbers of processes.
+The number of processes defaults to the powers of two up to the number of cores; the speedup is only meaningful on a
+machine with at least that many cores.
+
+    python -m benchmarks.bench_processes --processes 1 2 4 8 --fanout 16 --files-per-dir 200
+"""
+import argparse
+import os
+import pathlib
+import tempfile
+import time
+
+import pyls
+from benchmarks.generators import make_tree
+
+
+def run_listing(root: pathlib.Path, processes: int, list_format: bool) -> tuple:
+    """ List the tree and return the wall time and a hash of the output. """
+    config = pyls.Config(paths=[str(root)], recursive=True, list_format=list_format, processes=processes)
+    start = time.perf_counter()
+    output_hash = 0
+    for line in pyls.Lister(config).lines():
+        output_hash = hash((output_hash, line))
+    return time.perf_counter() - start, output_hash
+
+
+def main():
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", type=pathlib.Path, default=None, help="existing tree to list")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--files-per-dir", type=int, default=100)
+    parser.add_argument("--processes", type=int, nargs="+",
+                        default=[2 ** i for i in range(cores.bit_length()) if 2 ** i <= cores])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("-l", dest="list_format", action="store_true", help="use the long list format")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="pyls_bench_") as tmp:
+        root = args.root
+        if root is None:
+            root = pathlib.Path(tmp)
+            make_tree(root, args.depth, args.fanout, args.files_per_dir)
+
+        print(f"{cores} cores")
+        single = None
+        expected_hash = None
+        for processes in args.processes:
+            results = [run_listing(root, processes, args.list_format) for _ in range(args.repeat)]
+            best = min(seconds for seconds, _ in results)
+            output_hash = results[0][1]
+            if single is None:
+                single, expected_hash = best, output_hash
+            elif output_hash != expected_hash:
+                raise SystemExit(f"the output with {processes} processes differs from the one with {args.processes[0]}")
+            print(f"processes={processes:<3} {best:8.3f} s  speedup {single / best:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
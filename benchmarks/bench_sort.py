@@ -0,0 +1,69 @@
+"""
+Measure how long pyls takes to sort the entries of a directory with 1M entries, under the C locale and under a
+locale which requires locale.strxfrm, both by name and by size.
+
+No files are created: the entries are made up in memory, with precomputed lstat results, so that only the sorting
+itself is measured.
+
+    python -m benchmarks.bench_sort --entries 1000000 --locales C en_US.UTF-8
+"""
+import argparse
+import locale
+import os
+import pathlib
+import random
+import string
+import time
+
+import pyls
+
+
+def make_entries(n: int, seed: int = 0):
+    """ Make n entries with random names of mixed case, digits and punctuation, and random sizes. """
+    rng = random.Random(seed)
+    alphabet = string.ascii_letters + string.digits + "._-"
+    base = pathlib.Path("/nonexistent")
+    template = os.lstat(".")
+    entries = []
+    for i in range(n):
+        name = "".join(rng.choices(alphabet, k=rng.randint(4, 24))) + f"_{i}"
+        e = pyls.Entry(name, base / name)
+        e._lstat = os.stat_result((template.st_mode, 0, 0, 1, 0, 0, rng.randint(0, 1 << 20), 0, 0, 0))
+        entries.append(e)
+    return entries
+
+
+def time_sort(entries, sort_by_size: bool) -> float:
+    """ Return the time needed to compute the collation keys and sort the entries. """
+    for e in entries:
+        e.collation_key = None
+    lister = pyls.Lister(pyls.Config(sort_by_size=sort_by_size))
+    start = time.perf_counter()
+    lister._sorted_entries(entries)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=1_000_000)
+    parser.add_argument("--locales", nargs="+", default=["C", ""],
+                        help="values for LC_COLLATE; the empty string selects the locale of the environment")
+    args = parser.parse_args()
+
+    entries = make_entries(args.entries)
+    # pyls applies the user's locale the first time it is needed, so let it do that before selecting other locales.
+    pyls.Lister()
+    for name in args.locales:
+        try:
+            actual = locale.setlocale(locale.LC_COLLATE, name)
+        except locale.Error:
+            print(f"{name!r:14} not available, skipped")
+            continue
+        for sort_by_size in (False, True):
+            elapsed = time_sort(entries, sort_by_size)
+            mode = "size" if sort_by_size else "name"
+            print(f"{actual:14} by {mode}: {elapsed:6.2f} s  ({len(entries) / elapsed:,.0f} entries/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Measure the startup time of pyls: the wall clock time of short pyls runs, in new interpreters, compared to the time
+of an interpreter which does nothing. Optionally, show the modules which take longest to import, as reported by
+python -X importtime.
+
+pyls is run the way the console script installed by setup.py runs it, i.e. by importing the module and calling main,
+so that the bytecode of pyls.py is read from its cache rather than compiled each time. The benchmark fails if the
+median overhead of any command over the empty interpreter exceeds the target.
+
+    python -m benchmarks.bench_startup --repeat 50 --target-ms 40 --importtime
+"""
+import argparse
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+# The pyls arguments to time, on a small directory. The empty interpreter is timed as the baseline.
+COMMANDS = {
+    "pyls": [],
+    "pyls -a": ["-a"],
+    "pyls -l": ["-l"],
+    "pyls -laR": ["-laR"],
+}
+
+
+def run_times(args, repeat: int, env: dict) -> list:
+    """ Return the wall clock times of repeat runs of the interpreter with the given arguments. """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, env=env, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def slowest_imports(env: dict, args, count: int) -> list:
+    """ Return the count modules with the largest cumulative import time, in microseconds, for a run of pyls. """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import pyls; pyls.main()"] + args,
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative), name.rstrip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=30)
+    parser.add_argument("--target-ms", type=float, default=40.0,
+                        help="maximum median overhead of a pyls run over the empty interpreter (default: 40)")
+    parser.add_argument("--importtime", action="store_true", help="show the slowest imports of each command")
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=str(REPO_ROOT))
+    # Make sure the bytecode of pyls is cached, as it is for an installed pyls.
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    subprocess.run([sys.executable, "-c", "import pyls"], env=env, check=True)
+
+    with tempfile.TemporaryDirectory(prefix="pyls_bench_") as tmp:
+        root = pathlib.Path(tmp)
+        for i in range(10):
+            (root / f"file_{i}.txt").touch()
+        (root / ".hidden").touch()
+        (root / "subdir").mkdir()
+
+        baseline = statistics.median(run_times(["-c", "pass"], args.repeat, env))
+        print(f"{'python -c pass':16} {baseline * 1000:7.1f} ms")
+        failed = False
+        for name, pyls_args in COMMANDS.items():
+            command = ["-c", "import pyls; pyls.main()"] + pyls_args + [str(root)]
+            median = statistics.median(run_times(command, args.repeat, env))
+            overhead = median - baseline
+            failed |= overhead * 1000 > args.target_ms
+            print(f"{name:16} {median * 1000:7.1f} ms  overhead {overhead * 1000:6.1f} ms")
+            if args.importtime:
+                for cumulative, module in slowest_imports(env, pyls_args + [str(root)], 8):
+                    print(f"    {cumulative / 1000:6.1f} ms  {module.strip()}")
+
+    if failed:
+        sys.exit(f"the overhead exceeds the target of {args.target_ms} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Measure the throughput of many pyls listings running at the same time on a thread pool, each with its own Lister.
+
+Each listing alternates between the short and the long list format, so that listers with different configs run side
+by side. Since the formatting holds the GIL, the throughput mainly scales while the threads wait for system calls, so
+expect the largest gains on file systems with a high latency per call and with a cold cache.
+
+    python -m benchmarks.bench_threads --threads 1 2 4 8 --listings 64
+"""
+import argparse
+import concurrent.futures
+import pathlib
+import tempfile
+import time
+
+import pyls
+from benchmarks.generators import make_tree
+
+
+def run_listing(root: pathlib.Path, list_format: bool) -> int:
+    """ List the tree recursively with a new Lister and return the number of output lines. """
+    config = pyls.Config(paths=[str(root)], recursive=True, list_format=list_format)
+    return sum(1 for _ in pyls.Lister(config).lines())
+
+
+def listings_per_second(root: pathlib.Path, threads: int, listings: int) -> float:
+    """ Return the number of listings completed per second by a pool of the given number of threads. """
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        start = time.perf_counter()
+        futures = [pool.submit(run_listing, root, i % 2 == 1) for i in range(listings)]
+        for f in futures:
+            f.result()
+        return listings / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", type=pathlib.Path, default=None, help="existing tree to list")
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--files-per-dir", type=int, default=50)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--listings", type=int, default=32)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="pyls_bench_") as tmp:
+        root = args.root
+        if root is None:
+            root = pathlib.Path(tmp)
+            make_tree(root, args.depth, args.fanout, args.files_per_dir)
+
+        single = None
+        for threads in args.threads:
+            throughput = listings_per_second(root, threads, args.listings)
+            if single is None:
+                single = throughput
+            print(f"threads={threads:<3} {throughput:8.1f} listings/s  speedup {throughput / single:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Generators for synthetic directory trees used by the benchmarks.
+
+Each generator creates its tree below an existing, empty root directory and returns a TreeInfo with the number of
+entries directly in the root and in the whole tree, and of the hidden ones among them, which the benchmarks use to
+compute their throughput.
+"""
+import dataclasses
+import os
+import pathlib
+
+
+@dataclasses.dataclass
+class TreeInfo:
+    top_level_entries: int
+    total_entries: int
+    hidden_entries: int = 0  # only listed with -a; the generators make hidden entries directly in the root only
+
+
+def make_flat(root: pathlib.Path, num_files: int, hidden_fraction: float = 0.0) -> TreeInfo:
+    """ A single directory with num_files empty files, of which roughly hidden_fraction start with a dot. """
+    hidden_every = round(1 / hidden_fraction) if hidden_fraction else 0
+    for i in range(num_files):
+        prefix = "." if hidden_every and i % hidden_every == 0 else ""
+        _touch(root / f"{prefix}file_{i:07d}.txt", size=i % 4096)
+    num_hidden = len(range(0, num_files, hidden_every)) if hidden_every else 0
+    return TreeInfo(num_files, num_files, num_hidden)
+
+
+def make_deep_chain(root: pathlib.Path, depth: int, files_per_dir: int = 2) -> TreeInfo:
+    """ A chain of depth nested directories, each containing files_per_dir files and the next directory. """
+    path = root
+    for level in range(depth):
+        for i in range(files_per_dir):
+            _touch(path / f"file_{i}")
+        path = path / f"level_{level:04d}"
+        path.mkdir()
+    return TreeInfo(files_per_dir + 1, depth * (files_per_dir + 1))
+
+
+def make_wide(root: pathlib.Path, fanout: int, files_per_dir: int) -> TreeInfo:
+    """ A root directory with fanout subdirectories, each containing files_per_dir files. """
+    for d in range(fanout):
+        subdir = root / f"dir_{d:05d}"
+        subdir.mkdir()
+        for i in range(files_per_dir):
+            _touch(subdir / f"file_{i:05d}")
+    return TreeInfo(fanout, fanout * (files_per_dir + 1))
+
+
+def make_tree(root: pathlib.Path, depth: int, fanout: int, files_per_dir: int) -> TreeInfo:
+    """ A balanced tree with the given depth and fan-out, with files_per_dir files in each directory. """
+    total = files_per_dir
+    for i in range(files_per_dir):
+        _touch(root / f"file_{i:05d}")
+    if depth > 0:
+        for i in range(fanout):
+            child = root / f"dir_{i:03d}"
+            child.mkdir()
+            total += 1 + make_tree(child, depth - 1, fanout, files_per_dir).total_entries
+    return TreeInfo(files_per_dir + (fanout if depth > 0 else 0), total)
+
+
+def make_symlinks(root: pathlib.Path, num_links: int, num_targets: int = 10) -> TreeInfo:
+    """ A directory with num_links symlinks, pointing to num_targets files in a subdirectory. """
+    targets = root / "targets"
+    targets.mkdir()
+    for i in range(num_targets):
+        _touch(targets / f"target_{i:03d}")
+    for i in range(num_links):
+        os.symlink(targets / f"target_{i % num_targets:03d}", root / f"link_{i:07d}")
+    return TreeInfo(num_links + 1, num_links + 1 + num_targets)
+
+
+def _touch(path: pathlib.Path, size: int = 0):
+    with open(path, "wb") as f:
+        if size:
+            f.truncate(size)
+
+
+# The trees of the benchmark suite, by name. The large ones are only generated with --large.
+TREES = {
+    "flat_10k": lambda root: make_flat(root, 10_000),
+    "flat_100k": lambda root: make_flat(root, 100_000),
+    "hidden_20k": lambda root: make_flat(root, 20_000, hidden_fraction=0.5),
+    "deep_200": lambda root: make_deep_chain(root, 200),
+    "wide_1000x20": lambda root: make_wide(root, 1000, 20),
+    "symlinks_10k": lambda root: make_symlinks(root, 10_000),
+}
+LARGE_TREES = {
+    "flat_1m": lambda root: make_flat(root, 1_000_000),
+}
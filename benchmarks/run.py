@@ -0,0 +1,147 @@
+"""
+Benchmark suite for pyls.
+
+Generates synthetic directory trees (see benchmarks/generators.py) and times pyls in several modes on each of them.
+Every measurement runs in a fresh Python process, so that the peak RSS of each run can be reported. The results are
+printed as a table and can be saved as JSON, to compare them with a later run:
+
+    python -m benchmarks.run --output before.json
+    (change pyls)
+    python -m benchmarks.run --output after.json --compare before.json
+
+With --compare, the command exits with status 1 if any benchmark got slower than the threshold (default 10%).
+Generating the trees takes a while, so they can be kept in a directory with --tree-dir and reused by later runs.
+"""
+import argparse
+import json
+import os
+import pathlib
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import generators
+from benchmarks.timing import best_time, consume
+
+# The modes of pyls to time, named after their flags, as keyword arguments to pyls.Config. A terminal width enables
+# the column layout.
+MODES = {
+    "plain": {},
+    "a": dict(show_all=True),
+    "l": dict(list_format=True),
+    "S": dict(sort_by_size=True),
+    "S@top10": dict(sort_by_size=True, top=10),
+    "R": dict(recursive=True),
+    "lR": dict(list_format=True, recursive=True),
+    "l@jsonl": dict(list_format=True, output_format="jsonl"),
+    "l0": dict(list_format=True, output_format="nul"),
+    "columns@80": dict(use_column_layout=True, terminal_width=80),
+    "columns@200": dict(use_column_layout=True, terminal_width=200),
+}
+
+
+def run_worker(spec: dict):
+    """ Time a single mode on a single tree, in this process, and print the result as JSON. """
+    import pyls
+
+    config = dict(spec["config"])
+    terminal_width = config.pop("terminal_width", None)
+    if terminal_width is not None:
+        os.environ["COLUMNS"] = str(terminal_width)  # respected by shutil.get_terminal_size
+    pyls.CONFIG = pyls.Config(paths=[spec["root"]], **config)
+
+    best = best_time(lambda: consume(pyls.ls_lines()), spec["repeat"])
+    json.dump(dict(seconds=best, max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss), sys.stdout)
+
+
+def run_benchmark(root: pathlib.Path, mode: str, repeat: int) -> dict:
+    """ Run a worker process for the mode on the tree at root and return its result. """
+    spec = dict(root=str(root), config=MODES[mode], repeat=repeat)
+    worker = subprocess.run([sys.executable, "-m", "benchmarks.run", "--worker", json.dumps(spec)],
+                            stdout=subprocess.PIPE, check=True, cwd=pathlib.Path(__file__).parent.parent)
+    return json.loads(worker.stdout)
+
+
+def prepare_trees(tree_dir: pathlib.Path, names) -> dict:
+    """ Generate the trees with the given names in tree_dir, unless they exist already, and return their TreeInfo. """
+    all_trees = {**generators.TREES, **generators.LARGE_TREES}
+    infos = {}
+    for name in names:
+        root = tree_dir / name
+        info_file = tree_dir / f"{name}.json"
+        if info_file.exists():
+            infos[name] = generators.TreeInfo(**json.loads(info_file.read_text()))
+            continue
+        print(f"generating {name} ...", file=sys.stderr)
+        root.mkdir(parents=True)
+        infos[name] = all_trees[name](root)
+        info_file.write_text(json.dumps(infos[name].__dict__))
+    return infos
+
+
+def compare(results: list, baseline_file: pathlib.Path, threshold: float) -> bool:
+    """ Print the change of each result against the baseline. Return False if any benchmark got slower. """
+    baseline = {(r["tree"], r["mode"]): r for r in json.loads(baseline_file.read_text())["results"]}
+    ok = True
+    print(f"\ncompared to {baseline_file}:")
+    for r in results:
+        old = baseline.get((r["tree"], r["mode"]))
+        if old is None:
+            continue
+        change = r["seconds"] / old["seconds"] - 1
+        regression = change > threshold
+        ok = ok and not regression
+        flag = "  REGRESSION" if regression else ""
+        print(f"{r['tree']:14} {r['mode']:12} {change:+7.1%} time  {r['max_rss_kb'] / old['max_rss_kb'] - 1:+7.1%} rss"
+              f"{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--trees", nargs="+", default=None, help="names of the trees (default: all but the large ones)")
+    parser.add_argument("--large", action="store_true", help="also run the large trees, e.g. flat_1m")
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the best time is reported")
+    parser.add_argument("--tree-dir", type=pathlib.Path, default=None, help="directory in which to keep the trees")
+    parser.add_argument("--output", type=pathlib.Path, default=None, help="save the results to this JSON file")
+    parser.add_argument("--compare", type=pathlib.Path, default=None, help="JSON file of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown counted as a regression")
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(json.loads(args.worker))
+        return
+
+    names = args.trees or list(generators.TREES) + (list(generators.LARGE_TREES) if args.large else [])
+    with tempfile.TemporaryDirectory(prefix="pyls_bench_") as tmp:
+        tree_dir = args.tree_dir or pathlib.Path(tmp)
+        infos = prepare_trees(tree_dir, names)
+
+        results = []
+        print(f"{'tree':14} {'mode':12} {'seconds':>9} {'entries/s':>12} {'max rss':>10}")
+        for name in names:
+            for mode in args.modes:
+                recursive = MODES[mode].get("recursive", False)
+                entries = infos[name].total_entries if recursive else infos[name].top_level_entries
+                if not MODES[mode].get("show_all", False):
+                    entries -= infos[name].hidden_entries
+                r = run_benchmark(tree_dir / name, mode, args.repeat)
+                r.update(tree=name, mode=mode, entries=entries, entries_per_second=entries / r["seconds"])
+                results.append(r)
+                print(f"{name:14} {mode:12} {r['seconds']:9.3f} {r['entries_per_second']:12,.0f} "
+                      f"{r['max_rss_kb'] / 1024:7.1f} MB")
+
+    if args.output:
+        meta = dict(python=platform.python_version(), platform=platform.platform(), time=time.time())
+        args.output.write_text(json.dumps(dict(meta=meta, results=results), indent=2))
+    if args.compare and not compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+"""
+Timing helpers shared by the benchmarks.
+"""
+import collections
+import time
+from typing import Callable, Iterable
+
+
+def best_time(function: Callable[[], object], repeat: int) -> float:
+    """ Return the best wall clock time of repeat calls of function, in seconds. """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def consume(lines: Iterable[str]):
+    """ Exhaust an iterator of output lines without keeping them, to time a listing without its output. """
+    collections.deque(lines, maxlen=0)
@@ -1,41 +1,455 @@
-import argparse
-import dataclasses
-import datetime
-import grp
+from __future__ import annotations
+
+import array
+import bisect
+import contextvars
+import functools
+import heapq
+import itertools
 import locale
+import math
+import os
 import pathlib
-import pwd
+import select
 import stat
+import struct
 import sys
-import shutil
-from typing import List, Iterable, Tuple, Any
+import time
 
-""" 
-The ls command uses a locale-specific string sorting function, resulting in sort orders such as e.g. ["a", ".b", "c"],
-while the order obtained by the default sort would be [".b", "a", "c"]. To achieve the same result, we can configure 
-python to use the user's locale and use the locale.strxfrm as the sorting key.
+# The annotations are not evaluated at runtime, so typing, which takes a while to import, is only imported by type
+# checkers, which treat TYPE_CHECKING as true.
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import List, Iterable, Iterator, AsyncIterator, Tuple, Any, Optional, Dict, Callable, Set
 
-The following line applies the user's locale. While this is not a great idea in library code, pyls is meant to run as a 
-standalone program, so this should be OK. For more information, refer to
-https://docs.python.org/3/library/locale.html#background-details-hints-tips-and-caveats
 """
-locale.setlocale(locale.LC_ALL, '')
+pyls is started from shell scripts many times over, so the time to start it matters. Modules which take a noticeable
+time to import, and which are only needed for some of the options, are imported where they are used: argparse,
+asyncio, concurrent.futures, contextlib, ctypes, datetime, grp, multiprocessing, pwd, shutil and threading, as well as
+typing, see TYPE_CHECKING above. Likewise, the user's locale is only applied once it is needed, see _use_user_locale.
+The largest remaining imports are locale, which is needed to sort the names, and pathlib, since the paths of the
+entries are pathlib.Path objects. Run python -m benchmarks.bench_startup to check the startup time.
+"""
 
 
-@dataclasses.dataclass()
 class Config:
-    """ This class stores the parameters with which pyls was invoked. """
-    list_format: bool = False
-    show_all: bool = False
-    sort_by_size: bool = False
-    recursive: bool = False
-    use_column_layout: bool = False
-    paths: List[str] = dataclasses.field(default_factory=lambda: ["."])
+    """
+    This class stores the parameters with which pyls was invoked. It is a plain class rather than a dataclass, since
+    importing dataclasses takes longer than the rest of the startup of pyls.
+    """
+
+    def __init__(self,
+                 list_format: bool = False,
+                 show_all: bool = False,
+                 sort_by_size: bool = False,
+                 recursive: bool = False,
+                 use_column_layout: bool = False,
+                 paths: Optional[List[str]] = None,
+                 jobs: int = 1,
+                 prefetch: Optional[int] = None,
+                 preload_names: bool = False,
+                 stream_chunk_size: Optional[int] = None,
+                 stats: Optional["Stats"] = None,
+                 cache: Optional["ListingCache"] = None,
+                 watch: bool = False,
+                 output_format: str = "text",
+                 top: Optional[int] = None,
+                 top_of_tree: bool = False,
+                 processes: int = 1,
+                 resolve_links: bool = False,
+                 subtree_totals: bool = False,
+                 ignore_patterns: Optional[List[str]] = None,
+                 hide_patterns: Optional[List[str]] = None,
+                 fd_relative: bool = False,
+                 max_open_fds: int = 64):
+        self.list_format = list_format
+        self.show_all = show_all
+        self.sort_by_size = sort_by_size
+        self.recursive = recursive
+        self.use_column_layout = use_column_layout
+        self.paths = paths if paths is not None else ["."]
+        # number of threads reading directories in parallel, and how many directories they may read ahead of the output
+        self.jobs = jobs
+        self.prefetch = prefetch
+        # read the whole user and group databases up front instead of looking up names one by one
+        self.preload_names = preload_names
+        # if set, list directories unsorted and in chunks of this many entries, so that the memory use is bounded
+        self.stream_chunk_size = stream_chunk_size
+        # if set, the time spent in each phase of the listing and the number of system calls are recorded here
+        self.stats = stats
+        # if set, the contents of directories are read from and stored in this on-disk cache
+        self.cache = cache
+        # after listing the directories, keep listing those which change again, until interrupted
+        self.watch = watch
+        # "text" for the output of ls, or one of the machine-readable formats "jsonl" and "nul", see Lister
+        self.output_format = output_format
+        # if set, only list this many entries of each directory, or with top_of_tree, of all directories together
+        self.top = top
+        self.top_of_tree = top_of_tree
+        # number of worker processes listing the path arguments, or the subtrees of a single path, in parallel
+        self.processes = processes
+        # in the long list format, show the real paths of symlink targets rather than the targets stored in the links
+        self.resolve_links = resolve_links
+        # after the listing of each directory and its subdirectories, show their total size, like du
+        self.subtree_totals = subtree_totals
+        # shell patterns of the names of entries which are not listed, like ls --ignore, and without show_all, --hide
+        self.ignore_patterns = ignore_patterns if ignore_patterns is not None else []
+        self.hide_patterns = hide_patterns if hide_patterns is not None else []
+        # read directories and lstat entries relative to open descriptors of their parents, with at most
+        # max_open_fds of them open at once, instead of by their paths, see _DirectoryFds
+        self.fd_relative = fd_relative
+        self.max_open_fds = max_open_fds
+
+    def __repr__(self) -> str:
+        return "Config({})".format(", ".join(f"{name}={value!r}" for name, value in vars(self).items()))
+
+    def __eq__(self, other: Any) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return vars(self) == vars(other)
+
+    __hash__ = None  # mutable, like the dataclass it replaces
 
 
 CONFIG = Config()
 
 
+class NameCache:
+    """
+    Memoizes the user and group names of uids and gids for the long list format.
+
+    Each lookup through pwd or grp may be slow on hosts which use NSS with a network service such as LDAP, while a
+    listing typically contains only a handful of distinct owners. Optionally, the user and group databases can be
+    read in a single pass up front. Ids without a name are shown numerically, as ls does. The hits and misses
+    attributes count the lookups answered from the cache and the ones which were not. A cache may be shared by listers
+    running on different threads, so its lookups and counters are synchronized with a lock.
+    """
+
+    def __init__(self):
+        # Every lister makes a cache, so use the lock of _thread, which is built in, rather than importing threading.
+        import _thread
+        self._lock = _thread.allocate_lock()
+        self.hits = 0
+        self.misses = 0
+        self.preloaded = False
+        self._user_names: Dict[int, str] = {}
+        self._group_names: Dict[int, str] = {}
+
+    def preload(self):
+        """ Read all entries of the user and group databases into the cache. """
+        # If an id appears several times, getpwuid and getgrgid return the first entry, so keep the first one as well.
+        import grp
+        import pwd
+        with self._lock:
+            stats = _CURRENT_STATS.get()
+            if stats is not None:
+                stats.enter("pwd")
+            for p in pwd.getpwall():
+                self._user_names.setdefault(p.pw_uid, p.pw_name)
+            if stats is not None:
+                stats.exit(calls=1)
+                stats.enter("grp")
+            for g in grp.getgrall():
+                self._group_names.setdefault(g.gr_gid, g.gr_name)
+            if stats is not None:
+                stats.exit(calls=1)
+            self.preloaded = True
+
+    def clear(self):
+        """ Forget all cached names and reset the counters. """
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.preloaded = False
+            self._user_names.clear()
+            self._group_names.clear()
+
+    def user_name(self, uid: int) -> str:
+        """ Return the name of the user with the given uid, or the uid itself if it has no name. """
+        with self._lock:
+            try:
+                name = self._user_names[uid]
+            except KeyError:
+                self.misses += 1
+                stats = _CURRENT_STATS.get()
+                if stats is not None:
+                    stats.enter("pwd")
+                try:
+                    import pwd
+                    name = pwd.getpwuid(uid).pw_name
+                except KeyError:
+                    name = str(uid)
+                finally:
+                    if stats is not None:
+                        stats.exit(calls=1)
+                self._user_names[uid] = name
+            else:
+                self.hits += 1
+            return name
+
+    def group_name(self, gid: int) -> str:
+        """ Return the name of the group with the given gid, or the gid itself if it has no name. """
+        with self._lock:
+            try:
+                name = self._group_names[gid]
+            except KeyError:
+                self.misses += 1
+                stats = _CURRENT_STATS.get()
+                if stats is not None:
+                    stats.enter("grp")
+                try:
+                    import grp
+                    name = grp.getgrgid(gid).gr_name
+                except KeyError:
+                    name = str(gid)
+                finally:
+                    if stats is not None:
+                        stats.exit(calls=1)
+                self._group_names[gid] = name
+            else:
+                self.hits += 1
+            return name
+
+
+class TimestampFormatter:
+    """
+    Formats modification times for the long list format, relative to a reference time which is fixed when the
+    formatter is created.
+
+    Files modified within the six months before the reference time are shown with day, month and time of day, which
+    only changes once per minute. Older files are shown with day, month and year, which only changes once per day.
+    The formatted strings are cached for each such interval, so that the many files of e.g. a build directory, which
+    were all written within the same minute, are formatted only once. The cache is cleared whenever it reaches
+    max_cache_size intervals.
+    """
+
+    # The constant 31556952 is used in the ls source code, available at https://www.gnu.org/software/coreutils/.
+    # It roughly represents the number of seconds in a Gregorian year.
+    SIX_MONTHS_IN_SECONDS = 31556952 // 2
+
+    def __init__(self, now: Optional[float] = None, max_cache_size: int = 4096):
+        _use_user_locale(locale.LC_TIME)  # for the names of the months
+        self.now = time.time() if now is None else now
+        self.hits = 0
+        self.misses = 0
+        self._recent_cutoff = self.now - self.SIX_MONTHS_IN_SECONDS
+        self._max_cache_size = max_cache_size
+        # Maps (is_recent, number of the UTC minute or day) to the local intervals (start, end, formatted string)
+        # which overlap it. Local minutes and days may be shifted against UTC ones, so there can be two of them.
+        self._cache: Dict[Tuple[bool, int], List[Tuple[float, float, str]]] = {}
+
+    def format(self, mtime: float) -> str:
+        """ Get the string representing the modification time mtime, given in seconds since the epoch. """
+        is_recent = mtime > self._recent_cutoff
+        bucket_size = 60 if is_recent else 86400
+        for start, end, formatted in self._cache.get((is_recent, int(mtime // bucket_size)), ()):
+            if start <= mtime < end:
+                self.hits += 1
+                return formatted
+
+        self.misses += 1
+        import datetime
+        last_modified = datetime.datetime.fromtimestamp(mtime)
+        if is_recent:
+            date_format = "%b %e %H:%M"
+            start = last_modified.replace(second=0, microsecond=0)
+            end = start + datetime.timedelta(minutes=1)
+        else:
+            date_format = "%b %e  %Y"
+            start = last_modified.replace(hour=0, minute=0, second=0, microsecond=0)
+            end = start + datetime.timedelta(days=1)
+        formatted = last_modified.strftime(date_format)
+
+        if len(self._cache) >= self._max_cache_size:
+            self._cache.clear()
+        interval = (start.timestamp(), end.timestamp(), formatted)
+        for bucket in range(int(interval[0] // bucket_size), int(math.ceil(interval[1] / bucket_size))):
+            self._cache.setdefault((is_recent, bucket), []).append(interval)
+        return formatted
+
+
+class Stats:
+    """
+    Records the time spent in each phase of a listing, the number of calls of the system functions behind them, and
+    the number of directories and entries listed. A Stats object is passed in the stats field of the Config. To hook
+    into the instrumentation, e.g. to export the numbers elsewhere, subclass it and override enter and exit.
+
+    Phases are timed exclusively: if a phase starts while another one is running on the same thread, e.g. a lookup of
+    a user name while formatting the rows, the time is only counted for the inner phase. With more than one job, the
+    directories are read on several threads, so the times of the phases may add up to more than the wall time.
+    Without a Stats object, the only cost of the instrumentation is a check for a Stats object at each phase.
+
+    Code which does not belong to a Lister, such as Entry.lstat, records into the Stats object of the listing which
+    is currently producing a line, which is kept in a context variable, see _with_current_stats.
+    """
+
+    PHASES = ("readdir", "lstat", "resolve", "pwd", "grp", "sort", "format", "write")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds: Dict[str, float] = dict.fromkeys(self.PHASES, 0.0)
+        self.calls: Dict[str, int] = dict.fromkeys(self.PHASES, 0)
+        self.directories = 0
+        self.entries = 0
+        import threading
+        self._lock = threading.Lock()
+        self._local = threading.local()  # the stack of running phases of each thread, and when it last changed
+
+    def enter(self, phase: str):
+        """ Start timing a phase on the current thread, pausing the phase which is running already, if any. """
+        now = time.perf_counter()
+        stack = self._local.__dict__.setdefault("stack", [])
+        if stack:
+            self._add_time(stack[-1], now - self._local.since)
+        stack.append(phase)
+        self._local.since = now
+
+    def exit(self, calls: int = 0):
+        """ Stop timing the innermost phase on the current thread, adding the given number of calls to it. """
+        now = time.perf_counter()
+        phase = self._local.stack.pop()
+        self._add_time(phase, now - self._local.since, calls)
+        self._local.since = now
+
+    def count(self, phase: str, calls: int = 1):
+        """ Add calls to the phase without timing anything. """
+        self._add_time(phase, 0.0, calls)
+
+    def _add_time(self, phase: str, seconds: float, calls: int = 0):
+        with self._lock:
+            self.seconds[phase] += seconds
+            self.calls[phase] += calls
+
+    def _counters(self) -> tuple:
+        """ The recorded numbers, to be added to another Stats object by _add_counters. """
+        with self._lock:
+            return dict(self.seconds), dict(self.calls), self.directories, self.entries
+
+    def _add_counters(self, counters: tuple):
+        seconds, calls, directories, entries = counters
+        with self._lock:
+            for phase in self.PHASES:
+                self.seconds[phase] += seconds[phase]
+                self.calls[phase] += calls[phase]
+            self.directories += directories
+            self.entries += entries
+
+    def report(self) -> str:
+        """ Format the statistics as a table, with the wall time since the Stats object was created. """
+        lines = [
+            f"wall time    {time.perf_counter() - self.started:10.3f} s",
+            f"directories  {self.directories:10}",
+            f"entries      {self.entries:10}",
+            f"{'phase':12} {'seconds':>10} {'calls':>10}",
+        ]
+        for phase in self.PHASES:
+            lines.append(f"{phase:12} {self.seconds[phase]:10.3f} {self.calls[phase]:10}")
+        return "\n".join(lines)
+
+
+# The Stats object of the listing running in the current context, if any
+_CURRENT_STATS = contextvars.ContextVar("_CURRENT_STATS", default=None)
+
+
+def _timed(stats: Stats, phase: str, iterable: Iterable) -> Iterable:
+    """ Iterate over iterable, counting the time spent in producing each item for the phase. """
+    it = iter(iterable)
+    while True:
+        stats.enter(phase)
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        finally:
+            stats.exit()
+        yield item
+
+
+def _with_current_stats(stats: Stats, iterable: Iterable) -> Iterator:
+    """ Iterate over iterable, with stats as the current Stats object while each item is produced. """
+    it = iter(iterable)
+    try:
+        while True:
+            token = _CURRENT_STATS.set(stats)
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                _CURRENT_STATS.reset(token)
+            yield item
+    finally:
+        close = getattr(it, "close", None)
+        if close is not None:
+            close()
+
+
+class Entry:
+    """
+    A single entry of a directory listing, as produced by _iter_single_dir_children.
+
+    The entry keeps the os.DirEntry returned by os.scandir, which already knows the file type of the entry without an
+    additional system call on most file systems. The result of lstat is fetched lazily on first access and cached, so
+    that sorting, counting blocks and formatting rows all share a single lstat call per entry.
+
+    Since directories may contain millions of entries, entries use __slots__, and the path of an entry read from a
+    directory is only created when it is needed, e.g. to recurse into it.
+    """
+    __slots__ = ("name", "dir_entry", "parent", "collation_key", "_dir_path", "_path", "_lstat")
+
+    def __init__(self, name: str, path: Optional[pathlib.Path] = None, dir_entry: Optional[os.DirEntry] = None,
+                 dir_path: Optional[pathlib.Path] = None):
+        self.name = name
+        self.dir_entry = dir_entry
+        self.parent: Optional[Entry] = None  # the entry of the parent directory, if it is known
+        self.collation_key: Any = None  # computed once by _sorted_entries
+        self._dir_path = dir_path
+        self._path = path
+        self._lstat = None
+
+    @property
+    def path(self) -> pathlib.Path:
+        """ The path of the entry, i.e. the path of the directory containing it joined with its name. """
+        if self._path is None:
+            self._path = self._dir_path / self.name
+        return self._path
+
+    def alias(self, name: str, path: Optional[pathlib.Path] = None) -> "Entry":
+        """ Return a copy of this entry under a different name, sharing the cached type and lstat information. """
+        e = Entry(name, self.path if path is None else path, self.dir_entry)
+        # Without a DirEntry, both copies would have to lstat the path on their own, so fetch the result up front.
+        e._lstat = self._lstat if self.dir_entry is not None else self.lstat()
+        return e
+
+    def lstat(self) -> os.stat_result:
+        """ Return the (cached) result of lstat for this entry. """
+        if self._lstat is None:
+            stats = _CURRENT_STATS.get()
+            if stats is not None:
+                stats.enter("lstat")
+            try:
+                if self.dir_entry is not None:
+                    self._lstat = self.dir_entry.stat(follow_symlinks=False)
+                else:
+                    self._lstat = os.lstat(self.path)
+            finally:
+                if stats is not None:
+                    stats.exit(calls=1)
+        return self._lstat
+
+    def is_dir(self) -> bool:
+        """ Check if the entry is a directory, without following symlinks. """
+        if self.dir_entry is not None:
+            return self.dir_entry.is_dir(follow_symlinks=False)
+        return stat.S_ISDIR(self.lstat().st_mode)
+
+    def is_symlink(self) -> bool:
+        """ Check if the entry is a symlink. """
+        if self.dir_entry is not None:
+            return self.dir_entry.is_symlink()
+        return stat.S_ISLNK(self.lstat().st_mode)
+
+
 def main():
     """
     This is the main entry point for the pyls command. The results are printed to stdout.
@@ -45,11 +459,29 @@ def main():
         1 if minor problems (e.g., cannot access subdirectory),
         2 if serious trouble (e.g., cannot access command-line argument)."
     """
-    global CONFIG
-    CONFIG = get_configuration_from_command_line_args()
+    config = get_configuration_from_command_line_args()
+    lister = Lister(config)
+    # On a terminal, or when watching for changes, show the output of each directory as soon as it is complete.
+    writer = _BufferedLineWriter(sys.stdout, flush_at_end_of_directory=sys.stdout.isatty() or config.watch,
+                                 stats=config.stats, terminator=lister.terminator)
+    lines = lister.lines(end_of_directory=writer.end_of_directory)
     try:
-        for line in ls_lines():
-            print(line)
+        try:
+            writer.write_lines(lines)
+        finally:
+            # Stop the listing right away if the output fails, e.g. its worker processes.
+            lines.close()
+            writer.flush()
+            if config.stats is not None:
+                print(config.stats.report(), file=sys.stderr)
+    except BrokenPipeError:
+        # The reader of the output went away, e.g. pyls -R / | head. Stop without a traceback, and point stdout to
+        # devnull, since Python would otherwise try to flush it once more at exit and fail again.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    except KeyboardInterrupt:
+        # This is how --watch is usually stopped, so don't show a traceback.
+        sys.exit(130)
     except (FileNotFoundError, PermissionError) as e:
         print(e)
         sys.exit(1)
@@ -59,15 +491,180 @@ def main():
     sys.exit(0)
 
 
-def get_configuration_from_command_line_args() -> Config:
-    """ Parse the command line args and convert them to a Config object. """
+class _BufferedLineWriter:
+    """
+    Collects output lines and writes them to the stream in large chunks, which is much faster than printing line by
+    line when the output goes to a pipe or a file.
+    """
+
+    def __init__(self, stream, buffer_size: int = 64 * 1024, flush_at_end_of_directory: bool = False,
+                 stats: Optional[Stats] = None, terminator: str = "\n"):
+        self._stream = stream
+        self._terminator = terminator
+        self._stats = stats
+        self._buffer_size = buffer_size
+        self._flush_at_end_of_directory = flush_at_end_of_directory
+        self._lines: List[str] = []
+        self._num_chars = 0
+
+    def write_lines(self, lines: Iterable[str]):
+        """ Add the lines to the buffer, writing the buffer to the stream whenever it is full. """
+        for line in lines:
+            self._lines.append(line)
+            self._num_chars += len(line) + 1
+            if self._num_chars >= self._buffer_size:
+                self.flush()
+
+    def end_of_directory(self):
+        """ Called after the output of each directory. """
+        if self._flush_at_end_of_directory:
+            self.flush()
+
+    def flush(self):
+        """ Write all buffered lines to the stream. """
+        if self._stats is not None:
+            self._stats.enter("write")
+        try:
+            if self._lines:
+                self._lines.append("")  # for the trailing terminator
+                self._stream.write(self._terminator.join(self._lines))
+                self._lines = []
+                self._num_chars = 0
+            self._stream.flush()
+        finally:
+            if self._stats is not None:
+                self._stats.exit(calls=1)
+
+
+def get_configuration_from_command_line_args(args: Optional[List[str]] = None) -> Config:
+    """
+    Parse the command line args and convert them to a Config object.
+
+    Most invocations of pyls only combine the flags -l, -a, -S, -R and -0 with paths. Those are parsed by
+    _parse_short_flags, without importing argparse, which takes a noticeable part of the startup time. All other
+    arguments, including --help and invalid arguments, are parsed by argparse.
+    """
+    if args is None:
+        args = sys.argv[1:]
+    config = _parse_short_flags(args)
+    if config is None:
+        config = _parse_args_with_argparse(args)
+    return config
+
+
+# The options set by each short flag, and their values
+_SHORT_FLAGS = {
+    "l": ("list_format", True),
+    "a": ("show_all", True),
+    "S": ("sort_by_size", True),
+    "R": ("recursive", True),
+    "0": ("output_format", "nul"),
+}
+
+
+def _parse_short_flags(args: List[str]) -> Optional[Config]:
+    """
+    Parse args which consist only of paths and the flags in _SHORT_FLAGS, possibly combined as in -la, in the same
+    way as argparse. Return None for any other args.
+    """
+    options = {}
+    paths = []
+    only_paths = False
+    flag_after_paths = False
+    for arg in args:
+        if only_paths or arg == "-" or not arg.startswith("-"):
+            if flag_after_paths:
+                return None  # argparse rejects paths on both sides of a flag, let it report the error
+            paths.append(arg)
+        elif arg == "--":
+            only_paths = True
+        elif all(c in _SHORT_FLAGS for c in arg[1:]):
+            flag_after_paths = bool(paths)
+            options.update(_SHORT_FLAGS[c] for c in arg[1:])
+        else:
+            return None
+    # only format output in columns if pyls command is run directly from a terminal
+    return Config(paths=paths or ["."], use_column_layout=sys.stdout.isatty(), **options)
+
+
+def _parse_args_with_argparse(argv: List[str]) -> Config:
+    """ Parse all command line args supported by pyls with argparse, and convert them to a Config object. """
+    import argparse
     parser = argparse.ArgumentParser(description='A Python implementation of the UNIX ls command.')
     parser.add_argument('paths', nargs='*', default=['.'])
     parser.add_argument('-l', action='store_true')
     parser.add_argument('-a', action='store_true')
     parser.add_argument('-S', action='store_true')
     parser.add_argument('-R', action='store_true')
-    args = parser.parse_args()
+    parser.add_argument('-I', '--ignore', dest='ignore_patterns', action='append', default=[], metavar='PATTERN',
+                        help='do not list entries whose names match the shell PATTERN, and do not enter such '
+                             'directories with -R; can be given several times')
+    parser.add_argument('--hide', dest='hide_patterns', action='append', default=[], metavar='PATTERN',
+                        help='like --ignore, unless -a is given')
+    parser.add_argument('--format', dest='output_format', choices=_OUTPUT_FORMATS, default='text',
+                        help='text: the output of ls (default); jsonl: one JSON object per directory and entry, with '
+                             'the raw lstat fields with -l; nul: the path of each entry, preceded by the raw lstat '
+                             'fields with -l, terminated by a NUL byte')
+    parser.add_argument('-0', dest='output_format', action='store_const', const='nul',
+                        help='same as --format=nul')
+    parser.add_argument('--resolve-links', action='store_true',
+                        help='with -l, show the real path of the target of each symlink instead of the target stored '
+                             'in the link')
+    parser.add_argument('--subtree-totals', action='store_true',
+                        help='with -R, show the total size, blocks and number of files of each directory and the tree '
+                             'below it once the tree is listed, counting hard links once; like the listing, the '
+                             'totals leave out hidden entries without -a, and ignored entries')
+    parser.add_argument('--jobs', type=_positive_int, default=1,
+                        help='number of threads reading directories in parallel (default: 1)')
+    parser.add_argument('--processes', type=_positive_int, default=1,
+                        help='number of processes listing the path arguments, or with -R the subdirectories of a '
+                             'single path, in parallel (default: 1)')
+    parser.add_argument('--fd-relative', action='store_true',
+                        help='open each directory relative to an open descriptor of its parent and lstat its entries '
+                             'relative to its own descriptor, instead of by their paths, e.g. for very deep trees')
+    parser.add_argument('--max-fds', dest='max_open_fds', type=_positive_int, default=64, metavar='N',
+                        help='maximum number of directory descriptors open at once with --fd-relative, including '
+                             'those of the directories being read (default: 64)')
+    parser.add_argument('--prefetch', type=_positive_int, default=None,
+                        help='maximum number of directories read ahead of the output (default: 4 * jobs)')
+    parser.add_argument('--preload-names', action='store_true',
+                        help='read the whole user and group databases at once instead of looking up names one by one')
+    parser.add_argument('--stream', action='store_true',
+                        help='list huge directories with bounded memory: entries are not sorted, and the output is '
+                             'aligned in chunks of --chunk-size entries, without a total line')
+    parser.add_argument('--chunk-size', type=_positive_int, default=1024,
+                        help='number of entries per chunk with --stream (default: 1024)')
+    parser.add_argument('--cache', action='store_true',
+                        help='read unchanged directories from an on-disk cache, for trees whose files rarely change')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='do not use the cache, even if --cache is given before')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory of the cache (default: $XDG_CACHE_HOME/pyls or ~/.cache/pyls)')
+    parser.add_argument('--cache-size', type=_positive_int, default=64,
+                        help='maximum size of the cache in MiB (default: 64)')
+    parser.add_argument('--watch', action='store_true',
+                        help='after listing the directories, list them again whenever they change, until interrupted')
+    parser.add_argument('--stats', action='store_true',
+                        help='print the time spent in each phase and the number of system calls to stderr at exit')
+    parser.add_argument('--top', type=_positive_int, default=None, metavar='N',
+                        help='only list the first N entries of each directory, e.g. the largest ones with -S, '
+                             'without sorting all entries')
+    parser.add_argument('--top-of-tree', action='store_true',
+                        help='with --top and -R, list the first N entries of all directories together, with their '
+                             'paths')
+    args = parser.parse_args(argv)
+    if args.stream and args.S:
+        parser.error("--stream lists entries in directory order and cannot be combined with -S")
+    if args.stream and args.watch:
+        parser.error("--stream does not keep the entries in memory and cannot be combined with --watch")
+    if args.top is not None and (args.stream or args.watch):
+        parser.error("--top cannot be combined with --stream or --watch")
+    if args.top_of_tree and (args.top is None or not args.R):
+        parser.error("--top-of-tree requires --top and -R")
+    if args.subtree_totals and (not args.R or args.top is not None or args.watch):
+        parser.error("--subtree-totals requires -R, and cannot be combined with --top or --watch")
+    if args.processes > 1 and args.watch:
+        parser.error("--processes cannot be combined with --watch")
 
     # only format output in columns if pyls command is run directly from a terminal
     use_column_layout = sys.stdout.isatty()
@@ -79,141 +676,850 @@ def get_configuration_from_command_line_args() -> Config:
         recursive=args.R,
         paths=args.paths,
         use_column_layout=use_column_layout,
+        jobs=args.jobs,
+        prefetch=args.prefetch,
+        preload_names=args.preload_names,
+        stream_chunk_size=args.chunk_size if args.stream else None,
+        stats=Stats() if args.stats else None,
+        cache=ListingCache(args.cache_dir, args.cache_size * 2 ** 20) if args.cache else None,
+        watch=args.watch,
+        output_format=args.output_format,
+        top=args.top,
+        top_of_tree=args.top_of_tree,
+        processes=args.processes,
+        resolve_links=args.resolve_links,
+        subtree_totals=args.subtree_totals,
+        ignore_patterns=args.ignore_patterns,
+        hide_patterns=args.hide_patterns,
+        fd_relative=args.fd_relative,
+        max_open_fds=args.max_open_fds,
     )
 
 
-def ls_string() -> str:
-    """ Collect the pyls output in a single string. Mostly used for testing. """
-    joined_lines = "\n".join(ls_lines())
-    if joined_lines:  # only add trailing newline to non-empty output
-        joined_lines += "\n"
-    return joined_lines
+def _positive_int(value: str) -> int:
+    """ Argument type for options which require a positive integer. """
+    number = int(value)
+    if number < 1:
+        import argparse
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value}")
+    return number
 
 
-def ls_lines() -> Iterable[str]:
-    """ Iterate over the pyls output line by line. """
-
-    # Use two flags to determine if we need to add path headers and leading newlines, see other comment below:
-    list_multiple_dirs = (len(CONFIG.paths) > 1) or CONFIG.recursive
-    is_first_dir = True
-
-    # Traverse the directory structure.
-    stack = sorted((pathlib.Path(p) for p in CONFIG.paths),
-                   key=_sort_key, reverse=True)
-    while stack:
-        base_dir = stack.pop()
+def ls_string() -> str:
+    """ Collect the pyls output for the options in CONFIG in a single string. Mostly used for testing. """
+    return Lister(CONFIG).string()
 
-        """ In recursive mode or if multiple path arguments are given, we first print a header indicating the current 
-        directory. This header should have a leading newline, unless it is the first line of the output. Since this 
-        requires some awareness of the outer loop, we return the header line here, rather than in
-        format_lines_single_dir function. """
 
-        if list_multiple_dirs:
-            newline = "" if is_first_dir else "\n"
-            yield f"{newline}{base_dir}:"
-            is_first_dir = False
+def ls_lines() -> Iterable[str]:
+    """ Iterate over the pyls output for the options in CONFIG line by line. """
+    return Lister(CONFIG).lines()
 
-        yield from _formatted_lines_single_dir(base_dir)
 
-        if CONFIG.recursive:
-            _populate_stack_for_recursive_execution(base_dir, stack)
+_PAGE_INDEXES: Optional["PageIndexCache"] = None
 
 
-def _formatted_lines_single_dir(base_dir: pathlib.Path) -> Iterable[str]:
+def list_page(path: str, after: Optional[str] = None, limit: int = 100) -> Tuple[List[str], Optional[str]]:
     """
-    Format the lines for the contents of the base_dir properly formatted. This does not include the path
-    headers ("/some/path:") in recursive mode or when executing pyls with multiple path arguments.
+    List a page of the entries of a single directory with the options in CONFIG, and return the lines of the page and
+    the cursor of the next page, see Lister.list_page. The indexes of the directories are kept between calls.
     """
-    paths = list(_iter_single_dir_children(base_dir))
-    if CONFIG.list_format:
-        yield from _lines_of_single_dir_in_list_format(base_dir, paths)
-    else:
-        yield from _lines_of_single_dir_in_short_format(base_dir, paths)
+    global _PAGE_INDEXES
+    if _PAGE_INDEXES is None:
+        _PAGE_INDEXES = PageIndexCache()
+    return Lister(CONFIG, page_indexes=_PAGE_INDEXES).list_page(path, after, limit)
 
 
-def _lines_of_single_dir_in_list_format(base_dir: pathlib.Path,
-                                        paths: List[pathlib.Path]) -> Iterable[str]:
+async def als_lines(config: Config, semaphore: Optional["asyncio.Semaphore"] = None,
+                    executor: Optional["concurrent.futures.Executor"] = None,
+                    batch_size: int = 1024) -> AsyncIterator[str]:
     """
-    Iterate over the formatted rows corresponding to the contents of a single directory in long list format.
-    """
-    yield f"total {_total_num_blocks(paths)}"
-    rows = [_single_row_data_in_list_format(base_dir, p) for p in paths]
-
-    left_align = lambda s, w: s.ljust(w)
-    right_align = lambda s, w: s.rjust(w)
-    no_align = lambda s, w: s
-
-    alignments = [
-        no_align,  # filemode
-        right_align,  # num links
-        left_align,  # user
-        left_align,  # group
-        right_align,  # size_bytes
-        left_align,  # last modified
-        no_align,  # name
-    ]
-
-    col_widths = None
-    if rows:
-        col_widths = [max(len(r[col_idx]) for r in rows) for col_idx in range(len(alignments))]
-
-    for row in rows:
-        yield " ".join(align(val, col_width) for (val, col_width, align) in zip(row, col_widths, alignments))
-
-
-def _total_num_blocks(paths: List[pathlib.Path]) -> int:
-    """ Calculates the total number of blocks allocated for the paths. """
-    blocks = 0
-    for p in paths:
-        blocks += p.lstat().st_blocks
-    # Divide by two, since st_blocks assumes blocksize of 512, while ls uses 1024:
-    # https://docs.python.org/3/library/os.html#os.stat_result.st_blocks
-    # https://unix.stackexchange.com/questions/28780/file-block-size-difference-between-stat-and-ls
-    return blocks // 2
+    Iterate over the pyls output for the given config line by line, like ls_lines, without blocking the event loop.
 
+    The listing runs on the executor (by default, the one of the event loop), which produces the lines in batches of
+    batch_size lines, so that the file system calls and the formatting of each batch take a single round trip to a
+    thread. Listings do not share any state, so the batches of concurrent listings run in parallel. To limit the
+    number of listings running at the same time, pass the same semaphore to all of them. Watch mode is not supported,
+    since its listing never ends.
+    """
+    if config.watch:
+        raise ValueError("als_lines does not support watch mode")
+    import asyncio
+    import contextlib
+    loop = asyncio.get_running_loop()
+    async with (semaphore if semaphore is not None else contextlib.AsyncExitStack()):
+        lines = Lister(config).lines()
+        batch_future = None
+        try:
+            while True:
+                # If the consumer is cancelled, the batch keeps running on the executor thread anyway, so it is
+                # shielded and waited for below: the generator cannot be closed while it is running.
+                batch_future = loop.run_in_executor(executor, _next_batch, lines, batch_size)
+                batch = await asyncio.shield(batch_future)
+                for line in batch:
+                    yield line
+                if len(batch) < batch_size:
+                    break
+        finally:
+            if batch_future is not None and not batch_future.done():
+                with contextlib.suppress(Exception):
+                    await asyncio.shield(batch_future)
+            await loop.run_in_executor(executor, lines.close)
+
+
+def _next_batch(lines: Iterator[str], batch_size: int) -> List[str]:
+    return list(itertools.islice(lines, batch_size))
+
+
+class Lister:
+    """
+    Lists directories with the options of its config. The pyls command, ls_lines, ls_string, als_lines and list_page
+    all use a Lister to produce their output.
+
+    A lister owns the state of its listings: the config, the cache of user and group names, unless one is passed to
+    share it between listers, and the collation key function of the locale, which is determined when the lister is
+    created. The modification times are formatted relative to the start of each listing. Listers do not share any
+    state through module globals, so many listers can run on different threads at the same time, as can several
+    listings of the same lister.
+
+    Besides the text of ls, the output can be produced in two machine-readable formats, which do not depend on the
+    locale, apart from the order of the entries, and which are cheaper to produce than the long list format, since
+    nothing is aligned and no user or group names are looked up:
+
+      - "jsonl": one JSON object per line. Each directory starts with {"type": "directory", "path": ...}, followed by
+        {"type": "total", "total": ...} in the long list format, as in the output of ls. Each entry is an object
+        {"type": "entry", "name": ...}, with the raw fields "mode", "nlink", "uid", "gid", "size" and "mtime_ns" of
+        its lstat result in the long list format, and "target" for symlinks. Non-ASCII characters are escaped, and
+        names which are not valid in the file system encoding contain the surrogates of os.fsdecode.
+      - "nul": the path of each entry, i.e. the path of its directory joined with its name, terminated by a NUL byte
+        instead of a newline, as by find -print0. In the long list format, the path is preceded by the fields
+        "mode nlink uid gid size mtime_ns" and a tab. There are no directory headers or totals.
+
+    Combined with streaming, the memory used for either format is bounded as well.
+    """
 
-def _single_row_data_in_list_format(base_dir: pathlib.Path,
-                                    p: pathlib.Path) -> Tuple[str, str, str, str, str, str, str]:
-    """ Collect all items required to print a row in the long list format to a single tuple. """
-    lstat = p.lstat()
+    def __init__(self, config: Optional[Config] = None, name_cache: Optional[NameCache] = None,
+                 page_indexes: Optional["PageIndexCache"] = None):
+        self.config = config if config is not None else Config()
+        if self.config.output_format not in _OUTPUT_FORMATS:
+            raise ValueError(f"unknown output format {self.config.output_format!r}")
+        if self.config.subtree_totals and (self.config.top is not None or self.config.watch):
+            raise ValueError("subtree totals need all entries of each directory once, they cannot be combined with "
+                             "top or watch")
+        self.name_cache = name_cache if name_cache is not None else NameCache()
+        self.page_indexes = page_indexes  # created by list_page when it is first needed
+        self._collation_key = _collation_key_function()
+        self._excluded_name = _excluded_name_matcher(self.config.show_all, self.config.hide_patterns,
+                                                     self.config.ignore_patterns)
+
+    def _new_resolver(self) -> Optional["_SymlinkResolver"]:
+        """
+        With config.resolve_links, the resolver of a single listing, which starts with an empty cache of resolved
+        paths, since the links may change. Each listing has its own, so that concurrent listings do not share one.
+        """
+        return _SymlinkResolver() if self.config.resolve_links else None
+
+    @property
+    def terminator(self) -> str:
+        """ The character which terminates each of the lines produced by the lister. """
+        return "\0" if self.config.output_format == "nul" else "\n"
+
+    def string(self) -> str:
+        """ Collect the output in a single string. """
+        joined_lines = self.terminator.join(self.lines())
+        if joined_lines:  # only add trailing terminator to non-empty output
+            joined_lines += self.terminator
+        return joined_lines
+
+    def lines(self, end_of_directory: Optional[Callable[[], None]] = None) -> Iterator[str]:
+        """ Iterate over the output line by line, calling end_of_directory after the lines of each directory. """
+        lines = self._lines(end_of_directory)
+        if self.config.stats is not None:
+            lines = _with_current_stats(self.config.stats, lines)
+        return lines
+
+    def _lines(self, end_of_directory: Optional[Callable[[], None]] = None) -> Iterator[str]:
+        config = self.config
+
+        # Use this flag to determine if we need to add path headers, see the comment in _traversal_lines:
+        list_multiple_dirs = (len(config.paths) > 1) or config.recursive
+
+        if config.watch:
+            yield from self._watch_lines(end_of_directory)
+            return
+        # Traverse the directory structure. All modification times are shown relative to the time at which we start,
+        # and symlinks are resolved as of the start.
+        timestamps = TimestampFormatter()
+        resolver = self._new_resolver()
+        stack = self._sorted_entries(_top_level_entries(config.paths, self._collation_key), reverse=True)
+        if config.list_format and config.preload_names and not self.name_cache.preloaded:
+            self.name_cache.preload()
+        if config.top is not None and config.top_of_tree and config.recursive:
+            yield from self._top_of_tree_lines(stack, timestamps, resolver)
+            return
+        if config.processes > 1 and (len(stack) > 1 or config.recursive) and not config.subtree_totals:
+            yield from self._sharded_lines(stack, timestamps, resolver, list_multiple_dirs, end_of_directory)
+        else:
+            yield from self._traversal_lines(stack, timestamps, resolver, list_multiple_dirs, True, end_of_directory)
+        if config.cache is not None:
+            config.cache.evict()
+
+    def _traversal_lines(self, stack: List[Entry], timestamps: TimestampFormatter,
+                         resolver: Optional["_SymlinkResolver"], list_multiple_dirs: bool, is_first_dir: bool,
+                         end_of_directory: Optional[Callable[[], None]] = None,
+                         max_directories: Optional[int] = None) -> Iterator[str]:
+        """
+        Iterate over the output of the directories on the stack, in the order in which they are popped, and of their
+        subdirectories in recursive mode. If max_directories is given, stop after listing this many directories, and
+        leave the ones which are not listed yet on the stack.
+        """
+        config = self.config
+        if config.subtree_totals:
+            # The totals of the directories whose subtrees are not complete yet, by the id of their entries, and the
+            # device and inode of the files with several hard links which are counted already.
+            totals_by_dir: Dict[int, _SubtreeTotals] = {}
+            hard_links: Set[Tuple[int, int]] = set()
+        # Directories read from the listing cache are found by their paths, so the cache does not use descriptors.
+        # Neither do the directories above the shards, whose subdirectories are left on the stack.
+        dir_fds = None
+        if config.fd_relative and config.cache is None and max_directories is None:
+            dir_fds = _DirectoryFds(config.max_open_fds)
+        read_dir_listing = functools.partial(self._read_dir_listing, resolver=resolver,
+                                             with_totals=config.subtree_totals, dir_fds=dir_fds)
+        # Streamed directories are read while they are output, so reading them ahead would read them whole, twice.
+        # The directories left on the stack by max_directories are listed elsewhere, so they are not read ahead either.
+        jobs = config.jobs if not config.stream_chunk_size and max_directories is None else 1
+        import contextlib
+        # The descriptors are closed after the reader has stopped, so that none are left open by prefetched reads.
+        with (dir_fds if dir_fds is not None else contextlib.nullcontext()), \
+                _DirectoryReader(read_dir_listing, jobs, config.prefetch) as reader:
+            reader.prefetch(stack)
+            num_directories = 0
+            while stack and num_directories != max_directories:
+                base_dir = stack.pop()
+                num_directories += 1
+                stack_size = len(stack)
+                totals = None
+                if config.subtree_totals:
+                    parent_totals = totals_by_dir.get(id(base_dir.parent)) if base_dir.parent is not None else None
+                    totals = _SubtreeTotals(base_dir, parent_totals, hard_links)
+
+                """ In recursive mode or if multiple path arguments are given, we first print a header indicating the
+                current directory. This header should have a leading newline, unless it is the first line of the
+                output. Since this requires some awareness of the outer loop, we return the header line here, rather
+                than in format_lines_single_dir function. """
+
+                yield from self._directory_header(base_dir, list_multiple_dirs, is_first_dir)
+                is_first_dir = False
+
+                if config.stream_chunk_size:
+                    lines = self._streamed_lines_single_dir(base_dir, stack, timestamps, resolver, totals, dir_fds)
+                else:
+                    # The directory is read only once, and the same listing is used for the output and the recursion.
+                    listing = reader.read(base_dir)
+                    if totals is not None:
+                        totals.add_listing(listing)
+                    if config.recursive:
+                        self._populate_stack_for_recursive_execution(base_dir, listing.subdirs, stack)
+                    # Start reading the next directories before formatting the output of the current one.
+                    reader.prefetch(stack)
+                    lines = self._formatted_lines_single_dir(base_dir, listing, timestamps)
+
+                if config.stats is not None:
+                    config.stats.directories += 1
+                    lines = _timed(config.stats, "format", lines)
+                yield from lines
+                if totals is not None:
+                    # The subdirectories pushed onto the stack are listed next, the subtree is complete without them.
+                    totals.pending = len(stack) - stack_size
+                    yield from self._completed_subtree_lines(totals, totals_by_dir)
+                if end_of_directory is not None:
+                    end_of_directory()
+
+    def _completed_subtree_lines(self, totals: "_SubtreeTotals",
+                                 totals_by_dir: Dict[int, "_SubtreeTotals"]) -> Iterator[str]:
+        """
+        Iterate over the totals of the subtrees which are complete once the directory of totals is listed: its own, if
+        it has no subdirectories to list, and then those of its ancestors whose last subtree it completes. Each
+        complete subtree adds its totals to its parent. Only the totals of incomplete subtrees are kept.
+        """
+        if totals.pending:
+            totals_by_dir[id(totals.base_dir)] = totals
+            return
+        while totals is not None and totals.pending == 0:
+            totals_by_dir.pop(id(totals.base_dir), None)
+            yield from self._subtree_totals_lines(totals)
+            parent = totals.parent
+            if parent is not None:
+                parent.add_subtree(totals)
+            totals = parent
+
+    def _subtree_totals_lines(self, totals: "_SubtreeTotals") -> Iterator[str]:
+        """
+        The line with the totals of a subtree. There is none in the nul format, which has no directory headers.
+
+        The line follows the listing of the tree rather than the header of its directory: the totals are only known
+        once the whole tree is read, and holding back the output of the tree until then would keep all of it in
+        memory, rather than the totals of the incomplete subtrees only.
+        """
+        if self.config.output_format == "jsonl":
+            import json.encoder
+            path = json.encoder.encode_basestring_ascii(str(totals.base_dir.path))
+            yield (f'{{"type": "subtree", "path": {path}, "size": {totals.size}, "blocks": {totals.blocks // 2}, '
+                   f'"files": {totals.files}}}')
+        elif self.config.output_format == "text":
+            yield (f"\nsubtree {totals.base_dir.path}: {totals.files} files, {totals.size} bytes, "
+                   f"{totals.blocks // 2} blocks")
+
+    def _sharded_lines(self, stack: List[Entry], timestamps: TimestampFormatter,
+                       resolver: Optional["_SymlinkResolver"], list_multiple_dirs: bool,
+                       end_of_directory: Optional[Callable[[], None]] = None) -> Iterator[str]:
+        """
+        Iterate over the output like _traversal_lines, with the directories listed by config.processes worker
+        processes. Each path argument is a shard, or, for a single path in recursive mode, each subtree below it, after
+        the path itself is listed here. The output of a subtree is contiguous, so the workers list their shards
+        independently, each into a single buffer, see _list_shard. The blocks are yielded in the order of the shards,
+        which is the order of the serial output, with end_of_directory called after each block. At most two shards
+        per process are listed ahead of the output. If the iteration is stopped early, e.g. since the reader of the
+        output went away, the workers are terminated rather than left to finish the shards they are listing.
+        """
+        config = self.config
+        is_first_dir = True
+        if len(stack) == 1:
+            yield from self._traversal_lines(stack, timestamps, resolver, list_multiple_dirs, True, end_of_directory,
+                                             max_directories=1)
+            is_first_dir = False
+        shards = [(str(e.path), list_multiple_dirs, is_first_dir and i == 0) for i, e in enumerate(reversed(stack))]
+        stack.clear()
+
+        # The workers get a copy of the config without the Stats object and the cache, which cannot be pickled. They
+        # make their own, and the recorded statistics are added to the ones of this listing.
+        shard_config = Config(**vars(config))
+        shard_config.processes = 1
+        shard_config.stats = None
+        shard_config.cache = None
+        cache_args = (str(config.cache.cache_dir), config.cache.max_bytes) if config.cache is not None else None
+        # Unlike concurrent.futures before Python 3.9, a multiprocessing pool can be shut down without waiting for the
+        # running shards.
+        import multiprocessing
+        pool = multiprocessing.Pool(config.processes)
+        completed = False
+        try:
+            pending = []
+            for i in range(len(shards)):
+                while len(pending) < 2 * config.processes and i + len(pending) < len(shards):
+                    path, multiple, first = shards[i + len(pending)]
+                    pending.append(pool.apply_async(_list_shard, (shard_config, path, multiple, first, timestamps.now,
+                                                                  config.stats is not None, cache_args)))
+                text, lengths, counters, error = pending.pop(0).get()
+                if config.stats is not None:
+                    config.stats._add_counters(counters)
+                start = 0
+                for length in lengths:
+                    yield text[start:start + length]
+                    start += length
+                if error is not None:
+                    raise error
+                if end_of_directory is not None:
+                    end_of_directory()
+            completed = True
+        finally:
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+    def _watch_lines(self, end_of_directory: Optional[Callable[[], None]] = None) -> Iterator[str]:
+        """
+        Iterate over the output in watch mode: first the directories are listed as by _lines, then the listing of
+        each directory is repeated, with a header, whenever the directory changes. This ends when all watched
+        directories are gone, or when the iteration is stopped by the caller.
+        """
+        list_multiple_dirs = (len(self.config.paths) > 1) or self.config.recursive
+        timestamps = TimestampFormatter()
+        resolver = self._new_resolver()
+        with _Inotify() as inotify:
+            watcher = _DirectoryWatcher(inotify, self)
+            stack = self._sorted_entries(_top_level_entries(self.config.paths, self._collation_key), reverse=True)
+            for i, d in enumerate(watcher.add(stack)):
+                yield from self._directory_header(d.base_dir, list_multiple_dirs, i == 0)
+                yield from self._formatted_lines_single_dir(d.base_dir, d.listing(self.config.list_format, resolver),
+                                                            timestamps)
+                if end_of_directory is not None:
+                    end_of_directory()
+
+            while watcher.has_watches():
+                changed = watcher.wait_for_changes()
+                # Show the modification times relative to the time of the change, rather than the start of pyls.
+                timestamps = TimestampFormatter()
+                resolver = self._new_resolver()
+                for d in changed:
+                    yield from self._directory_header(d.base_dir, True, False)
+                    listing = d.listing(self.config.list_format, resolver)
+                    yield from self._formatted_lines_single_dir(d.base_dir, listing, timestamps)
+                    if end_of_directory is not None:
+                        end_of_directory()
+
+    def _top_of_tree_lines(self, stack: List[Entry], timestamps: TimestampFormatter,
+                           resolver: Optional["_SymlinkResolver"]) -> Iterator[str]:
+        """
+        Iterate over the lines of a single listing of the first config.top entries of all directories below the
+        entries on the stack, as if they were in a single directory. The entries are shown and ordered by their paths
+        instead of their names, and the special entries . and .. are left out. The directories are read in any order,
+        and only config.top entries are kept at a time, plus the directories which still have to be read.
+        """
+        stats = self.config.stats
+
+        def tree_entries() -> Iterator[Entry]:
+            while stack:
+                base_dir = stack.pop()
+                if stats is not None:
+                    stats.directories += 1
+                subdirs = []
+                for e in self._iter_scandir_visible(base_dir):
+                    e.collation_key = self._collation_key(str(e.path))
+                    if e.is_dir():
+                        subdirs.append(e)
+                    yield e
+                self._populate_stack_for_recursive_execution(base_dir, subdirs, stack)
+
+        top = [e.alias(str(e.path)) for e in self._top_entries(tree_entries(), self.config.top)]
+        listing = DirectoryListing(top, with_lstat=self.config.list_format, resolver=resolver)
+        lines = self._formatted_lines_single_dir(None, listing, timestamps, include_total=False)
+        yield from (lines if stats is None else _timed(stats, "format", lines))
+
+    def _directory_header(self, base_dir: Entry, list_multiple_dirs: bool, is_first_dir: bool) -> Iterator[str]:
+        """
+        The header before the entries of a directory. In the text format, this is the path of the directory, which is
+        only shown if several directories are listed. In the jsonl format, every directory gets a header record.
+        """
+        if self.config.output_format == "jsonl":
+            import json.encoder
+            yield f'{{"type": "directory", "path": {json.encoder.encode_basestring_ascii(str(base_dir.path))}}}'
+        elif self.config.output_format == "text" and list_multiple_dirs:
+            newline = "" if is_first_dir else "\n"
+            yield f"{newline}{base_dir.path}:"
+
+    def _formatted_lines_single_dir(self, base_dir: Optional[Entry], listing: "DirectoryListing",
+                                    timestamps: TimestampFormatter, include_total: bool = True) -> Iterator[str]:
+        """
+        Format the lines for the entries of a single directory. This does not include the path
+        headers ("/some/path:") in recursive mode or when executing pyls with multiple path arguments.
+        """
+        if self.config.stats is not None:
+            self.config.stats.entries += len(listing)
+        if self.config.output_format == "jsonl":
+            yield from self._lines_of_single_dir_in_jsonl_format(listing, include_total)
+        elif self.config.output_format == "nul":
+            yield from self._lines_of_single_dir_in_nul_format(base_dir, listing)
+        elif self.config.list_format:
+            yield from self._lines_of_single_dir_in_list_format(listing, timestamps, include_total)
+        else:
+            yield from self._lines_of_single_dir_in_short_format(listing)
+
+    def _streamed_lines_single_dir(self, base_dir: Entry, stack: List[Entry], timestamps: TimestampFormatter,
+                                   resolver: Optional["_SymlinkResolver"], totals: Optional["_SubtreeTotals"] = None,
+                                   dir_fds: Optional["_DirectoryFds"] = None) -> Iterator[str]:
+        """
+        Format the lines for the entries of a single directory in the order in which they are read from the directory.
+
+        The entries are formatted in chunks of config.stream_chunk_size entries, with the column widths of each chunk
+        computed separately, so that only a single chunk is kept in memory, plus the subdirectories required for
+        recursive listings. The total number of blocks is unknown until the whole directory is read, so it is omitted.
+        A directory which fits into the first chunk is sorted and listed with its total instead, like without
+        streaming, so only directories larger than a chunk are listed differently. The sizes of the entries are added
+        to totals, if given, and the directory is read relative to the descriptor of its parent, if dir_fds are given.
+        """
+        if dir_fds is None:
+            yield from self._streamed_lines_single_dir_at(base_dir, None, stack, timestamps, resolver, totals)
+            return
+        fd = dir_fds.open(base_dir)
+        pushed = None
+        try:
+            stack_size = len(stack)
+            yield from self._streamed_lines_single_dir_at(base_dir, fd, stack, timestamps, resolver, totals)
+            pushed = stack[stack_size:]
+        finally:
+            dir_fds.release(base_dir, fd, pushed or [])
+
+    def _streamed_lines_single_dir_at(self, base_dir: Entry, dir_fd: Optional[int], stack: List[Entry],
+                                      timestamps: TimestampFormatter, resolver: Optional["_SymlinkResolver"],
+                                      totals: Optional["_SubtreeTotals"]) -> Iterator[str]:
+        config = self.config
+        with_totals = totals is not None
+        children = self._iter_unsorted_dir_children(base_dir, dir_fd)
+        first_chunk = list(itertools.islice(children, config.stream_chunk_size + 1))
+        if len(first_chunk) <= config.stream_chunk_size:
+            listing = DirectoryListing(self._sorted_entries(first_chunk), with_lstat=config.list_format,
+                                       with_subdirs=config.recursive, resolver=resolver,
+                                       with_totals=with_totals, dir_fd=dir_fd)
+            if totals is not None:
+                totals.add_listing(listing)
+            if config.recursive:
+                self._populate_stack_for_recursive_execution(base_dir, listing.subdirs, stack)
+            yield from self._formatted_lines_single_dir(base_dir, listing, timestamps)
+            return
+
+        subdirs = []
+        chunk = []
+        for e in itertools.chain(first_chunk, children):
+            chunk.append(e)
+            if len(chunk) == config.stream_chunk_size:
+                listing = DirectoryListing(chunk, with_lstat=config.list_format, with_subdirs=config.recursive,
+                                           resolver=resolver, with_totals=with_totals, dir_fd=dir_fd)
+                if totals is not None:
+                    totals.add_listing(listing)
+                subdirs.extend(listing.subdirs)
+                yield from self._formatted_lines_single_dir(base_dir, listing, timestamps, include_total=False)
+                chunk = []
+        if chunk:
+            listing = DirectoryListing(chunk, with_lstat=config.list_format, with_subdirs=config.recursive,
+                                       resolver=resolver, with_totals=with_totals, dir_fd=dir_fd)
+            if totals is not None:
+                totals.add_listing(listing)
+            subdirs.extend(listing.subdirs)
+            yield from self._formatted_lines_single_dir(base_dir, listing, timestamps, include_total=False)
+        if config.recursive:
+            self._populate_stack_for_recursive_execution(base_dir, subdirs, stack)
+
+    def _lines_of_single_dir_in_list_format(self, listing: "DirectoryListing", timestamps: TimestampFormatter,
+                                            include_total: bool = True) -> Iterator[str]:
+        """
+        Iterate over the formatted rows corresponding to the contents of a single directory in long list format.
+
+        The column widths are computed from the integer columns of the listing, and the strings of each row are only
+        created when the row is formatted, so the rows are never all kept in memory.
+        """
+        if include_total:
+            # Divide by two, since st_blocks assumes blocksize of 512, while ls uses 1024:
+            # https://docs.python.org/3/library/os.html#os.stat_result.st_blocks
+            # https://unix.stackexchange.com/questions/28780/file-block-size-difference-between-stat-and-ls
+            yield f"total {listing.num_blocks // 2}"
+        if not listing.names:
+            return
+
+        user_names = {uid: self.name_cache.user_name(uid) for uid in set(listing.uids)}
+        group_names = {gid: self.name_cache.group_name(gid) for gid in set(listing.gids)}
+        num_links_width = len(str(max(listing.num_links)))
+        user_width = max(len(name) for name in user_names.values())
+        group_width = max(len(name) for name in group_names.values())
+        size_width = len(str(max(listing.sizes)))
+        last_modified_width = max(len(timestamps.format(mtime_ns / 1e9)) for mtime_ns in listing.mtimes_ns)
+
+        for i, name in enumerate(listing.names):
+            if i in listing.link_targets:
+                name = f"{name} -> {listing.link_targets[i]}"
+            # The file mode and name are not aligned, numbers are aligned to the right, and other columns to the left.
+            yield " ".join((
+                stat.filemode(listing.modes[i]),
+                str(listing.num_links[i]).rjust(num_links_width),
+                user_names[listing.uids[i]].ljust(user_width),
+                group_names[listing.gids[i]].ljust(group_width),
+                str(listing.sizes[i]).rjust(size_width),
+                timestamps.format(listing.mtimes_ns[i] / 1e9).ljust(last_modified_width),
+                name,
+            ))
+
+    def _lines_of_single_dir_in_jsonl_format(self, listing: "DirectoryListing",
+                                             include_total: bool = True) -> Iterator[str]:
+        """
+        Iterate over the JSON records of the entries of a single directory, see the Lister docstring. The records are
+        written directly from the columns of the listing, only the strings are encoded by the json module.
+        """
+        import json.encoder
+        quote = json.encoder.encode_basestring_ascii
+        if not self.config.list_format:
+            for name in listing.names:
+                yield f'{{"type": "entry", "name": {quote(name)}}}'
+            return
+
+        if include_total:
+            yield f'{{"type": "total", "total": {listing.num_blocks // 2}}}'
+        for i, name in enumerate(listing.names):
+            target = f', "target": {quote(listing.link_targets[i])}' if i in listing.link_targets else ""
+            yield (f'{{"type": "entry", "name": {quote(name)}, "mode": {listing.modes[i]}, '
+                   f'"nlink": {listing.num_links[i]}, "uid": {listing.uids[i]}, "gid": {listing.gids[i]}, '
+                   f'"size": {listing.sizes[i]}, "mtime_ns": {listing.mtimes_ns[i]}{target}}}')
+
+    def _lines_of_single_dir_in_nul_format(self, base_dir: Optional[Entry],
+                                           listing: "DirectoryListing") -> Iterator[str]:
+        """
+        Iterate over the NUL-terminated records of the entries of a single directory, see the Lister docstring. Without
+        a base_dir, the names of the entries are their paths already.
+        """
+        prefix = os.path.join(str(base_dir.path), "") if base_dir is not None else ""
+        if not self.config.list_format:
+            for name in listing.names:
+                yield prefix + name
+            return
+
+        for i, name in enumerate(listing.names):
+            yield (f"{listing.modes[i]} {listing.num_links[i]} {listing.uids[i]} {listing.gids[i]} "
+                   f"{listing.sizes[i]} {listing.mtimes_ns[i]}\t{prefix}{name}")
+
+    def _lines_of_single_dir_in_short_format(self, listing: "DirectoryListing") -> Iterator[str]:
+        """
+        This function defines the layout of results in the pyls execution without arguments. The algorithm which
+        arranges results in columns was ported from the original ls source code.
+        """
+        if not self.config.use_column_layout:
+            yield from listing.names  # yield one path name per line
+        else:
+            yield from _lines_in_short_format_many_per_line(listing.names)
 
-    filemode = stat.filemode(lstat.st_mode)
-    num_links_dirs = str(lstat[stat.ST_NLINK])
+    def _iter_single_dir_children(self, base_dir: Entry, dir_fd: Optional[int] = None) -> Iterator[Entry]:
+        """
+        Iterate over the children of a directory in sorted order.
 
-    # User and Group code adapted from
-    # https://stackoverflow.com/questions/1830618/how-to-find-the-owner-of-a-file-or-directory-in-python
-    user = str(pwd.getpwuid(lstat.st_uid).pw_name)
-    group = str(grp.getgrgid(lstat.st_uid).gr_name)
+        Compared to calling os.scandir(), this function:
 
-    size_bytes = str(lstat.st_size)
-    last_modified = _last_modified_time_str(lstat)
-    name = _printable_path_name(base_dir, p)
+          1. Returns the entries in sorted order depending on the config.sort_by_size parameter
+          2. Includes the special entries . and .., which are not returned by os.scandir
+          3. Leaves out the excluded entries, see _excluded_name_matcher, before they are sorted
 
-    if p.is_symlink():
-        name = f"{name} -> {p.resolve()}"
+        If dir_fd is given, it is an open descriptor of the directory, which is read instead of its path.
+        """
+        if self.config.cache is not None:
+            children = self._without_excluded(self.config.cache.scan_dir(base_dir.path))
+        else:
+            children = _scan_dir(base_dir.path, self._excluded_name, dir_fd)
+        # Like ls, sort . and .. together with the other entries. In most locales, they end up first anyway.
+        children.extend(self._special_entries(base_dir))
+        yield from self._sorted_entries(children)
+
+    def _iter_unsorted_dir_children(self, base_dir: Entry, dir_fd: Optional[int] = None) -> Iterator[Entry]:
+        """ Iterate over the children of a directory in the order of os.scandir, preceded by . and .. if requested. """
+        yield from self._special_entries(base_dir)
+        yield from _iter_scandir(base_dir.path, self._excluded_name, dir_fd)
+
+    def _read_dir_listing(self, base_dir: Entry, resolver: Optional["_SymlinkResolver"] = None,
+                          with_totals: bool = False, dir_fds: Optional["_DirectoryFds"] = None) -> "DirectoryListing":
+        """
+        Read the sorted and filtered entries of a directory, including the lstat results needed to format them. This
+        is all the file system access required to list a single directory. With with_totals, the listing also adds
+        up the sizes of the entries, see DirectoryListing. With dir_fds, the directory is opened relative to the
+        descriptor of its parent, and its entries are read and statted relative to its own descriptor.
+
+        With config.top, only the first entries are kept while the directory is read. In recursive listings, the
+        subdirectories are still all entered, so they are collected separately.
+        """
+        if dir_fds is None:
+            return self._read_dir_listing_at(base_dir, None, resolver, with_totals)
+        fd = dir_fds.open(base_dir)
+        subdirs = []
+        try:
+            listing = self._read_dir_listing_at(base_dir, fd, resolver, with_totals)
+            subdirs = self._subdirs_to_enter(base_dir, listing.subdirs)
+        finally:
+            dir_fds.release(base_dir, fd, subdirs)
+        return listing
+
+    def _read_dir_listing_at(self, base_dir: Entry, dir_fd: Optional[int], resolver: Optional["_SymlinkResolver"],
+                             with_totals: bool) -> "DirectoryListing":
+        if self.config.top is None:
+            entries = list(self._iter_single_dir_children(base_dir, dir_fd))
+            return DirectoryListing(entries, with_lstat=self.config.list_format, with_subdirs=self.config.recursive,
+                                    resolver=resolver, with_totals=with_totals, dir_fd=dir_fd)
+
+        children = itertools.chain(self._special_entries(base_dir), self._iter_scandir_visible(base_dir, dir_fd))
+        subdirs = []
+        if self.config.recursive:
+            children = _collecting_subdirs(children, subdirs)
+        listing = DirectoryListing(self._top_entries(children, self.config.top), with_lstat=self.config.list_format,
+                                   resolver=resolver, dir_fd=dir_fd)
+        listing.subdirs = self._sorted_entries(subdirs)
+        return listing
+
+    def _iter_scandir_visible(self, base_dir: Entry, dir_fd: Optional[int] = None) -> Iterator[Entry]:
+        """ Iterate over the entries of a directory which are not excluded, in directory order, without . and .. """
+        if self.config.cache is not None:
+            yield from self._without_excluded(self.config.cache.scan_dir(base_dir.path))
+        else:
+            yield from _iter_scandir(base_dir.path, self._excluded_name, dir_fd)
+
+    def _top_entries(self, entries: Iterable[Entry], n: int) -> List[Entry]:
+        """
+        Return the first n entries in the order of _sort_key, like _sorted_entries(entries)[:n], but with a heap of n
+        entries, so that only n entries are kept in memory while iterating over the entries. This takes O(len(entries)
+        * log(n)) time instead of O(len(entries) * log(len(entries))). Collation keys which are set already are used
+        as they are.
+        """
+        collation_key = self._collation_key
+
+        def key(e: Entry) -> Any:
+            if e.collation_key is None:
+                e.collation_key = collation_key(e.name)
+            return self._sort_key(e)
+
+        stats = self.config.stats
+        if stats is not None:
+            stats.enter("sort")
+        try:
+            return heapq.nsmallest(n, entries, key=key)
+        finally:
+            if stats is not None:
+                stats.exit()
+
+    def _populate_stack_for_recursive_execution(self, base_dir: Entry,
+                                                subdirs: List[Entry],
+                                                stack: List[Entry]):
+        """
+        Push the subdirectories of base_dir, in the order of the output, onto the stack, such that they are popped in
+        the same order in which they appear in the output.
+        """
+        for c in reversed(self._subdirs_to_enter(base_dir, subdirs)):
+            c.parent = base_dir
+            stack.append(c)
 
-    return filemode, num_links_dirs, user, group, size_bytes, last_modified, name
+    def _subdirs_to_enter(self, base_dir: Entry, subdirs: List[Entry]) -> List[Entry]:
+        """ The subdirectories of base_dir which are entered in recursive listings. """
+        if base_dir.is_symlink():
+            return []  # don't enter symlinks
+        if self._is_hidden_name(base_dir.name):
+            return []
+        return subdirs
+
+    def list_page(self, path: str, after: Optional[str] = None, limit: int = 100) -> Tuple[List[str], Optional[str]]:
+        """
+        List a page of at most limit entries of a single directory, in the order of its full listing, starting after
+        the entry of the cursor after, or at the first entry. Return the lines of the entries, formatted like a chunk
+        of the listing, see _streamed_lines_single_dir, without a header or total, and the cursor of the next page,
+        which is None after the last page.
+
+        The sorted names of the directory are kept in the page index cache of the lister, so a page of an unchanged
+        directory costs a stat of the directory, a binary search for the cursor and the lstat calls of the entries of
+        the page, rather than reading and sorting the whole directory. The cursor identifies the last entry of the
+        page by its name, and its size with sort_by_size, so if the directory changes between pages, the next page
+        continues after the position of that entry in the new listing.
+        """
+        if limit < 1:
+            raise ValueError(f"expected a positive limit, got {limit}")
+        if self.page_indexes is None:
+            self.page_indexes = PageIndexCache()
+        config = self.config
+        token = _CURRENT_STATS.set(config.stats)
+        try:
+            base_dir = Entry(pathlib.Path(path).name, pathlib.Path(path))
+            st = os.stat(path)
+            key = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_ctime_ns)
+            options = (config.show_all, config.sort_by_size, self._collation_key, tuple(config.ignore_patterns),
+                       tuple(config.hide_patterns))
+            index = self.page_indexes.get(path, options, key)
+            if index is None:
+                entries = list(self._iter_single_dir_children(base_dir))
+                index = [e.name for e in entries], [self._sort_key(e) for e in entries]
+                # A directory modified within the resolution of its timestamps might change again without changing
+                # the key, see ListingCache.
+                if time.time_ns() - st.st_mtime_ns >= ListingCache._RECENTLY_MODIFIED_NS:
+                    self.page_indexes.put(path, options, key, *index)
+            names, sort_keys = index
+
+            start = 0
+            if after is not None:
+                size, name = _decode_page_cursor(after)
+                collation_key = self._collation_key(name)
+                start = bisect.bisect_right(sort_keys, (-size, collation_key) if config.sort_by_size else collation_key)
+            end = min(start + limit, len(names))
+            # The entries of the page are read again, since the index only has their names.
+            page = [Entry(name, dir_path=base_dir.path) for name in names[start:end]]
+            listing = DirectoryListing(page, with_lstat=config.list_format, resolver=self._new_resolver())
+            lines = list(self._formatted_lines_single_dir(base_dir, listing, TimestampFormatter(), include_total=False))
+            cursor = None
+            if end < len(names):
+                cursor = _encode_page_cursor(-sort_keys[end - 1][0] if config.sort_by_size else 0, names[end - 1])
+            return lines, cursor
+        finally:
+            _CURRENT_STATS.reset(token)
+
+    def _is_hidden_name(self, name: str) -> bool:
+        """ Determine if a directory with the given name is hidden, so that it is not entered in recursive listings. """
+        return not self.config.show_all and name.startswith(".")
+
+    def _is_excluded_name(self, name: str) -> bool:
+        """ Determine if an entry with the given name should be excluded from the pyls output. """
+        return self._excluded_name is not None and self._excluded_name(name) is not None
+
+    def _without_excluded(self, entries: List[Entry]) -> List[Entry]:
+        if self._excluded_name is None:
+            return entries
+        return [e for e in entries if self._excluded_name(e.name) is None]
+
+    def _special_entries(self, base_dir: Entry) -> List[Entry]:
+        """ The entries . and .. of a directory, if they are shown. """
+        if not self.config.show_all:
+            return []
+        return self._without_excluded(_special_entries(base_dir))
+
+    def _sorted_entries(self, entries: List[Entry], reverse: bool = False) -> List[Entry]:
+        """ Sort the entries by _sort_key, computing the collation key of each entry only once. """
+        stats = self.config.stats
+        if stats is not None:
+            stats.enter("sort")
+        try:
+            collation_key = self._collation_key
+            for e in entries:
+                if e.collation_key is None:
+                    e.collation_key = collation_key(e.name)
+            return sorted(entries, key=self._sort_key, reverse=reverse)
+        finally:
+            if stats is not None:
+                stats.exit()
+
+    def _sort_key(self, e: Entry) -> Any:
+        """
+        The sorting key used throughout the program. Depending on the config.sort_by_size parameter, the key is the
+        collation key of the entry name, or a tuple of an integer containing the negative size of the entry and the
+        collation key in order to resolve ties.
+        """
+        if self.config.sort_by_size:
+            # use the negative size, as largest files should be printed first
+            # make a tuple with the name key as the second element to resolve ties.
+            return (-e.lstat().st_size,
+                    e.collation_key)
+        else:
+            return e.collation_key
 
 
-def _lines_of_single_dir_in_short_format(base_dir: pathlib.Path,
-                                         paths: List[pathlib.Path]) -> Iterable[str]:
+def _list_shard(config: Config, path: str, list_multiple_dirs: bool, is_first_dir: bool, now: float,
+                with_stats: bool, cache_args: Optional[Tuple[str, int]]) -> Tuple[str, "array.array", Optional[tuple],
+                                                                               Optional[BaseException]]:
     """
-    This function defines the layout of results in the pyls execution without arguments. The algorithm which arranges
-    results in columns was ported from the original ls source code.
+    List a path and, in recursive mode, the tree below it, in a worker process of Lister._sharded_lines.
+
+    The lines are returned joined in a single string, with an array of their lengths, so that the result is pickled
+    as two buffers rather than one object per line. If the listing fails, the lines up to the error are returned with
+    the exception, so that the parent raises it at the same point of the output as a serial listing.
     """
-    path_strings = [_printable_path_name(base_dir, p) for p in paths]
-    if not CONFIG.use_column_layout:
-        yield from path_strings  # yield one path name per line
-    else:
-        yield from _lines_in_short_format_many_per_line(path_strings)
+    if with_stats:
+        config.stats = Stats()
+    if cache_args is not None:
+        config.cache = ListingCache(*cache_args)
+    lister = Lister(config)
+    if config.list_format and config.preload_names and not lister.name_cache.preloaded:
+        lister.name_cache.preload()
+    stack = _top_level_entries([path], lister._collation_key)
+    lines = lister._traversal_lines(stack, TimestampFormatter(now), lister._new_resolver(), list_multiple_dirs,
+                                    is_first_dir)
+    if config.stats is not None:
+        lines = _with_current_stats(config.stats, lines)
+    collected = []
+    error = None
+    try:
+        collected.extend(lines)
+    except Exception as e:
+        error = e
+    if config.cache is not None:
+        config.cache.evict()
+    counters = config.stats._counters() if config.stats is not None else None
+    return "".join(collected), array.array("q", map(len, collected)), counters, error
 
 
-@dataclasses.dataclass
 class ColumnInfo:
-    num_cols: int
-    col_array: List[int]
-    line_len: int = 0
-    is_valid: bool = True
+    def __init__(self, num_cols: int, col_array: List[int], line_len: int = 0, is_valid: bool = True):
+        self.num_cols = num_cols
+        self.col_array = col_array
+        self.line_len = line_len
+        self.is_valid = is_valid
 
 
 def _lines_in_short_format_many_per_line(path_strings: List[str]) -> Iterable[str]:
@@ -223,6 +1529,7 @@ def _lines_in_short_format_many_per_line(path_strings: List[str]) -> Iterable[st
     It is a direct port of the original print_many_per_line function in the coreutils ls source code,
     available at https://www.gnu.org/software/coreutils/, version 5.0, file src/ls.c lines 3485 - 3562.
     """
+    import shutil  # only needed on a terminal
     terminal_size = shutil.get_terminal_size()
     layout = _get_optimal_column_layout(path_strings, terminal_size)
     num_files = len(path_strings)
@@ -246,117 +1553,991 @@ def _get_optimal_column_layout(path_strings, terminal_size) -> ColumnInfo:
     """
     This function determines the optimal number of columns for the output of the pyls command.
 
-    It is a direct port of the original print_many_per_line function in the coreutils ls source code,
-    available at https://www.gnu.org/software/coreutils/, version 5.0, file src/ls.c lines 3485 - 3562.
+    The result is the same as in the original print_many_per_line function in the coreutils ls source code,
+    available at https://www.gnu.org/software/coreutils/, version 5.0, file src/ls.c lines 3485 - 3562: the layout
+    with the most columns whose total width is less than the terminal width. Rather than updating the layouts for
+    all possible numbers of columns file by file, the number of columns is decreased until the first valid layout is
+    found. The width of each column is the maximum over a slice of the name widths, and a layout is abandoned as soon
+    as its columns exceed the terminal width. Numbers of columns resulting in the same number of rows also result in
+    the same column widths, so those are only checked once.
     """
+    widths = [len(p) + 2 for p in path_strings]
+    num_files = len(widths)
     max_possible_cols = max(1, terminal_size.columns // 3)
-    col_layouts = [ColumnInfo(num_cols=i, col_array=[0] * i) for i in range(1, max_possible_cols)]
-    for p_idx, p in enumerate(path_strings):
-        real_length = len(p) + 2  # (2 if p_idx != 0 else 0)
-        for col, col_layout in enumerate(col_layouts, 1):
-            if not col_layout.is_valid:
+    if num_files == 0:
+        return ColumnInfo(num_cols=max(1, max_possible_cols - 1), col_array=[0] * max(1, max_possible_cols - 1))
+
+    last_invalid_num_rows = None
+    for num_cols in range(max_possible_cols - 1, 0, -1):
+        num_rows = (num_files + num_cols - 1) // num_cols
+        if num_rows == last_invalid_num_rows:
+            continue
+        col_array = [0] * num_cols
+        line_len = 0
+        for col_idx, start in enumerate(range(0, num_files, num_rows)):
+            col_array[col_idx] = max(widths[start:start + num_rows])
+            line_len += col_array[col_idx]
+            if line_len >= terminal_size.columns:
+                last_invalid_num_rows = num_rows
+                break
+        else:
+            return ColumnInfo(num_cols=num_cols, col_array=col_array, line_len=line_len)
+
+    # Even a single column is too wide for the terminal, so print one name per line, as ls does.
+    return ColumnInfo(num_cols=1, col_array=[max(widths)], line_len=max(widths), is_valid=False)
+
+
+def _special_entries(base_dir: Entry) -> List[Entry]:
+    """ Make the entries . and .. of a directory, reusing what is known about the directory and its parent. """
+    if base_dir.parent is not None:
+        dot_dot = base_dir.parent.alias("..", base_dir.path / "..")
+    else:
+        dot_dot = Entry("..", base_dir.path / "..")
+    return [base_dir.alias("."), dot_dot]
+
+
+class DirectoryListing:
+    """
+    The entries of a single directory in the order in which they are shown, stored column by column.
+
+    Rather than keeping an Entry, an os.DirEntry and an lstat result for each of possibly millions of entries, the
+    listing keeps the names in a list and the fields of the long list format in arrays of machine integers. Strings
+    are only created when the rows are formatted. Entries are only kept for the subdirectories, for the recursion.
+    """
+
+    def __init__(self, entries: List[Entry], with_lstat: bool = False, with_subdirs: bool = False,
+                 resolver: Optional["_SymlinkResolver"] = None,
+                 with_totals: bool = False, dir_fd: Optional[int] = None):
+        """
+        Make the listing from the entries, in the given order. The list of entries is consumed: each entry is removed
+        from the list as soon as it is processed, so that its memory can be freed.
+
+        With lstat results, the targets of symlinks are read with a single readlink, as shown by ls, relative to
+        dir_fd if the directory is open, or resolved to the full path by the resolver, if one is given.
+
+        With with_totals, the sizes, blocks and number of files of the entries other than . and .. are added up for
+        _SubtreeTotals. The files with several hard links are not added up, but their device, inode, size and blocks
+        are kept in linked_files, so that _SubtreeTotals counts each of them once, in the order of the output, even if
+        the listings are read on several threads.
+        """
+        self.names: List[str] = []
+        self.subdirs: List[Entry] = []
+        self.modes = array.array("q")
+        self.num_links = array.array("q")
+        self.uids = array.array("q")
+        self.gids = array.array("q")
+        self.sizes = array.array("q")
+        self.mtimes_ns = array.array("q")
+        self.num_blocks = 0
+        self.link_targets: Dict[int, str] = {}  # the targets of the symlinks, by index
+        self.total_size = 0
+        self.total_blocks = 0
+        self.num_files = 0
+        self.linked_files: List[Tuple[int, int, int, int]] = []
+        for i, e in enumerate(entries):
+            entries[i] = None
+            self.names.append(e.name)
+            if with_subdirs and e.name not in (".", "..") and e.is_dir():
+                self.subdirs.append(e)
+            if with_totals and e.name not in (".", ".."):
+                self._add_to_totals(e.lstat())
+            if with_lstat:
+                lstat = e.lstat()
+                self.modes.append(lstat.st_mode)
+                self.num_links.append(lstat.st_nlink)
+                self.uids.append(lstat.st_uid)
+                self.gids.append(lstat.st_gid)
+                self.sizes.append(lstat.st_size)
+                self.mtimes_ns.append(lstat.st_mtime_ns)
+                self.num_blocks += lstat.st_blocks
+                if stat.S_ISLNK(lstat.st_mode):
+                    # The type is known from the lstat result, which usually comes with the entry from the scan.
+                    stats = _CURRENT_STATS.get()
+                    if stats is not None:
+                        stats.enter("resolve")
+                    calls = 1
+                    try:
+                        if resolver is None:
+                            self.link_targets[i] = (os.readlink(e.path) if dir_fd is None
+                                                    else os.readlink(e.name, dir_fd=dir_fd))
+                        else:
+                            self.link_targets[i], calls = resolver.resolve(str(e.path))
+                    finally:
+                        if stats is not None:
+                            stats.exit(calls=calls)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _add_to_totals(self, lstat: os.stat_result):
+        is_dir = stat.S_ISDIR(lstat.st_mode)
+        if lstat.st_nlink > 1 and not is_dir:
+            self.linked_files.append((lstat.st_dev, lstat.st_ino, lstat.st_size, lstat.st_blocks))
+            return
+        self.total_size += lstat.st_size
+        self.total_blocks += lstat.st_blocks
+        if not is_dir:
+            self.num_files += 1
+
+
+class _SubtreeTotals:
+    """
+    The total size, number of 512-byte blocks and number of files, i.e. entries other than directories, of a
+    directory and the tree below it, which are added up while the tree is listed. Like the listing, they leave out
+    hidden entries unless show_all is set, and the entries which are excluded by patterns. pending is the number of
+    subdirectories whose trees are not complete yet. Only the totals of the directories whose trees are incomplete,
+    i.e. the listed ancestors of the directories on the traversal stack, are kept.
+    """
+    __slots__ = ("base_dir", "parent", "hard_links", "size", "blocks", "files", "pending", "_own_size", "_own_blocks")
+
+    def __init__(self, base_dir: Entry, parent: Optional["_SubtreeTotals"],
+                 hard_links: Set[Tuple[int, int]]):
+        self.base_dir = base_dir
+        self.parent = parent
+        self.hard_links = hard_links
+        # Count the directory itself. Its lstat result is usually cached, since its parent counted it as an entry.
+        lstat = base_dir.lstat()
+        self._own_size = self.size = lstat.st_size
+        self._own_blocks = self.blocks = lstat.st_blocks
+        self.files = 0
+        self.pending = 0
+
+    def add_listing(self, listing: DirectoryListing):
+        self.size += listing.total_size
+        self.blocks += listing.total_blocks
+        self.files += listing.num_files
+        for dev, ino, size, blocks in listing.linked_files:
+            if (dev, ino) not in self.hard_links:
+                self.hard_links.add((dev, ino))
+                self.size += size
+                self.blocks += blocks
+                self.files += 1
+
+    def add_subtree(self, other: "_SubtreeTotals"):
+        """ Add the totals of a complete subtree, whose directory is counted among the entries of this one already. """
+        self.size += other.size - other._own_size
+        self.blocks += other.blocks - other._own_blocks
+        self.files += other.files
+        self.pending -= 1
+
+
+class _SymlinkResolver:
+    """
+    Resolves paths to their real paths like os.path.realpath, caching the resolved path of every prefix of the paths
+    it resolves. Links of a tree often point into the same few directories, so the prefixes which they share are only
+    resolved once, rather than with an lstat of every component of each target.
+
+    The cache is not invalidated, so a resolver should only be used for a single listing. Symlink loops are not
+    detected as such: after following MAX_LINKS links, the next link is not followed.
+    """
+
+    MAX_LINKS = 40  # like the limit of the Linux kernel
+
+    def __init__(self):
+        self._resolved: Dict[str, str] = {}  # maps paths whose parent is a real path to their real path
+
+    def resolve(self, path: str) -> Tuple[str, int]:
+        """ Return the real path of path, and the number of readlink calls it took. """
+        calls = [0]
+        resolved = self._join("/" if os.path.isabs(path) else os.getcwd(), path, calls, 0)
+        return resolved, calls[0]
+
+    def _join(self, resolved: str, rest: str, calls: List[int], num_links: int) -> str:
+        """ Resolve the path rest, if it is relative, within the real path resolved. """
+        if os.path.isabs(rest):
+            resolved = "/"
+        for name in rest.split("/"):
+            if not name or name == ".":
                 continue
-            idx = p_idx // ((len(path_strings) + col - 1) // (col))
-            if real_length > col_layout.col_array[idx]:
-                col_layout.line_len += real_length - col_layout.col_array[idx]
-                col_layout.col_array[idx] = real_length
-                col_layout.is_valid = col_layout.line_len < terminal_size.columns
-    valid_col = col_layouts[-1]
-    for c in reversed(col_layouts):
-        if c.is_valid:
-            valid_col = c
-            break
-    return valid_col
+            if name == "..":
+                resolved = os.path.dirname(resolved)
+                continue
+            path = os.path.join(resolved, name)
+            real_path = self._resolved.get(path)
+            if real_path is None:
+                calls[0] += 1
+                try:
+                    target = os.readlink(path)
+                except OSError:
+                    real_path = path  # not a symlink, or does not exist
+                else:
+                    if num_links < self.MAX_LINKS:
+                        real_path = self._join(resolved, target, calls, num_links + 1)
+                    else:
+                        real_path = path
+                self._resolved[path] = real_path
+            resolved = real_path
+        return resolved
+
+
+class _DirectoryFds:
+    """
+    Opens the directories of a traversal relative to the descriptors of their parents, see Config.fd_relative.
+
+    The kernel then only looks up a single name to open a directory or to lstat an entry, rather than walking its
+    whole path, which costs more the deeper the tree, and fails for paths longer than PATH_MAX. Paths are still
+    joined for the headers, but never passed to the kernel.
+
+    The descriptor of a directory is held after it is read, until all of its subdirectories which are entered are
+    opened. At most max_open descriptors are open at once, counting both the held ones and those of the directories
+    which are being read, e.g. by the threads of --jobs. A read waits for a free descriptor, and a descriptor is only
+    held if another one is left free for the next read, so that the held descriptors never block the reads which
+    release them. Otherwise, the descriptor is closed right away, and the subdirectories are opened by their paths.
+    Since the os.DirEntry objects of the subdirectories stat relative to the descriptor of their parent, their lstat
+    results are fetched before it is closed. A directory's own lstat result is taken from its descriptor when it is
+    opened.
+    """
+
+    _FLAGS = os.O_RDONLY | getattr(os, "O_DIRECTORY", 0) | getattr(os, "O_CLOEXEC", 0)
+
+    def __init__(self, max_open: int = 64):
+        self._max_open = max_open
+        # The held descriptors, by the id of the entry of their directory, with the number of its subdirectories
+        # which are not opened yet
+        self._held: Dict[int, List[int]] = {}
+        self._reading = 0  # the number of descriptors which are opened and not released yet
+        import threading
+        self._condition = threading.Condition()
+
+    def __enter__(self) -> "_DirectoryFds":
+        return self
+
+    def __exit__(self, *exc_info):
+        """ Close the descriptors which are still held, e.g. if the traversal was stopped early. """
+        with self._condition:
+            for fd, _ in self._held.values():
+                os.close(fd)
+            self._held.clear()
+            self._condition.notify_all()
+
+    def open(self, base_dir: Entry) -> int:
+        """ Open the directory of the entry. The caller passes the descriptor to release when it is done with it. """
+        with self._condition:
+            while len(self._held) + self._reading >= self._max_open:
+                self._condition.wait()
+            self._reading += 1
+            held = self._held.get(id(base_dir.parent)) if base_dir.parent is not None else None
+        try:
+            if held is None:
+                fd = os.open(base_dir.path, self._FLAGS)
+            else:
+                # The parent's descriptor is not closed before this subdirectory is counted as opened, below.
+                try:
+                    fd = os.open(base_dir.name, self._FLAGS | os.O_NOFOLLOW, dir_fd=held[0])
+                finally:
+                    self._opened_subdir(base_dir.parent)
+        except BaseException:
+            self._stop_reading()
+            raise
+        if base_dir.dir_entry is not None and base_dir._lstat is None:
+            base_dir._lstat = os.fstat(fd)  # the same as its lstat, since subdirectories are not symlinks
+        return fd
+
+    def release(self, base_dir: Entry, fd: int, subdirs: List[Entry]):
+        """ Hold the descriptor of the directory until the given subdirectories are opened, or close it. """
+        with self._condition:
+            # Holding the descriptor keeps its slot, which must leave one free for the reads of the subdirectories.
+            if subdirs and len(self._held) + self._reading < self._max_open:
+                self._held[id(base_dir)] = [fd, len(subdirs)]
+                self._reading -= 1
+                return
+        try:
+            for e in subdirs:
+                e.lstat()
+        finally:
+            os.close(fd)
+            self._stop_reading()
+
+    def _stop_reading(self):
+        with self._condition:
+            self._reading -= 1
+            self._condition.notify_all()
+
+    def _opened_subdir(self, parent: Entry):
+        with self._condition:
+            held = self._held[id(parent)]
+            held[1] -= 1
+            if held[1] == 0:
+                del self._held[id(parent)]
+                os.close(held[0])
+                self._condition.notify_all()
+
+
+class _DirectoryReader:
+    """
+    Reads the entries of directories with the given function, optionally ahead of time on a pool of threads.
+
+    With a single job, directories are read on demand. With more jobs, the directories which will be popped next from
+    the traversal stack are submitted to a thread pool, so that waiting for slow file systems overlaps with formatting
+    the output. Since the output is still produced by popping from the same stack, the order of the output does not
+    depend on the number of jobs. At most max_prefetch directories are read ahead, which bounds the memory used by
+    entries that are not yet needed.
+    """
+
+    def __init__(self, read_dir_listing: Callable[[Entry], DirectoryListing], jobs: int = 1,
+                 max_prefetch: Optional[int] = None):
+        self._read_dir_listing = read_dir_listing
+        self._executor = None
+        if jobs > 1:
+            import concurrent.futures
+            self._executor = concurrent.futures.ThreadPoolExecutor(jobs)
+        self._max_prefetch = max_prefetch if max_prefetch is not None else 4 * jobs
+        self._pending: Dict[int, "concurrent.futures.Future"] = {}  # keyed by the id of the Entry on the stack
+
+    def __enter__(self) -> "_DirectoryReader":
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._executor is not None:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+            self._executor.shutdown(wait=True)
+
+    def prefetch(self, stack: List[Entry]):
+        """ Submit the directories at the top of the stack, until max_prefetch directories are read ahead. """
+        if self._executor is None:
+            return
+        for e in reversed(stack):
+            if len(self._pending) >= self._max_prefetch:
+                break
+            if id(e) not in self._pending:
+                # Run in a copy of the current context, so that the current Stats object is used on the thread as well.
+                self._pending[id(e)] = self._executor.submit(contextvars.copy_context().run, self._read_dir_listing, e)
+
+    def read(self, base_dir: Entry) -> DirectoryListing:
+        """ Return the listing of the directory, waiting for the prefetched result if there is one. """
+        future = self._pending.pop(id(base_dir), None)
+        if future is None:
+            return self._read_dir_listing(base_dir)
+        return future.result()
 
 
-def _printable_path_name(base_dir: pathlib.Path, p: pathlib.Path) -> str:
+class ListingCache:
     """
-    Converts the path object to the name that should be shown in the ls output. The base_dir is required to check
-    for the special directories . and ..
+    An on-disk cache of the contents of directories, for repeated listings of trees which rarely change.
+
+    For each directory, the names of its entries and the fields of their lstat results are stored together with the
+    device, inode, modification time and change time of the directory. Adding, removing or renaming an entry changes
+    the modification time of the directory, so as long as this key is unchanged, the directory is read from the cache
+    with a single stat instead of reading the directory and calling lstat for each entry. Changes to the entries
+    themselves, e.g. a file which grew, do not change the directory and are not detected, so the cache is only meant
+    for trees whose files are mostly static. Since the lstat results are stored, populating the cache calls lstat for
+    each entry, even if the output does not need it.
+
+    Each directory is stored in a file named after its device and inode, so a changed directory replaces its outdated
+    file. The file consists of a header, one fixed size record per entry, and the names of the entries separated by
+    null bytes. Reading a file from the cache updates its modification time, and when the files of the cache exceed
+    max_bytes, the least recently used ones are removed. Errors while reading or writing the cache are ignored, the
+    directory is then read from the file system.
     """
-    name = p.name
-    # The main reason for this function is the formatting of the . and .. dirs:
-    if p == base_dir:
-        name = "."
-    elif p == base_dir.parent:
-        name = ".."
-    return name
 
+    _HEADER = struct.Struct("<4sQQqqII")  # magic, device, inode, mtime_ns, ctime_ns, number of entries, names size
+    # mode, number of links, uid, gid, size, mtime_ns, number of blocks, device, inode
+    _RECORD = struct.Struct("<IQIIqqqQQ")
+    _MAGIC = b"PYL3"
+    # Directories modified within the resolution of the file system timestamps before they were read could change
+    # again without changing the key, so directories modified this recently are not stored.
+    _RECENTLY_MODIFIED_NS = 2 * 10 ** 9
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: int = 64 * 2 ** 20):
+        if cache_dir is None:
+            cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "pyls")
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._stored = False
+        import threading
+        self._lock = threading.Lock()
+
+    def scan_dir(self, path: pathlib.Path) -> List[Entry]:
+        """ Return the entries of the directory like _scan_dir, reading them from the cache if it is up to date. """
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_ctime_ns)
+        cache_file = self.cache_dir / f"{st.st_dev:x}-{st.st_ino:x}"
+        entries = self._load(cache_file, key, path)
+        with self._lock:
+            if entries is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entries is None:
+            entries = _scan_dir(path)
+            if time.time_ns() - st.st_mtime_ns >= self._RECENTLY_MODIFIED_NS:
+                self._store(cache_file, key, entries)
+        return entries
+
+    def _load(self, cache_file: pathlib.Path, key: Tuple[int, int, int, int],
+              path: pathlib.Path) -> Optional[List[Entry]]:
+        try:
+            with open(cache_file, "rb") as f:
+                data = f.read()
+            magic, *file_key, num_entries, names_size = self._HEADER.unpack_from(data)
+            if magic != self._MAGIC or tuple(file_key) != key:
+                return None
+            records_end = self._HEADER.size + num_entries * self._RECORD.size
+            if len(data) != records_end + names_size:
+                return None
+            records = self._RECORD.iter_unpack(data[self._HEADER.size:records_end])
+            names = data[records_end:].split(b"\0") if num_entries else []
+            if len(names) != num_entries:
+                return None
+            entries = []
+            for name, (mode, nlink, uid, gid, size, mtime_ns, blocks, dev, ino) in zip(names, records):
+                e = Entry(os.fsdecode(name), dir_path=path)
+                e._lstat = os.stat_result((mode, ino, dev, nlink, uid, gid, size, 0, mtime_ns // 10 ** 9, 0),
+                                          {"st_mtime": mtime_ns / 1e9, "st_mtime_ns": mtime_ns, "st_blocks": blocks})
+                entries.append(e)
+            os.utime(cache_file)  # mark the file as recently used
+            return entries
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def _store(self, cache_file: pathlib.Path, key: Tuple[int, int, int, int], entries: List[Entry]):
+        try:
+            records = []
+            for e in entries:
+                lstat = e.lstat()
+                records.append(self._RECORD.pack(lstat.st_mode, lstat.st_nlink, lstat.st_uid, lstat.st_gid,
+                                                 lstat.st_size, lstat.st_mtime_ns, lstat.st_blocks, lstat.st_dev,
+                                                 lstat.st_ino))
+            names = b"\0".join(os.fsencode(e.name) for e in entries)
+            data = b"".join((self._HEADER.pack(self._MAGIC, *key, len(entries), len(names)), *records, names))
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first, so that concurrent runs never read a partially written file.
+            import threading
+            temp_file = cache_file.with_name(f".{cache_file.name}.{os.getpid()}.{threading.get_ident()}")
+            with open(temp_file, "wb") as f:
+                f.write(data)
+            os.replace(temp_file, cache_file)
+            self._stored = True
+        except OSError:
+            pass
+
+    def evict(self):
+        """ Remove the least recently used files until the cache is at most max_bytes large. """
+        if not self._stored:
+            return
+        self._stored = False
+        try:
+            files = []
+            with os.scandir(self.cache_dir) as it:
+                for d in it:
+                    st = d.stat(follow_symlinks=False)
+                    files.append((st.st_mtime_ns, st.st_size, d.path))
+            total_size = sum(size for _, size, _ in files)
+            for _, size, file_path in sorted(files):
+                if total_size <= self.max_bytes:
+                    break
+                os.unlink(file_path)
+                total_size -= size
+        except OSError:
+            pass
+
+
+class PageIndexCache:
+    """
+    Keeps the sorted names of recently paged directories in memory, for Lister.list_page.
 
-def _last_modified_time_str(lstat) -> str:
+    Each index is stored with the device, inode, modification time and change time of its directory, like the
+    directories of the ListingCache, and it is only used while this key is unchanged. Only the max_directories most
+    recently used indexes are kept. As with the ListingCache, changes to the entries themselves, such as a file which
+    grew, do not invalidate an index, so with sort_by_size, pages may be out of date.
     """
-    Get the string representing the time of the last modification.
 
-    For files modified within the past 6 months, a date format indicating the day, month and daytime is used.
-    For files older than 6 months, a different date format indicating the day, month and year is used.
+    def __init__(self, max_directories: int = 64):
+        self.max_directories = max_directories
+        self.hits = 0
+        self.misses = 0
+        self._indexes: Dict[Tuple[str, Any], Tuple[Tuple[int, int, int, int], List[str], List[Any]]] = {}
+        import threading
+        self._lock = threading.Lock()
+
+    def get(self, path: str, options: Any, key: Tuple[int, int, int, int]) -> Optional[Tuple[List[str], List[Any]]]:
+        """ Return the names and sort keys of the directory, if its index is stored with the given key. """
+        with self._lock:
+            index = self._indexes.pop((path, options), None)
+            if index is None or index[0] != key:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._indexes[(path, options)] = index  # move it to the end, as the most recently used one
+            return index[1], index[2]
+
+    def put(self, path: str, options: Any, key: Tuple[int, int, int, int], names: List[str], sort_keys: List[Any]):
+        """ Store the names and sort keys of the directory, removing the least recently used index if needed. """
+        with self._lock:
+            self._indexes.pop((path, options), None)
+            self._indexes[(path, options)] = (key, names, sort_keys)
+            while len(self._indexes) > self.max_directories:
+                del self._indexes[next(iter(self._indexes))]
+
+
+def _encode_page_cursor(size: int, name: str) -> str:
+    """ Make the opaque cursor of the entry with the given size and name, which ends a page. """
+    import base64
+    return base64.urlsafe_b64encode(b"%d/" % size + os.fsencode(name)).decode("ascii")
+
+
+def _decode_page_cursor(cursor: str) -> Tuple[int, str]:
+    """ Return the size and name of the entry of a cursor made by _encode_page_cursor. """
+    import base64
+    import binascii
+    try:
+        size, _, name = base64.urlsafe_b64decode(cursor.encode("ascii")).partition(b"/")
+        return int(size), os.fsdecode(name)
+    except (UnicodeError, binascii.Error, ValueError):
+        raise ValueError(f"invalid cursor {cursor!r}") from None
+
+
+class _Inotify:
+    """ A minimal wrapper of the Linux inotify API, which is not part of the standard library, using ctypes. """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_EXCL_UNLINK = 0x04000000
+
+    _EVENT = struct.Struct("iIII")  # struct inotify_event without the name: wd, mask, cookie, length of the name
+
+    def __init__(self):
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("--watch requires inotify, which is only available on Linux")
+        self._libc = libc
+        self._fd = self._check(libc.inotify_init1(os.O_CLOEXEC))
+
+    def __enter__(self) -> "_Inotify":
+        return self
+
+    def __exit__(self, *exc_info):
+        os.close(self._fd)
+
+    def add_watch(self, path: pathlib.Path, mask: int) -> int:
+        """ Watch the directory at path for the events in mask, and return the watch descriptor. """
+        return self._check(self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask), path)
+
+    def remove_watch(self, wd: int):
+        """ Stop watching, which is reported by an IN_IGNORED event. Watches which are gone already are ignored. """
+        self._libc.inotify_rm_watch(self._fd, wd)
+
+    def read_events(self, timeout: Optional[float] = None) -> List[Tuple[int, int, str]]:
+        """ Wait at most timeout seconds for events, and return them as tuples (watch descriptor, mask, name). """
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self._fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + name_length].rstrip(b"\0")
+            offset += name_length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    @staticmethod
+    def _check(result: int, path: Optional[pathlib.Path] = None) -> int:
+        if result < 0:
+            import ctypes
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), *([str(path)] if path is not None else []))
+        return result
+
+
+class _WatchedDirectory:
     """
-    last_modified = datetime.datetime.fromtimestamp(lstat.st_mtime)
-    # The constant 31556952 is used in the ls source code, available at https://www.gnu.org/software/coreutils/.
-    # It roughly represents the number of seconds in a Gregorian year.
-    six_months_in_seconds = 31556952 // 2
-    if (datetime.datetime.now() - last_modified) < datetime.timedelta(seconds=six_months_in_seconds):
-        date_format = "%b %e %H:%M"
-    else:
-        date_format = "%b %e  %Y"
-    return last_modified.strftime(date_format)
+    The entries of a directory listed in watch mode, in the order of the output.
+
+    The sort key of each entry is kept next to it, so that a changed entry is removed and inserted again with a binary
+    search, rather than sorting the whole directory again. The lstat results of the unchanged entries are kept as
+    well, so formatting the directory again does not call lstat for them.
+    """
+
+    def __init__(self, base_dir: Entry, entries: List[Entry], wd: int, seq: int, lister: "Lister"):
+        self.base_dir = base_dir
+        self.wd = wd
+        self.seq = seq  # the position of the directory in the output, for listing changed directories in order
+        self._lister = lister
+        self.entries = entries
+        self.keys = [lister._sort_key(e) for e in entries]
+        self.by_name = {e.name: e for e in entries}
+
+    def remove(self, name: str) -> Optional[Entry]:
+        """ Remove the entry with the given name, if there is one, and return it. """
+        e = self.by_name.pop(name, None)
+        if e is None:
+            return None
+        i = bisect.bisect_left(self.keys, self._lister._sort_key(e))
+        while self.entries[i] is not e:  # skip other entries with an equal key
+            i += 1
+        del self.entries[i]
+        del self.keys[i]
+        return e
+
+    def insert(self, e: Entry):
+        """ Insert the entry at its position in the sort order. """
+        if e.collation_key is None:
+            e.collation_key = self._lister._collation_key(e.name)
+        key = self._lister._sort_key(e)
+        i = bisect.bisect_right(self.keys, key)
+        self.entries.insert(i, e)
+        self.keys.insert(i, key)
+        self.by_name[e.name] = e
+
+    def subdirs(self) -> List[Entry]:
+        return [e for e in self.entries if e.name not in (".", "..") and e.is_dir()]
+
+    def listing(self, with_lstat: bool, resolver: Optional["_SymlinkResolver"]) -> DirectoryListing:
+        return DirectoryListing(list(self.entries), with_lstat=with_lstat, resolver=resolver)
+
+
+class _DirectoryWatcher:
+    """
+    Keeps the entries of the listed directories up to date with the changes reported by inotify.
 
+    Every event for a name in a watched directory is handled the same way: the entry of that name is removed, and if
+    the name still exists, a new entry is inserted with a fresh lstat result. Events are collected until there are
+    none for _BATCH_SECONDS, so that e.g. a burst of files written to a spool directory results in a single listing.
+    """
 
-def _iter_single_dir_children(path: pathlib.Path) -> Iterable[pathlib.Path]:
+    _BATCH_SECONDS = 0.1
+
+    def __init__(self, inotify: _Inotify, lister: "Lister"):
+        self._inotify = inotify
+        self._lister = lister
+        self._config = lister.config
+        self._mask = (_Inotify.IN_CREATE | _Inotify.IN_DELETE | _Inotify.IN_MOVED_FROM | _Inotify.IN_MOVED_TO |
+                      _Inotify.IN_DELETE_SELF | _Inotify.IN_MOVE_SELF | _Inotify.IN_ONLYDIR | _Inotify.IN_EXCL_UNLINK)
+        if self._config.list_format or self._config.sort_by_size:
+            # The sizes, times and permissions of the entries are shown or determine their order.
+            self._mask |= _Inotify.IN_ATTRIB | _Inotify.IN_MODIFY
+        self._by_wd: Dict[int, _WatchedDirectory] = {}
+        self._by_path: Dict[pathlib.Path, _WatchedDirectory] = {}
+        self._next_seq = 0
+
+    def has_watches(self) -> bool:
+        return bool(self._by_wd)
+
+    def add(self, stack: List[Entry]) -> List[_WatchedDirectory]:
+        """
+        Watch and read the directories on the stack and, in recursive mode, their subdirectories. The directories are
+        returned in the order of the output.
+        """
+        added = []
+        while stack:
+            base_dir = stack.pop()
+            # Watch the directory before reading it, so that no change after reading it is missed.
+            wd = self._inotify.add_watch(base_dir.path, self._mask)
+            entries = list(self._lister._iter_single_dir_children(base_dir))
+            d = _WatchedDirectory(base_dir, entries, wd, self._next_seq, self._lister)
+            self._next_seq += 1
+            self._by_wd[wd] = d
+            self._by_path[base_dir.path] = d
+            if self._config.recursive:
+                self._lister._populate_stack_for_recursive_execution(base_dir, d.subdirs(), stack)
+            added.append(d)
+        return added
+
+    def wait_for_changes(self) -> List[_WatchedDirectory]:
+        """ Wait for changes, update the entries, and return the changed directories in the order of the output. """
+        events = self._inotify.read_events()
+        while True:
+            more_events = self._inotify.read_events(self._BATCH_SECONDS)
+            if not more_events:
+                break
+            events.extend(more_events)
+
+        changed_names: Dict[int, Set[str]] = {}
+        for wd, mask, name in events:
+            if mask & _Inotify.IN_Q_OVERFLOW:
+                # Events were lost, so check every name of every directory.
+                for d in self._by_wd.values():
+                    try:
+                        changed_names.setdefault(d.wd, set()).update(d.by_name, os.listdir(d.base_dir.path))
+                    except OSError:
+                        pass
+            elif mask & _Inotify.IN_IGNORED:
+                self._forget(self._by_wd.get(wd))
+            elif mask & _Inotify.IN_MOVE_SELF:
+                # Unlike a removed directory, a moved one keeps its watch, whose changes would still be listed under
+                # the old path. If it was moved within the listed tree, the IN_MOVED_TO event of its new parent, which
+                # is handled below, watches it again under its new path.
+                d = self._by_wd.get(wd)
+                if d is not None and not self._is_at_its_path(d):
+                    self._forget(d)
+            elif name:
+                changed_names.setdefault(wd, set()).add(name)
+
+        changed: Dict[int, _WatchedDirectory] = {}
+        new_subdirs: List[Entry] = []
+        for wd, names in changed_names.items():
+            d = self._by_wd.get(wd)
+            if d is None:
+                continue
+            visible_changes = [self._update(d, name, new_subdirs) for name in names]
+            if not any(visible_changes):
+                continue
+            changed[d.seq] = d
+            if self._config.show_all:
+                for e in _special_entries(Entry(d.base_dir.name, d.base_dir.path)):
+                    d.remove(e.name)
+                    d.insert(e)
+            parent = self._by_path.get(d.base_dir.parent.path) if d.base_dir.parent is not None else None
+            if parent is not None and (self._config.list_format or self._config.sort_by_size):
+                # The directory itself changed, e.g. its modification time, so update its entry in the parent.
+                self._update(parent, d.base_dir.name, new_subdirs)
+                changed[parent.seq] = parent
+        for d in self.add(new_subdirs):
+            changed[d.seq] = d
+        return [changed[seq] for seq in sorted(changed)]
+
+    def _update(self, d: _WatchedDirectory, name: str, new_subdirs: List[Entry]) -> bool:
+        """
+        Update the entry with the given name in the directory d. New subdirectories to watch are added to new_subdirs.
+        Returns whether the entry is shown in the output.
+        """
+        if self._lister._is_excluded_name(name):
+            return False
+        old = d.remove(name)
+        new = Entry(name, dir_path=d.base_dir.path)
+        try:
+            new.lstat()
+        except OSError:
+            new = None
+        if new is not None:
+            d.insert(new)
+
+        if old is not None and old.is_dir():
+            subdir = self._by_path.get(old.path)
+            is_same_dir = new is not None and subdir is not None and _same_file(subdir.base_dir.lstat(), new.lstat())
+            if not is_same_dir:
+                self._forget(subdir)
+        if new is not None and new.is_dir() and new.path not in self._by_path and self._config.recursive:
+            self._lister._populate_stack_for_recursive_execution(d.base_dir, [new], new_subdirs)
+            new.parent = Entry(d.base_dir.name, d.base_dir.path)  # the entry .. with a fresh lstat result
+        return True
+
+    @staticmethod
+    def _is_at_its_path(d: _WatchedDirectory) -> bool:
+        """ Determine if the path of the directory d still refers to it, rather than to nothing or another file. """
+        try:
+            return _same_file(os.lstat(d.base_dir.path), d.base_dir.lstat())
+        except OSError:
+            return False
+
+    def _forget(self, d: Optional[_WatchedDirectory]):
+        """ Stop watching the directory d and its subdirectories. """
+        if d is None:
+            return
+        for path in [p for p in self._by_path if p == d.base_dir.path or d.base_dir.path in p.parents]:
+            subdir = self._by_path.pop(path)
+            self._by_wd.pop(subdir.wd, None)
+            self._inotify.remove_watch(subdir.wd)
+
+
+def _same_file(a: os.stat_result, b: os.stat_result) -> bool:
+    return (a.st_dev, a.st_ino) == (b.st_dev, b.st_ino)
+
+
+def _collecting_subdirs(entries: Iterable[Entry], subdirs: List[Entry]) -> Iterator[Entry]:
+    """ Iterate over the entries, appending the subdirectories among them, except for . and .., to subdirs. """
+    for e in entries:
+        if e.name not in (".", "..") and e.is_dir():
+            subdirs.append(e)
+        yield e
+
+
+def _scan_dir(path: pathlib.Path, excluded_name: Optional[Callable[[str], Any]] = None,
+              dir_fd: Optional[int] = None) -> List[Entry]:
     """
-    Iterate over the children of a directory in sorted order.
+    Read the contents of a directory with a single pass of os.scandir. The type information returned by the
+    directory read is kept in the entries, so no further system calls are made at this point.
+    """
+    return list(_iter_scandir(path, excluded_name, dir_fd))
+
 
-    Compared to calling path.iterdir(), this function:
+def _iter_scandir(path: pathlib.Path, excluded_name: Optional[Callable[[str], Any]] = None,
+                  dir_fd: Optional[int] = None) -> Iterable[Entry]:
+    """
+    Iterate over the entries returned by os.scandir, without reading the whole directory up front. Names for which
+    excluded_name returns a true value are skipped before an entry is made for them.
 
-      1. Returns the paths in sorted order depending on the CONFIG.sort_by_size parameter
-      2. Includes the special paths . and .., which are not returned by pathlib.Path.iterdir
+    If dir_fd is given, the directory is read from this open descriptor instead of its path. The os.DirEntry objects
+    then stat the entries relative to the descriptor, so it must stay open while their lstat results are fetched.
     """
-    children = list(path.iterdir())
-    if CONFIG.show_all:
-        if CONFIG.sort_by_size:
-            # In size-sorted output, . and .. are sorted together with the other paths
-            children.append(path)
-            children.append(path / "..")
+    stats = _CURRENT_STATS.get()
+    if stats is not None:
+        stats.count("readdir")
+    with os.scandir(path if dir_fd is None else dir_fd) as it:
+        for d in (it if stats is None else _timed(stats, "readdir", it)):
+            if excluded_name is not None and excluded_name(d.name):
+                continue
+            yield Entry(d.name, dir_entry=d, dir_path=path)
+
+
+def _excluded_name_matcher(show_all: bool, hide_patterns: List[str],
+                           ignore_patterns: List[str]) -> Optional[Callable[[str], Any]]:
+    """
+    Return a function which returns a match object for the names of entries which are not listed, like ls: names
+    which match one of the ignore_patterns, and unless show_all is set, hidden names and names which match one of the
+    hide_patterns. The patterns are compiled into a single regular expression, so each name is checked with a single
+    call. Return None if no names are excluded.
+    """
+    alternatives = [_shell_pattern_regex(p) for p in ignore_patterns]
+    if not show_all:
+        alternatives.append(r"\.")
+        alternatives.extend(_shell_pattern_regex(p) for p in hide_patterns)
+    if not alternatives:
+        return None
+    import re
+    return re.compile("|".join(f"(?:{a})" for a in alternatives), re.DOTALL).match
+
+
+def _shell_pattern_regex(pattern: str) -> str:
+    """
+    Translate a shell pattern into a regular expression which matches whole names, like fnmatch(3) with the
+    FNM_PERIOD flag, as used by ls: a leading period of a name is only matched by a period in the pattern. Unlike
+    fnmatch.translate, a backslash quotes the next character. Character classes such as [[:digit:]] are not supported.
+    """
+    import re
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            parts.append(".*")
+        elif c == "?":
+            parts.append(".")
+        elif c == "\\":
+            if i == len(pattern):
+                return r"(?!)"  # like in fnmatch, a trailing backslash matches nothing
+            parts.append(re.escape(pattern[i]))
+            i += 1
+        elif c == "[":
+            bracket = _bracket_expression_regex(pattern, i)
+            if bracket is None:
+                parts.append(re.escape(c))  # an unmatched [ is an ordinary character
+                continue
+            regex, i = bracket
+            parts.append(regex)
         else:
-            # In name-sorted output, . and .. should always be yielded first
-            yield path
-            yield path / ".."
-    for p in sorted(children, key=_sort_key):
-        if _is_hidden_path(p):
-            continue
-        yield p
-
-
-def _populate_stack_for_recursive_execution(base_dir: pathlib.Path,
-                                            stack: List[pathlib.Path]):
-    if base_dir.is_symlink():
-        return  # don't enter symlinks
-    if _is_hidden_path(base_dir):
-        return
-    children = sorted(base_dir.iterdir(), key=_sort_key, reverse=True)
-    for c in children:
-        if c.is_dir() and not c.is_symlink() and not _is_hidden_path(c):
-            stack.append(c)
+            parts.append(re.escape(c))
+    regex = "".join(parts) + r"\Z"
+    if not pattern.startswith((".", "\\.")):
+        regex = r"(?!\.)" + regex
+    return regex
 
 
-def _is_hidden_path(p: pathlib.Path) -> bool:
-    """ Determine if the path should be excluded from the pyls output. """
-    return not CONFIG.show_all and p.name.startswith(".")
+def _bracket_expression_regex(pattern: str, i: int) -> Optional[Tuple[str, int]]:
+    """
+    Translate the bracket expression of a shell pattern whose [ is right before pattern[i] into a regular expression.
+    Return it with the index after the closing ], or None if the set is not closed. A backslash quotes the next
+    character inside the set too, a - at either end is an ordinary character, and a reversed range matches nothing.
+    """
+    import re
+    negate = pattern[i:i + 1] in ("!", "^")
+    if negate:
+        i += 1
+    # The characters of the set, and whether each one is an unquoted -.
+    chars: List[Tuple[str, bool]] = []
+    while True:
+        if i == len(pattern):
+            return None
+        c = pattern[i]
+        i += 1
+        if c == "]" and chars:  # a ] right after the [ or its negation is an ordinary character
+            break
+        if c == "\\":
+            if i == len(pattern):
+                return r"(?!)", i  # like in fnmatch, a trailing backslash matches nothing
+            chars.append((pattern[i], False))
+            i += 1
+        else:
+            chars.append((c, c == "-"))
+    members = []
+    k = 0
+    while k < len(chars):
+        first = chars[k][0]
+        if k + 2 < len(chars) and chars[k + 1][1]:
+            last = chars[k + 2][0]
+            if first <= last:
+                members.append(f"{re.escape(first)}-{re.escape(last)}")
+            k += 3
+        else:
+            members.append(re.escape(first))
+            k += 1
+    if not members:
+        return ("." if negate else r"(?!)"), i
+    body = "".join(members)
+    return (f"[^{body}]" if negate else f"[{body}]"), i
 
 
-def _sort_key(path: pathlib.Path) -> Any:
+def _top_level_entries(paths: List[str], collation_key: Callable[[str], Any]) -> List[Entry]:
+    """ Make the entries for the path arguments. These are sorted by the full path, rather than just the name. """
+    entries = []
+    for p in paths:
+        path = pathlib.Path(p)
+        e = Entry(path.name, path)
+        e.collation_key = collation_key(str(path))
+        entries.append(e)
+    return entries
+
+
+def _collation_key_function() -> Callable[[str], Any]:
     """
-    The sorting key used throughout the program. Depending on the CONFIG.sort_by_size parameter, the key is a string
-    representing the path name, or a tuple of an integer containing the negative size of the path and the name key in
-    order to resolve ties.
+    Return the function which maps names to keys in the collation order of the current locale. In the C locale,
+    names are compared byte by byte, so the comparatively expensive locale.strxfrm can be skipped.
     """
-    path_name_key = locale.strxfrm(str(path))
-    if CONFIG.sort_by_size:
-        # use the negative size, as largest files should be printed first
-        # make a tuple with the name key as the second element to resolve ties.
-        return (-path.lstat().st_size,
-                path_name_key)
-    else:
-        return path_name_key
+    _use_user_locale(locale.LC_COLLATE)
+    collate = locale.setlocale(locale.LC_COLLATE)
+    if collate in ("C", "POSIX") or collate.startswith("C."):
+        return _byte_order_key
+    return locale.strxfrm
+
+
+_OUTPUT_FORMATS = ("text", "jsonl", "nul")
+
+_USER_LOCALE_CATEGORIES: Set[int] = set()
+
+
+def _use_user_locale(category: int):
+    """
+    Apply the user's locale to a locale category, the first time the category is needed.
+
+    The ls command uses a locale-specific string sorting function, resulting in sort orders such as e.g.
+    ["a", ".b", "c"], while the order obtained by the default sort would be [".b", "a", "c"]. To achieve the same
+    result, pyls uses the user's locale for LC_COLLATE, with locale.strxfrm as the sorting key, and for LC_TIME, for
+    the names of the months. Applying the locale is not a great idea in library code, since it changes the whole
+    process, so it is postponed until a listing actually needs it, and done only once: a program which uses pyls as
+    a library and selects a locale of its own afterwards keeps that one. For more information, refer to
+    https://docs.python.org/3/library/locale.html#background-details-hints-tips-and-caveats
+    """
+    if category not in _USER_LOCALE_CATEGORIES:
+        _USER_LOCALE_CATEGORIES.add(category)
+        locale.setlocale(category, '')
+
+
+def _byte_order_key(name: str) -> str:
+    """
+    Sorting key which orders names by the bytes of their file system representation. For ASCII names, this is the
+    name itself. Other names are mapped to a string with one code point per byte, which avoids comparing the
+    surrogates that represent undecodable bytes in the wrong order.
+    """
+    if name.isascii():
+        return name
+    return os.fsencode(name).decode("latin-1")
 
 
 if __name__ == '__main__':
@@ -1,7 +1,22 @@
+import asyncio
+import collections
+import concurrent.futures
 import contextlib
+import datetime
+import grp
+import io
+import itertools
+import json
 import os
 import pathlib
+import pwd
+import random
+import shutil
 import subprocess
+import sys
+import threading
+import time
+from typing import Iterator
 
 import pytest
 
@@ -63,9 +78,12 @@ def _make_test_symlink(path: pathlib.Path, target_path: pathlib.Path):
     path.symlink_to(target=target_path)
 
 
-def run_system_ls(path, list_format=False, recursive=False, show_all=False, sort_by_size=False) -> str:
+def run_system_ls(path, list_format=False, recursive=False, show_all=False, sort_by_size=False,
+                  unsorted=False) -> str:
     """ Executes the system ls command with the given arguments and returns the stdout output. """
     subprocess_args = []
+    if unsorted:
+        subprocess_args.append("-U")
     if show_all:
         subprocess_args.append("-a")
     if recursive:
@@ -79,14 +97,29 @@ def run_system_ls(path, list_format=False, recursive=False, show_all=False, sort
     return ls_run.stdout.decode('utf-8')
 
 
-def run_pyls(path, list_format=False, recursive=False, show_all=False, sort_by_size=False) -> str:
+def run_pyls(path, list_format=False, recursive=False, show_all=False, sort_by_size=False,
+             jobs=1, prefetch=None, stream_chunk_size=None) -> str:
     """ Executes the pyls command with the given arguments and returns the output. """
+    _configure_pyls(path, list_format, recursive, show_all, sort_by_size, jobs, prefetch, stream_chunk_size)
+    return pyls.ls_string()
+
+
+def run_pyls_lines(path, list_format=False, recursive=False, show_all=False, sort_by_size=False) -> Iterator[str]:
+    """ Like run_pyls, but returns an iterator over the output lines, e.g. to keep watching for changes. """
+    _configure_pyls(path, list_format, recursive, show_all, sort_by_size)
+    return iter(pyls.ls_lines())
+
+
+def _configure_pyls(path, list_format=False, recursive=False, show_all=False, sort_by_size=False,
+                    jobs=1, prefetch=None, stream_chunk_size=None):
     pyls.CONFIG.paths = [str(path)]
     pyls.CONFIG.show_all = show_all
     pyls.CONFIG.recursive = recursive
     pyls.CONFIG.list_format = list_format
     pyls.CONFIG.sort_by_size = sort_by_size
-    return pyls.ls_string()
+    pyls.CONFIG.jobs = jobs
+    pyls.CONFIG.prefetch = prefetch
+    pyls.CONFIG.stream_chunk_size = stream_chunk_size
 
 
 @pytest.mark.parametrize("show_all", [False, True])
@@ -143,6 +176,1290 @@ def test_compare_to_system_ls(test_base_dir: pathlib.Path,
         assert sys_ls_result == py_ls_result
 
 
+@pytest.mark.parametrize("prefetch", [1, None])
+@pytest.mark.parametrize("jobs", [2, 8])
+@pytest.mark.parametrize("sort_by_size", [False, True])
+@pytest.mark.parametrize("list_format", [False, True])
+def test_parallel_traversal_matches_serial(test_base_dir: pathlib.Path,
+                                           list_format: bool,
+                                           sort_by_size: bool,
+                                           jobs: int,
+                                           prefetch: int):
+    """ Reading directories on a thread pool must not change the output, in particular not its order. """
+    serial_result = run_pyls(test_base_dir, list_format=list_format, sort_by_size=sort_by_size,
+                             recursive=True, show_all=True)
+    parallel_result = run_pyls(test_base_dir, list_format=list_format, sort_by_size=sort_by_size,
+                               recursive=True, show_all=True, jobs=jobs, prefetch=prefetch)
+    assert parallel_result == serial_result
+
+
+def test_async_listings_match_ls_lines(test_base_dir: pathlib.Path):
+    """ Dozens of listings with different options run concurrently, each giving the same output as ls_lines. """
+    options = [dict(list_format=list_format, sort_by_size=sort_by_size, recursive=recursive, show_all=show_all)
+               for list_format, sort_by_size, recursive, show_all in itertools.product([False, True], repeat=4)]
+    configs = [pyls.Config(paths=[str(test_base_dir)], **o) for o in options * 3]
+    expected = [run_pyls(test_base_dir, **o) for o in options * 3]
+    ticks = 0
+
+    async def list_all():
+        nonlocal ticks
+        semaphore = asyncio.Semaphore(8)
+
+        async def collect(config):
+            return "".join([f"{line}\n" async for line in pyls.als_lines(config, semaphore=semaphore, batch_size=5)])
+
+        listings = asyncio.ensure_future(asyncio.gather(*(collect(c) for c in configs)))
+        while not listings.done():  # the event loop keeps running while the listings are produced
+            ticks += 1
+            await asyncio.sleep(0)
+        return listings.result()
+
+    assert asyncio.run(list_all()) == expected
+    assert ticks > len(configs)
+
+
+def test_async_listing_cancelled_during_a_batch(tmp_path: pathlib.Path, monkeypatch):
+    """ Cancelling the consumer while a batch is running raises CancelledError, once the batch has ended. """
+    _make_test_file(tmp_path / "file")
+    started, release = threading.Event(), threading.Event()
+    real_scan_dir = pyls._scan_dir
+
+    def blocking_scan_dir(*args):
+        started.set()
+        release.wait()
+        return real_scan_dir(*args)
+
+    monkeypatch.setattr(pyls, "_scan_dir", blocking_scan_dir)
+
+    async def cancel_consumer():
+        async def consume():
+            return [line async for line in pyls.als_lines(pyls.Config(paths=[str(tmp_path)]))]
+
+        consumer = asyncio.ensure_future(consume())
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        consumer.cancel()
+        asyncio.get_running_loop().call_later(0.05, release.set)
+        with pytest.raises(asyncio.CancelledError):
+            await consumer
+
+    asyncio.run(cancel_consumer())
+
+
+def test_listers_on_threads_match_serial_output(test_base_dir: pathlib.Path):
+    """ Listers with different configs, running on many threads at the same time, give the same output as ls_lines. """
+    options = [dict(list_format=list_format, sort_by_size=sort_by_size, recursive=recursive, show_all=show_all)
+               for list_format, sort_by_size, recursive, show_all in itertools.product([False, True], repeat=4)]
+    expected = [run_pyls(test_base_dir, **o) for o in options * 3]
+    listers = [pyls.Lister(pyls.Config(paths=[str(test_base_dir)], jobs=2, **o)) for o in options * 3]
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        assert list(pool.map(pyls.Lister.string, listers)) == expected
+
+
+@pytest.mark.parametrize("output_format", ["text", "jsonl", "nul"])
+def test_processes_match_serial_output(test_base_dir: pathlib.Path, output_format: str):
+    """ Listing the subtrees or path arguments in worker processes gives the same output as a serial listing. """
+    subdirs = sorted(str(p) for p in test_base_dir.iterdir() if p.is_dir())
+    for paths, recursive, stream_chunk_size in [([str(test_base_dir)], True, None),
+                                                ([str(test_base_dir)], True, 3),
+                                                (subdirs, True, None),
+                                                (subdirs + [str(test_base_dir)], False, None)]:
+        for list_format, show_all in itertools.product([False, True], repeat=2):
+            options = dict(paths=paths, recursive=recursive, stream_chunk_size=stream_chunk_size,
+                           list_format=list_format, show_all=show_all, output_format=output_format)
+            expected = pyls.Lister(pyls.Config(**options)).string()
+            assert pyls.Lister(pyls.Config(processes=2, **options)).string() == expected
+
+
+def test_processes_raise_errors_at_the_same_point(test_base_dir: pathlib.Path):
+    """ An error in a worker is raised after the output of the preceding shards and the lines before the error. """
+    paths = [str(test_base_dir), str(test_base_dir / "missing"), str(test_base_dir / "zzz")]
+    for processes in [1, 3]:
+        lines = []
+        with pytest.raises(FileNotFoundError):
+            lines.extend(pyls.Lister(pyls.Config(paths=paths, processes=processes)).lines())
+        if processes == 1:
+            expected = lines
+    assert lines == expected
+    assert lines[-1] == f"\n{test_base_dir / 'missing'}:"
+
+
+def test_processes_record_stats_of_workers(test_base_dir: pathlib.Path):
+    """ The directories and entries listed by the workers are counted in the Stats object of the config. """
+    serial = pyls.Config(paths=[str(test_base_dir)], recursive=True, list_format=True, stats=pyls.Stats())
+    sharded = pyls.Config(paths=[str(test_base_dir)], recursive=True, list_format=True, stats=pyls.Stats(),
+                          processes=2)
+    assert pyls.Lister(sharded).string() == pyls.Lister(serial).string()
+    assert sharded.stats.directories == serial.stats.directories
+    assert sharded.stats.entries == serial.stats.entries
+    assert sharded.stats.calls["readdir"] == serial.stats.calls["readdir"]
+
+
+_list_shard = pyls._list_shard
+
+
+def _list_shard_slowly(config: pyls.Config, path: str, *args):
+    """ List the shards like pyls._list_shard, taking a long time for the ones named slow. """
+    if path.endswith("slow"):
+        time.sleep(30)
+    return _list_shard(config, path, *args)
+
+
+def test_processes_stop_when_the_listing_is_closed(tmp_path: pathlib.Path, monkeypatch):
+    """ If the output is closed early, e.g. by pyls -R | head, the workers are not left to finish their shards. """
+    for name in ("a", "slow"):
+        (tmp_path / name).mkdir()
+        _make_test_file(tmp_path / name / "file")
+    monkeypatch.setattr(pyls, "_list_shard", _list_shard_slowly)
+    lines = pyls.Lister(pyls.Config(paths=[str(tmp_path)], recursive=True, processes=2)).lines()
+    assert next(line for line in lines if line == "file")
+    start = time.monotonic()
+    lines.close()
+    assert time.monotonic() - start < 10
+
+
+def test_parallel_traversal_bounds_prefetch(test_base_dir: pathlib.Path, monkeypatch):
+    """ No more than the configured number of directories may be read ahead of the output. """
+    max_pending = 0
+    real_prefetch = pyls._DirectoryReader.prefetch
+
+    def checking_prefetch(self, stack):
+        nonlocal max_pending
+        real_prefetch(self, stack)
+        max_pending = max(max_pending, len(self._pending))
+
+    monkeypatch.setattr(pyls._DirectoryReader, "prefetch", checking_prefetch)
+    run_pyls(test_base_dir, recursive=True, show_all=True, jobs=4, prefetch=3)
+    assert 0 < max_pending <= 3
+
+
+def test_byte_order_key_matches_bytes():
+    """ The sorting key for the C locale orders names like their bytes, including undecodable bytes. """
+    names = ["a", "Z", "_a", ".a", "\u00e9", "\uffff", "\U0001f600", os.fsdecode(b"\xff"), os.fsdecode(b"a\x80")]
+    assert sorted(names, key=pyls._byte_order_key) == sorted(names, key=os.fsencode)
+
+
+@pytest.mark.parametrize("sort_by_size", [False, True])
+def test_collation_key_is_computed_once_per_entry(test_base_dir: pathlib.Path, monkeypatch, sort_by_size: bool):
+    """ The collation key of an entry is computed once, no matter how often the entry is compared. """
+    counter = collections.Counter()
+    real_key_function = pyls._collation_key_function()
+
+    def counting_key_function(name):
+        counter[name] += 1
+        return real_key_function(name)
+
+    monkeypatch.setattr(pyls, "_collation_key_function", lambda: counting_key_function)
+    run_pyls(test_base_dir / "many_files", show_all=True, sort_by_size=sort_by_size)
+    assert sum(counter.values()) == 1 + 12  # the path argument, . and .. and the ten files
+    assert max(counter.values()) == 1
+
+
+def _reference_column_layout(path_strings, terminal_size) -> pyls.ColumnInfo:
+    """
+    The straightforward port of the column layout in the coreutils ls source code (version 5.0, file src/ls.c lines
+    3485 - 3562), which updates the layouts for all possible numbers of columns file by file.
+    """
+    max_possible_cols = max(1, terminal_size.columns // 3)
+    col_layouts = [pyls.ColumnInfo(num_cols=i, col_array=[0] * i) for i in range(1, max_possible_cols)]
+    for p_idx, p in enumerate(path_strings):
+        real_length = len(p) + 2
+        for col, col_layout in enumerate(col_layouts, 1):
+            if not col_layout.is_valid:
+                continue
+            idx = p_idx // ((len(path_strings) + col - 1) // col)
+            if real_length > col_layout.col_array[idx]:
+                col_layout.line_len += real_length - col_layout.col_array[idx]
+                col_layout.col_array[idx] = real_length
+                col_layout.is_valid = col_layout.line_len < terminal_size.columns
+    for c in reversed(col_layouts):
+        if c.is_valid:
+            return c
+    return None
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_column_layout_matches_reference(seed: int):
+    """ The column layout is the same as the one of the straightforward port of coreutils, on random inputs. """
+    rng = random.Random(seed)
+    for _ in range(50):
+        num_files = rng.choice([0, 1, 2, rng.randint(3, 30), rng.randint(30, 500)])
+        max_len = rng.choice([3, 10, 40])
+        names = ["x" * rng.randint(1, max_len) for _ in range(num_files)]
+        terminal_size = os.terminal_size((rng.randint(6, 300), 24))
+
+        expected = _reference_column_layout(names, terminal_size)
+        if expected is None:
+            continue  # no valid layout, see test_column_layout_falls_back_to_single_column
+        layout = pyls._get_optimal_column_layout(names, terminal_size)
+        assert (layout.num_cols, layout.col_array, layout.line_len) == \
+               (expected.num_cols, expected.col_array, expected.line_len)
+
+
+def test_column_layout_falls_back_to_single_column(monkeypatch):
+    """ If a name is wider than the terminal, one name is printed per line. """
+    monkeypatch.setattr(shutil, "get_terminal_size", lambda: os.terminal_size((80, 24)))
+    layout = pyls._get_optimal_column_layout(["a", "b" * 100, "c"], os.terminal_size((80, 24)))
+    assert layout.num_cols == 1
+    assert list(pyls._lines_in_short_format_many_per_line(["a", "b" * 100, "c"])) == \
+           ["a".ljust(102), "b" * 100 + "  ", "c".ljust(102)]
+
+
+class _CountingStream(io.StringIO):
+    """ A text stream which counts the calls of its write method. """
+
+    def __init__(self):
+        super().__init__()
+        self.num_writes = 0
+
+    def write(self, s):
+        self.num_writes += 1
+        return super().write(s)
+
+
+def test_buffered_line_writer_writes_in_chunks():
+    """ The lines are written in a few large chunks, with the same result as printing them one by one. """
+    lines = [f"line {i}" for i in range(1000)]
+    stream = _CountingStream()
+    writer = pyls._BufferedLineWriter(stream, buffer_size=1024)
+    writer.write_lines(lines)
+    writer.end_of_directory()
+    writer.flush()
+    assert stream.getvalue() == "".join(f"{line}\n" for line in lines)
+    assert stream.num_writes < 20
+
+
+def test_buffered_line_writer_flushes_at_end_of_directory():
+    """ On a terminal, the output of each directory is written as soon as it is complete. """
+    stream = _CountingStream()
+    writer = pyls._BufferedLineWriter(stream, flush_at_end_of_directory=True)
+    writer.write_lines(["a", "b"])
+    assert stream.getvalue() == ""
+    writer.end_of_directory()
+    assert stream.getvalue() == "a\nb\n"
+
+
+def test_main_exits_quietly_on_broken_pipe(tmp_path: pathlib.Path):
+    """ When the reader of the output goes away, as with pyls | head, pyls stops without printing a traceback. """
+    for i in range(2000):
+        (tmp_path / f"{i:05d}_a_file_with_a_rather_long_name_to_fill_the_pipe_buffer_quickly").touch()
+    pyls_proc = subprocess.Popen([sys.executable, pyls.__file__, "-l", str(tmp_path)],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    pyls_proc.stdout.readline()
+    pyls_proc.stdout.close()
+    _, stderr = pyls_proc.communicate(timeout=30)
+    assert stderr == b""
+    assert pyls_proc.returncode == 1
+
+
+@pytest.mark.parametrize("args, unused_modules", [
+    ([], {"argparse", "asyncio", "concurrent.futures", "ctypes", "dataclasses", "datetime", "grp", "multiprocessing",
+          "pwd", "shutil", "threading", "typing"}),
+    (["-laR"], {"argparse", "asyncio", "concurrent.futures", "ctypes", "dataclasses", "multiprocessing", "shutil",
+                "typing"}),
+])
+def test_main_imports_only_needed_modules(tmp_path: pathlib.Path, args: list, unused_modules: set):
+    """ Modules which are slow to import are only imported for the options which need them. """
+    (tmp_path / "a_file").touch()
+    script = "import sys, pyls\ntry:\n    pyls.main()\nfinally:\n    print(sorted(sys.modules), file=sys.stderr)"
+    pyls_run = subprocess.run([sys.executable, "-c", script] + args + [str(tmp_path)], capture_output=True,
+                              cwd=pathlib.Path(pyls.__file__).parent, text=True)
+    assert pyls_run.returncode == 0
+    assert unused_modules.isdisjoint(eval(pyls_run.stderr))
+
+
+@pytest.mark.parametrize("args", [
+    [], ["-l"], ["-la", "x"], ["-R", "-S", "x", "y"], ["x", "-a"], ["x", "-a", "y"], ["-", "-l"], ["--", "-l", "--"],
+    ["x", "--", "-l"], ["-5"], ["-lx"], ["--preload-names", "x"], ["-l", "--jobs", "2"], ["-la", "--"], [""],
+])
+def test_short_flags_are_parsed_like_argparse(args: list, capsys):
+    """ The fast path for the common flags gives the same result as argparse, and leaves everything else to it. """
+    def parse(parse_args):
+        try:
+            return repr(parse_args(args))
+        except SystemExit:
+            return "error"
+
+    expected = parse(pyls._parse_args_with_argparse)
+    config = pyls._parse_short_flags(args)
+    if config is not None:
+        assert repr(config) == expected
+    assert parse(pyls.get_configuration_from_command_line_args) == expected
+
+
+@pytest.mark.parametrize("recursive", [False, True])
+@pytest.mark.parametrize("list_format", [False, True])
+@pytest.mark.parametrize("test_case", PATHS)
+def test_stream_compare_to_system_ls_unsorted(test_base_dir: pathlib.Path,
+                                              test_case: str,
+                                              list_format: bool,
+                                              recursive: bool):
+    """
+    With a chunk size larger than the directories, each directory fits into its first chunk, so the streamed output
+    equals the sorted output of ls. With chunks of a single entry, the directories are listed in directory order,
+    like ls -U. This is only compared without the long format, whose columns are aligned within each chunk.
+    """
+    path = test_base_dir / test_case
+    sys_ls_result = run_system_ls(path, list_format=list_format, recursive=recursive)
+    py_ls_result = run_pyls(path, list_format=list_format, recursive=recursive, stream_chunk_size=1000)
+    print_if_different(py_ls_result, sys_ls_result)
+    assert sys_ls_result == py_ls_result
+
+    if not list_format:
+        sys_ls_result = run_system_ls(path, recursive=recursive, unsorted=True)
+        py_ls_result = run_pyls(path, recursive=recursive, stream_chunk_size=1)
+        print_if_different(py_ls_result, sys_ls_result)
+        assert sys_ls_result == py_ls_result
+
+
+def test_stream_does_not_read_directories_ahead(tmp_path: pathlib.Path, monkeypatch):
+    """ With --jobs, streamed directories are still only read while they are output, never whole ahead of time. """
+    for d in ("a", "b"):
+        (tmp_path / d).mkdir()
+        _make_test_file(tmp_path / d / "file")
+    read = []
+    real_read_dir_listing = pyls.Lister._read_dir_listing
+
+    def spy(self, base_dir, *args, **kwargs):
+        read.append(base_dir.name)
+        return real_read_dir_listing(self, base_dir, *args, **kwargs)
+
+    monkeypatch.setattr(pyls.Lister, "_read_dir_listing", spy)
+    config = pyls.Config(paths=[str(tmp_path / "a"), str(tmp_path / "b")], list_format=True, recursive=True,
+                         stream_chunk_size=1, jobs=4)
+    assert "file" in pyls.Lister(config).string()
+    assert read == []
+
+
+def test_stream_aligns_each_chunk_separately(tmp_path: pathlib.Path):
+    """ In streaming mode, the columns are aligned within each chunk of entries rather than the whole directory. """
+    for i in range(6):
+        (tmp_path / f"file_{i}").write_bytes(b"a" * 10 ** i)
+    group = grp.getgrgid(os.getgid()).gr_name
+
+    lines = run_pyls(tmp_path, list_format=True, stream_chunk_size=1).splitlines()
+    assert len(lines) == 6
+    for line in lines:
+        size = 10 ** int(line[-1])
+        assert f" {group} {size} " in line
+
+    # A directory which fits into a single chunk is listed as without streaming.
+    lines = run_pyls(tmp_path, list_format=True, stream_chunk_size=6).splitlines()
+    assert lines.pop(0).startswith("total ")
+    assert lines == sorted(lines, key=lambda line: line[-1])
+    for line in lines:
+        size = 10 ** int(line[-1])
+        assert f" {group} {size:>6} " in line
+
+
+def _make_tree_with_odd_names(root: pathlib.Path):
+    (root / "sub dir").mkdir()
+    (root / "sub dir" / "new\nline").write_bytes(b"abc")
+    (root / "tab\tand \"quotes\"").touch()
+    (root / "unicode_é").touch()
+    (root / os.fsdecode(b"undecodable_\xff")).touch()
+    (root / "link").symlink_to("sub dir")
+
+
+@pytest.mark.parametrize("stream_chunk_size", [None, 2])
+@pytest.mark.parametrize("list_format", [False, True])
+def test_jsonl_format_has_the_raw_lstat_fields(tmp_path: pathlib.Path, list_format: bool, stream_chunk_size: int):
+    """ Each directory and entry is a JSON object, in the order of the text output, without looking up names. """
+    _make_tree_with_odd_names(tmp_path)
+    config = pyls.Config(paths=[str(tmp_path)], list_format=list_format, recursive=True, show_all=True,
+                         stream_chunk_size=stream_chunk_size, output_format="jsonl")
+    name_cache = pyls.NameCache()
+    records = [json.loads(line) for line in pyls.Lister(config, name_cache).lines()]
+    assert name_cache.misses == 0
+
+    text_config = pyls.Config(paths=[str(tmp_path)], recursive=True, show_all=True, stream_chunk_size=stream_chunk_size)
+    text_lines = list(pyls.Lister(text_config).lines())
+    directory = None
+    for record in records:
+        if record["type"] == "directory":
+            directory = pathlib.Path(record["path"])
+            assert text_lines.pop(0).lstrip("\n") == f"{directory}:"
+        elif record["type"] == "total":
+            assert list_format and stream_chunk_size is None
+            expected_total = sum(os.lstat(directory / name).st_blocks for name in os.listdir(directory)) // 2
+            assert record["total"] == expected_total + (os.lstat(directory).st_blocks +
+                                                        os.lstat(directory / "..").st_blocks) // 2
+        else:
+            assert record["name"] == text_lines.pop(0)
+            if not list_format:
+                assert set(record) == {"type", "name"}
+                continue
+            lstat = os.lstat(directory / record["name"])
+            assert (record["mode"], record["nlink"], record["uid"], record["gid"], record["size"],
+                    record["mtime_ns"]) == (lstat.st_mode, lstat.st_nlink, lstat.st_uid, lstat.st_gid,
+                                            lstat.st_size, lstat.st_mtime_ns)
+            if record["name"] == "link":
+                assert record["target"] == "sub dir"
+            else:
+                assert "target" not in record
+    assert text_lines == []
+
+
+@pytest.mark.parametrize("list_format", [False, True])
+def test_nul_format_has_one_record_per_path(tmp_path: pathlib.Path, list_format: bool):
+    """ Each entry is its path, preceded by the raw lstat fields in the long list format, terminated by NUL. """
+    _make_tree_with_odd_names(tmp_path)
+    config = pyls.Config(paths=[str(tmp_path)], list_format=list_format, recursive=True, output_format="nul")
+    output = pyls.Lister(config).string()
+    assert output.endswith("\0")
+    records = output[:-1].split("\0")
+    expected_paths = sorted(str(p) for p in tmp_path.rglob("*"))
+    if not list_format:
+        assert sorted(records) == expected_paths
+        return
+
+    paths = []
+    for record in records:
+        fields, path = record.split("\t", 1)
+        lstat = os.lstat(path)
+        assert fields == " ".join(str(n) for n in (lstat.st_mode, lstat.st_nlink, lstat.st_uid, lstat.st_gid,
+                                                   lstat.st_size, lstat.st_mtime_ns))
+        paths.append(path)
+    assert sorted(paths) == expected_paths
+
+
+def _make_tree_with_random_sizes(root: pathlib.Path, seed: int = 0):
+    rng = random.Random(seed)
+    for d in ["", "sub", "sub/deeper", ".hidden_dir", "other"]:
+        (root / d).mkdir(exist_ok=True)
+        for i in range(rng.randint(0, 30)):
+            prefix = rng.choice(["", "", ".", "A", "z"])
+            (root / d / f"{prefix}file_{i}").write_bytes(b"x" * rng.choice([0, 1, 10, rng.randint(0, 5000)]))
+
+
+def _jsonl_entries_by_directory(config: pyls.Config) -> dict:
+    config.output_format = "jsonl"
+    entries_by_directory = {}
+    for record in map(json.loads, pyls.Lister(config).lines()):
+        if record["type"] == "directory":
+            entries = entries_by_directory.setdefault(record["path"], [])
+        elif record["type"] == "entry":
+            entries.append(record)
+    return entries_by_directory
+
+
+@pytest.mark.parametrize("top", [1, 3, 1000])
+@pytest.mark.parametrize("show_all", [False, True])
+@pytest.mark.parametrize("sort_by_size", [False, True])
+def test_top_lists_the_first_entries_of_each_directory(tmp_path: pathlib.Path, sort_by_size: bool, show_all: bool,
+                                                       top: int):
+    """ With --top N, each directory shows the first N entries of its listing, and all subdirectories are listed. """
+    _make_tree_with_random_sizes(tmp_path)
+    options = dict(paths=[str(tmp_path)], list_format=True, recursive=True, show_all=show_all,
+                   sort_by_size=sort_by_size)
+    expected = {path: entries[:top] for path, entries in _jsonl_entries_by_directory(pyls.Config(**options)).items()}
+    entries_by_directory = _jsonl_entries_by_directory(pyls.Config(top=top, **options))
+    assert list(entries_by_directory.items()) == list(expected.items())
+
+
+@pytest.mark.parametrize("top", [1, 5, 1000])
+@pytest.mark.parametrize("sort_by_size", [False, True])
+def test_top_of_tree_lists_the_first_entries_of_all_directories(tmp_path: pathlib.Path, sort_by_size: bool, top: int):
+    """ With --top-of-tree, the first N entries of all directories are listed together, ordered by their paths. """
+    _make_tree_with_random_sizes(tmp_path)
+    options = dict(paths=[str(tmp_path)], list_format=True, recursive=True, show_all=True, sort_by_size=sort_by_size)
+    all_entries = []
+    for path, entries in _jsonl_entries_by_directory(pyls.Config(**options)).items():
+        all_entries.extend(dict(e, name=os.path.join(path, e["name"])) for e in entries if e["name"] not in (".", ".."))
+    collation_key = pyls._collation_key_function()
+    all_entries.sort(key=lambda e: (-e["size"] if sort_by_size else 0, collation_key(e["name"])))
+
+    config = pyls.Config(top=top, top_of_tree=True, output_format="jsonl", **options)
+    assert [json.loads(line) for line in pyls.Lister(config).lines()] == all_entries[:top]  # without headers
+
+
+def _reference_time_str(mtime: float, now: float) -> str:
+    """ Format the modification time without caching, in the same way as ls. """
+    last_modified = datetime.datetime.fromtimestamp(mtime)
+    if now - mtime < pyls.TimestampFormatter.SIX_MONTHS_IN_SECONDS:
+        return last_modified.strftime("%b %e %H:%M")
+    return last_modified.strftime("%b %e  %Y")
+
+
+def test_timestamp_formatter_matches_reference():
+    """ The cached strings are the same as formatting each modification time on its own. """
+    rng = random.Random(0)
+    now = time.time()
+    formatter = pyls.TimestampFormatter(now=now)
+    cutoff = now - pyls.TimestampFormatter.SIX_MONTHS_IN_SECONDS
+    mtimes = [now + rng.uniform(-60 * 60 * 24 * 800, 60 * 60 * 24 * 30) for _ in range(2000)]
+    mtimes += [m + rng.uniform(0, 120) for m in mtimes[:200]]  # repeat some minutes and days
+    mtimes += [cutoff - 1, cutoff + 1, now, now + 3600, 0.0]
+    for mtime in mtimes:
+        assert formatter.format(mtime) == _reference_time_str(mtime, now)
+    assert formatter.hits > 0
+
+
+def test_timestamp_formatter_caches_by_minute_and_day():
+    """ Recent times within the same minute, and old times within the same day, are formatted only once. """
+    now = time.time()
+    formatter = pyls.TimestampFormatter(now=now)
+    minute_start = datetime.datetime.fromtimestamp(now - 3600).replace(second=0, microsecond=0).timestamp()
+    day_start = datetime.datetime.fromtimestamp(now - 3 * 31556952).replace(hour=0, minute=0, second=0,
+                                                                            microsecond=0).timestamp()
+    for offset in range(0, 60, 5):
+        formatter.format(minute_start + offset)
+    for offset in range(0, 24 * 60 * 60, 3600):
+        formatter.format(day_start + offset)
+    assert formatter.misses == 2
+
+
+def test_timestamp_formatter_cache_is_bounded():
+    """ The cache does not grow beyond its maximum size. """
+    now = time.time()
+    formatter = pyls.TimestampFormatter(now=now, max_cache_size=10)
+    for i in range(100):
+        formatter.format(now - 60 * i)
+    assert len(formatter._cache) <= 10
+
+
+def test_name_cache_counts_hits_and_misses():
+    """ Repeated lookups of the same id are answered from the cache. """
+    cache = pyls.NameCache()
+    uid, gid = os.getuid(), os.getgid()
+    assert cache.user_name(uid) == pwd.getpwuid(uid).pw_name
+    assert cache.user_name(uid) == pwd.getpwuid(uid).pw_name
+    assert cache.group_name(gid) == grp.getgrgid(gid).gr_name
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_name_cache_preload():
+    """ After preloading the databases, lookups of known ids do not miss the cache. """
+    cache = pyls.NameCache()
+    cache.preload()
+    cache.user_name(pwd.getpwall()[0].pw_uid)
+    cache.group_name(grp.getgrall()[0].gr_gid)
+    assert (cache.hits, cache.misses) == (2, 0)
+
+
+def test_name_cache_falls_back_to_numeric_ids():
+    """ Like ls, ids without a name in the user or group database are shown as numbers. """
+    unknown_id = 2 ** 31 - 3
+    with contextlib.suppress(KeyError):
+        pwd.getpwuid(unknown_id)
+        pytest.skip(f"uid {unknown_id} exists on this system")
+    with contextlib.suppress(KeyError):
+        grp.getgrgid(unknown_id)
+        pytest.skip(f"gid {unknown_id} exists on this system")
+    cache = pyls.NameCache()
+    assert cache.user_name(unknown_id) == str(unknown_id)
+    assert cache.group_name(unknown_id) == str(unknown_id)
+
+
+def test_listers_have_their_own_name_caches():
+    """ Unless a name cache is passed to share it, each lister looks up the names in a cache of its own. """
+    first, second = pyls.Lister(), pyls.Lister()
+    assert first.name_cache is not second.name_cache
+    shared = pyls.NameCache()
+    assert pyls.Lister(name_cache=shared).name_cache is shared
+
+
+def test_name_cache_clear():
+    """ Clearing the cache forgets the names and resets the counters. """
+    cache = pyls.NameCache()
+    cache.preload()
+    cache.user_name(os.getuid())
+    cache.clear()
+    assert (cache.hits, cache.misses, cache.preloaded) == (0, 0, False)
+    cache.user_name(os.getuid())
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="changing the group of a file requires root privileges")
+def test_group_column_uses_gid(tmp_path: pathlib.Path):
+    """ The group column shows the group of the file, not the group with the same id as the owner. """
+    other_gid = next((g.gr_gid for g in grp.getgrall() if g.gr_gid != os.getuid()), None)
+    if other_gid is None:
+        pytest.skip("no group with a gid different from the uid")
+    f = tmp_path / "file"
+    f.touch()
+    os.chown(f, os.getuid(), other_gid)
+
+    assert run_pyls(tmp_path, list_format=True) == run_system_ls(tmp_path, list_format=True)
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_stats_count_directories_entries_and_calls(tmp_path: pathlib.Path, monkeypatch, jobs: int):
+    """ The statistics count every listed directory and entry, and one lstat per entry in the long format. """
+    for d in ("a", "b", "b/c"):
+        (tmp_path / d).mkdir()
+        for i in range(3):
+            (tmp_path / d / f"file{i}").touch()
+    (tmp_path / "link").symlink_to(tmp_path / "a")
+    stats = pyls.Stats()
+    monkeypatch.setattr(pyls.CONFIG, "stats", stats)
+
+    output = run_pyls(tmp_path, list_format=True, recursive=True, jobs=jobs)
+
+    assert output == run_system_ls(tmp_path, list_format=True, recursive=True)
+    assert stats.directories == 4
+    assert stats.entries == 3 + 3 + 4 + 3
+    assert stats.calls["readdir"] == 4
+    assert stats.calls["lstat"] == stats.entries + 1  # including the lstat of the top level directory
+    assert stats.calls["resolve"] == 1
+    assert all(seconds >= 0 for seconds in stats.seconds.values())
+    assert "entries" in stats.report()
+
+
+def _make_tree_with_links(root: pathlib.Path):
+    """ Make links with relative, absolute, chained, dangling and looping targets. """
+    (root / "deep" / "a" / "b").mkdir(parents=True)
+    (root / "deep" / "a" / "b" / "file").touch()
+    (root / "links").mkdir()
+    (root / "links" / "relative").symlink_to("../deep/a/b/file")
+    (root / "links" / "absolute").symlink_to(root / "deep" / "a")
+    (root / "links" / "chained").symlink_to("relative")
+    (root / "links" / "through_dir").symlink_to("../links/../deep/./a/b")
+    (root / "links" / "dangling").symlink_to("missing/file")
+    (root / "links" / "loop_a").symlink_to("loop_b")
+    (root / "links" / "loop_b").symlink_to("loop_a")
+
+
+def test_symlink_targets_are_read_as_stored(tmp_path: pathlib.Path):
+    """ Like ls, the long format shows the targets stored in the links, with one readlink per link. """
+    _make_tree_with_links(tmp_path)
+    stats = pyls.Stats()
+    config = pyls.Config(paths=[str(tmp_path / "links")], list_format=True, stats=stats)
+    assert pyls.Lister(config).string() == run_system_ls(tmp_path / "links", list_format=True)
+    assert stats.calls["resolve"] == 7
+
+
+def test_resolve_links_shows_real_paths(tmp_path: pathlib.Path, monkeypatch):
+    """ With resolve_links, the targets are the real paths of the links, as by os.path.realpath. """
+    _make_tree_with_links(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    config = pyls.Config(paths=["links"], list_format=True, output_format="jsonl", resolve_links=True)
+    targets = {r["name"]: r["target"] for r in map(json.loads, pyls.Lister(config).lines()) if "target" in r}
+    assert set(targets) == {"relative", "absolute", "chained", "through_dir", "dangling", "loop_a", "loop_b"}
+    for name, target in targets.items():
+        if not name.startswith("loop"):
+            assert target == os.path.realpath(tmp_path / "links" / name)
+
+
+def test_concurrent_listings_of_a_lister_have_their_own_resolvers(tmp_path: pathlib.Path, monkeypatch):
+    """ A listing which starts while another one of the same lister runs does not replace the resolver of the first. """
+    for d in ("a", "b"):
+        (tmp_path / d).mkdir()
+        (tmp_path / d / "link").symlink_to("../target")
+    used = []
+    real_resolve = pyls._SymlinkResolver.resolve
+
+    def spy(self, path):
+        used.append(self)
+        return real_resolve(self, path)
+
+    monkeypatch.setattr(pyls._SymlinkResolver, "resolve", spy)
+    lister = pyls.Lister(pyls.Config(paths=[str(tmp_path / "a"), str(tmp_path / "b")], list_format=True,
+                                     resolve_links=True))
+    first = lister.lines()
+    next(line for line in first if "link ->" in line)
+    assert lister.string().count("link ->") == 2
+    assert sum("link ->" in line for line in first) == 1
+    assert len(used) == 4
+    assert used[0] is used[3] and used[1] is used[2] and used[0] is not used[1]
+
+
+def test_resolve_links_resolves_shared_prefixes_once(tmp_path: pathlib.Path):
+    """ Links into the same directory only take a readlink for themselves and their targets. """
+    (tmp_path / "deep" / "a" / "b" / "c").mkdir(parents=True)
+    (tmp_path / "links").mkdir()
+    for i in range(50):
+        (tmp_path / "links" / f"link{i}").symlink_to(f"../deep/a/b/c/target{i}")
+    stats = pyls.Stats()
+    config = pyls.Config(paths=[str(tmp_path / "links")], list_format=True, resolve_links=True, stats=stats)
+    output = pyls.Lister(config).string()
+    assert f"link7 -> {os.path.realpath(tmp_path)}/deep/a/b/c/target7\n" in output
+    assert stats.calls["resolve"] <= 2 * 50 + len(tmp_path.parts) + 4
+
+
+def _make_tree_with_hard_links(root: pathlib.Path):
+    for d in ("a/b/c", "a/d", "e", ".hidden"):
+        (root / d).mkdir(parents=True)
+    for i, d in enumerate(("a", "a/b", "a/b/c", "a/d", "e", ".hidden")):
+        _make_test_file(root / d / "file", size_bytes=1000 * i + 1)
+    os.link(root / "a/b/file", root / "a/d/same_dir_link")
+    os.link(root / "a/b/file", root / "e/other_dir_link")
+    os.link(root / "e/file", root / "e/link_in_same_dir")
+    (root / "e" / "symlink").symlink_to("../a")
+
+
+@pytest.mark.parametrize("stream_chunk_size", [None, 2])
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_subtree_totals_match_du(tmp_path: pathlib.Path, jobs: int, stream_chunk_size: int):
+    """ The totals of each subtree follow its last directory, and count hard links once, like du. """
+    if shutil.which("du") is None:
+        pytest.skip("du is not available")
+    _make_tree_with_hard_links(tmp_path)
+    config = pyls.Config(paths=[str(tmp_path)], recursive=True, show_all=True, subtree_totals=True, jobs=jobs,
+                         stream_chunk_size=stream_chunk_size, output_format="jsonl")
+    records = [json.loads(line) for line in pyls.Lister(config).lines()]
+
+    # Each subtree record comes right after its tree, i.e. the directories are completed in post-order.
+    open_dirs = []
+    for record in records:
+        if record["type"] == "directory":
+            while open_dirs and not record["path"].startswith(open_dirs[-1] + os.sep):
+                open_dirs.pop()
+            open_dirs.append(record["path"])
+        elif record["type"] == "subtree":
+            assert open_dirs
+            assert record["path"] == open_dirs.pop()
+    assert not open_dirs
+
+    # Compare the whole tree only, since du may count a hard link in another directory than pyls.
+    root = records[-1]
+    assert root["type"] == "subtree" and root["path"] == str(tmp_path)
+    du_bytes = subprocess.run(["du", "-s", "--apparent-size", "-B1", str(tmp_path)], capture_output=True, text=True)
+    du_blocks = subprocess.run(["du", "-sk", str(tmp_path)], capture_output=True, text=True)
+    assert root["size"] == int(du_bytes.stdout.split()[0])
+    assert root["blocks"] == int(du_blocks.stdout.split()[0])
+    assert root["files"] == 7  # six files and a symlink, each counted once
+
+
+def test_subtree_totals_leave_out_hidden_entries_without_show_all(tmp_path: pathlib.Path):
+    """ Without -a, the totals only cover the listed entries, like du with the hidden entries excluded. """
+    if shutil.which("du") is None:
+        pytest.skip("du is not available")
+    _make_tree_with_hard_links(tmp_path)
+    config = pyls.Config(paths=[str(tmp_path)], recursive=True, subtree_totals=True, output_format="jsonl")
+    root = [json.loads(line) for line in pyls.Lister(config).lines()][-1]
+    du_bytes = subprocess.run(["du", "-s", "--apparent-size", "-B1", "--exclude=.*", str(tmp_path)],
+                              capture_output=True, text=True)
+    assert root["size"] == int(du_bytes.stdout.split()[0])
+    assert root["files"] == 6  # the file in .hidden is left out
+
+
+def test_subtree_totals_text_format(tmp_path: pathlib.Path):
+    """ In the text format, the totals are a line after the tree, as in the jsonl format. """
+    _make_tree_with_hard_links(tmp_path)
+    options = dict(paths=[str(tmp_path / "a")], recursive=True, subtree_totals=True)
+    text_totals = [line for line in pyls.Lister(pyls.Config(**options)).lines() if line.startswith("\nsubtree ")]
+    jsonl_totals = [r for r in map(json.loads, pyls.Lister(pyls.Config(output_format="jsonl", **options)).lines())
+                    if r["type"] == "subtree"]
+    assert text_totals == [f"\nsubtree {r['path']}: {r['files']} files, {r['size']} bytes, {r['blocks']} blocks"
+                           for r in jsonl_totals]
+    # The hard link in a/d is counted in a/b, which is listed first.
+    assert [(r["path"], r["files"]) for r in jsonl_totals] == [
+        (str(tmp_path / "a/b/c"), 1), (str(tmp_path / "a/b"), 2), (str(tmp_path / "a/d"), 1), (str(tmp_path / "a"), 4)]
+
+
+@pytest.mark.parametrize("stream_chunk_size", [None, 2])
+def test_subtree_totals_do_not_depend_on_jobs(tmp_path: pathlib.Path, stream_chunk_size: int):
+    """ A file linked from many directories is counted in the first one listed, however the reads are scheduled. """
+    _make_test_file(tmp_path / "shared", size_bytes=100000)
+    root = tmp_path / "tree"
+    for i in range(40):
+        (root / f"d{i:02d}").mkdir(parents=True)
+        _make_test_file(root / f"d{i:02d}" / "own", size_bytes=i)
+        os.link(tmp_path / "shared", root / f"d{i:02d}" / "link")
+    options = dict(paths=[str(root)], recursive=True, subtree_totals=True, stream_chunk_size=stream_chunk_size)
+    expected = pyls.Lister(pyls.Config(**options)).string()
+    # The first subdirectory listed counts the link, the others only their own file.
+    assert expected.count(": 2 files, ") == 1 and expected.count(": 1 files, ") == 39
+    for _ in range(10):
+        assert pyls.Lister(pyls.Config(jobs=8, **options)).string() == expected
+
+
+def _all_pages(lister: pyls.Lister, path: pathlib.Path, limit: int) -> list:
+    lines, cursor = lister.list_page(str(path), limit=limit)
+    pages = [lines]
+    while cursor is not None:
+        lines, cursor = lister.list_page(str(path), after=cursor, limit=limit)
+        pages.append(lines)
+    return pages
+
+
+@pytest.mark.parametrize("output_format", ["text", "jsonl", "nul"])
+@pytest.mark.parametrize("sort_by_size", [False, True])
+@pytest.mark.parametrize("show_all", [False, True])
+def test_pages_match_the_full_listing(tmp_path: pathlib.Path, output_format: str, sort_by_size: bool,
+                                      show_all: bool):
+    """ The pages together list the entries of a directory in the order of the full listing. """
+    _make_tree_with_random_sizes(tmp_path)
+    _make_tree_with_odd_names(tmp_path)
+    options = dict(paths=[str(tmp_path)], show_all=show_all, sort_by_size=sort_by_size, output_format=output_format,
+                   list_format=output_format != "text")
+    expected = [line for line in pyls.Lister(pyls.Config(**options)).lines()
+                if not line.startswith(('{"type": "directory"', '{"type": "total"'))]
+    lister = pyls.Lister(pyls.Config(**options))
+    for limit in [1, 3, len(expected), 1000]:
+        pages = _all_pages(lister, tmp_path, limit)
+        assert [line for page in pages for line in page] == expected
+        assert all(len(page) == limit for page in pages[:-1])
+        assert 0 < len(pages[-1]) <= limit
+
+
+def test_later_pages_are_served_from_the_index(tmp_path: pathlib.Path, monkeypatch):
+    """ Only the first page of an unchanged directory reads it, later ones only lstat the entries of the page. """
+    for i in range(100):
+        (tmp_path / f"file{i:03}").touch()
+    os.utime(tmp_path, (time.time() - 60, time.time() - 60))
+    scans = []
+    real_scan_dir = pyls._scan_dir
+    monkeypatch.setattr(pyls, "_scan_dir", lambda path, *args: scans.append(path) or real_scan_dir(path, *args))
+    stats = pyls.Stats()
+    lister = pyls.Lister(pyls.Config(list_format=True, stats=stats))
+
+    first, cursor = lister.list_page(str(tmp_path), limit=10)
+    for _ in range(5):
+        lines, cursor = lister.list_page(str(tmp_path), after=cursor, limit=10)
+    lstat_calls = stats.calls["lstat"]
+    lines, _ = lister.list_page(str(tmp_path), after=cursor, limit=10)
+    assert len(scans) == 1
+    assert stats.calls["lstat"] - lstat_calls == 10
+    assert [line.split()[-1] for line in lines] == [f"file{i:03}" for i in range(60, 70)]
+    assert lister.page_indexes.hits == 6
+
+    # A new entry changes the directory, so it is read again, and the next page continues after the same entry.
+    (tmp_path / "file0605").touch()
+    lines, _ = lister.list_page(str(tmp_path), after=cursor, limit=2)
+    assert len(scans) == 2
+    assert [line.split()[-1] for line in lines] == ["file060", "file0605"]
+
+
+def test_page_indexes_depend_on_the_excluded_names(tmp_path: pathlib.Path, monkeypatch):
+    """ The page indexes kept by list_page between calls are not shared by configs with other excluded names. """
+    for name in ("foo.tmp", "foo.txt", "bar.txt"):
+        (tmp_path / name).touch()
+    os.utime(tmp_path, (time.time() - 60, time.time() - 60))
+    monkeypatch.setattr(pyls, "_PAGE_INDEXES", None)
+    monkeypatch.setattr(pyls, "CONFIG", pyls.Config())
+    assert pyls.list_page(str(tmp_path)) == (["bar.txt", "foo.tmp", "foo.txt"], None)
+    monkeypatch.setattr(pyls, "CONFIG", pyls.Config(ignore_patterns=["*.tmp"]))
+    assert pyls.list_page(str(tmp_path)) == (["bar.txt", "foo.txt"], None)
+    monkeypatch.setattr(pyls, "CONFIG", pyls.Config(hide_patterns=["bar*"]))
+    assert pyls.list_page(str(tmp_path)) == (["foo.tmp", "foo.txt"], None)
+
+
+def test_list_page_rejects_invalid_cursors(tmp_path: pathlib.Path):
+    with pytest.raises(ValueError):
+        pyls.Lister().list_page(str(tmp_path), after="not a cursor!")
+    with pytest.raises(ValueError):
+        pyls.Lister().list_page(str(tmp_path), limit=0)
+
+
+def test_stats_are_recorded_only_for_their_listing(test_base_dir: pathlib.Path):
+    """ A listing without a Stats object, running at the same time on the same thread, records nothing. """
+    def make_lister(stats):
+        return pyls.Lister(pyls.Config(paths=[str(test_base_dir)], list_format=True, recursive=True, stats=stats))
+
+    alone = pyls.Stats()
+    list(make_lister(alone).lines())
+    interleaved = pyls.Stats()
+    for _ in itertools.zip_longest(make_lister(interleaved).lines(), make_lister(None).lines()):
+        pass
+    assert interleaved.calls == alone.calls
+    assert (interleaved.directories, interleaved.entries) == (alone.directories, alone.entries)
+
+
+def _make_cached_tree(root: pathlib.Path):
+    """ Make a small tree whose directories are old enough to be stored in the listing cache. """
+    for d in ("a", "a/b", "c"):
+        (root / d).mkdir()
+        _make_test_file(root / d / "file", size_bytes=len(d))
+    (root / "link").symlink_to(root / "a")
+    for d in (root / "a/b", root / "a", root / "c", root):
+        os.utime(d, (time.time() - 60, time.time() - 60))
+
+
+def test_listing_cache_serves_unchanged_directories(tmp_path: pathlib.Path, monkeypatch):
+    """ A second listing of an unchanged tree is read from the cache, and gives the same output. """
+    root = tmp_path / "root"
+    root.mkdir()
+    _make_cached_tree(root)
+    (tmp_path / "cache").mkdir()  # before running ls, since it changes the number of links of ..
+    cache = pyls.ListingCache(tmp_path / "cache")
+    monkeypatch.setattr(pyls.CONFIG, "cache", cache)
+    expected = run_system_ls(root, list_format=True, recursive=True, show_all=True, sort_by_size=True)
+
+    assert run_pyls(root, list_format=True, recursive=True, show_all=True, sort_by_size=True) == expected
+    assert (cache.hits, cache.misses) == (0, 4)
+    with _count_stat_calls(monkeypatch) as counter:
+        assert run_pyls(root, list_format=True, recursive=True, show_all=True, sort_by_size=True) == expected
+    assert (cache.hits, cache.misses) == (4, 4)
+    assert not [key for key in counter if isinstance(key, tuple)]  # no directory was read
+    assert str(root / "a" / "file") not in counter
+
+
+def test_listing_cache_detects_changed_directories(tmp_path: pathlib.Path, monkeypatch):
+    """ Adding an entry changes the modification time of the directory, so it is read again. """
+    root = tmp_path / "root"
+    root.mkdir()
+    _make_cached_tree(root)
+    cache = pyls.ListingCache(tmp_path / "cache")
+    monkeypatch.setattr(pyls.CONFIG, "cache", cache)
+    run_pyls(root, recursive=True)
+
+    # Only the contents of the directories are compared, since the entry of c in the root directory is unchanged.
+    _make_test_file(root / "c" / "new_file")
+    assert run_pyls(root, recursive=True) == run_system_ls(root, recursive=True)
+    assert (cache.hits, cache.misses) == (3, 5)
+
+
+def test_listing_cache_ignores_recently_modified_directories(tmp_path: pathlib.Path, monkeypatch):
+    """ Directories modified just now could change again without changing their key, so they are not stored. """
+    cache = pyls.ListingCache(tmp_path / "cache")
+    monkeypatch.setattr(pyls.CONFIG, "cache", cache)
+    (tmp_path / "root").mkdir()
+    run_pyls(tmp_path / "root")
+    run_pyls(tmp_path / "root")
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_listing_cache_ignores_corrupt_files(tmp_path: pathlib.Path, monkeypatch):
+    """ A damaged cache file is treated like a missing one. """
+    root = tmp_path / "root"
+    root.mkdir()
+    _make_cached_tree(root)
+    cache = pyls.ListingCache(tmp_path / "cache")
+    monkeypatch.setattr(pyls.CONFIG, "cache", cache)
+    run_pyls(root, list_format=True, recursive=True)
+    for cache_file in (tmp_path / "cache").iterdir():
+        cache_file.write_bytes(cache_file.read_bytes()[:-3])
+
+    assert run_pyls(root, list_format=True, recursive=True) == run_system_ls(root, list_format=True, recursive=True)
+    assert cache.hits == 0
+
+
+def test_listing_cache_keeps_hard_links_apart(tmp_path: pathlib.Path, monkeypatch):
+    """ The device and inode of the entries are cached, so the subtree totals tell hard-linked files apart. """
+    root = tmp_path / "root"
+    root.mkdir()
+    _make_cached_tree(root)
+    for i in range(3):
+        _make_test_file(root / "c" / f"linked_{i}", size_bytes=i + 1)
+        os.link(root / "c" / f"linked_{i}", root / "a" / f"link_{i}")
+    for d in (root / "a", root / "c"):
+        os.utime(d, (time.time() - 60, time.time() - 60))
+    cache = pyls.ListingCache(tmp_path / "cache")
+    config = pyls.Config(paths=[str(root)], recursive=True, subtree_totals=True, cache=cache)
+    expected = pyls.Lister(config).string()
+    assert pyls.Lister(config).string() == expected
+    assert cache.hits == 4
+    assert pyls.Lister(pyls.Config(paths=[str(root)], recursive=True, subtree_totals=True)).string() == expected
+
+
+def test_listing_cache_evicts_least_recently_used_files(tmp_path: pathlib.Path, monkeypatch):
+    """ When the cache grows beyond its maximum size, the files used least recently are removed. """
+    root = tmp_path / "root"
+    root.mkdir()
+    _make_cached_tree(root)
+    cache = pyls.ListingCache(tmp_path / "cache")
+    monkeypatch.setattr(pyls.CONFIG, "cache", cache)
+    run_pyls(root / "c")
+    c_file, = (tmp_path / "cache").iterdir()
+    os.utime(c_file, (time.time() - 60, time.time() - 60))
+    run_pyls(root / "a")
+
+    cache.max_bytes = c_file.stat().st_size
+    _make_test_file(root / "a" / "b" / "new_file")
+    os.utime(root / "a" / "b", (time.time() - 60, time.time() - 60))
+    run_pyls(root / "a" / "b")
+    assert not c_file.exists()
+    assert sum(f.stat().st_size for f in (tmp_path / "cache").iterdir()) <= cache.max_bytes
+
+
+def _next_output(lines: Iterator[str], expected: str) -> str:
+    """ Take lines from the iterator and join them like ls_string, until the result is as long as expected. """
+    output = ""
+    while len(output) < len(expected):
+        output += next(lines) + "\n"
+    return output
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="--watch requires inotify")
+@pytest.mark.parametrize("sort_by_size", [False, True])
+@pytest.mark.parametrize("list_format", [False, True])
+def test_watch_lists_changed_directory_again(tmp_path: pathlib.Path, monkeypatch, list_format: bool,
+                                             sort_by_size: bool):
+    """ After each change of the watched directory, the listing is repeated and matches that of ls. """
+    for i in range(10):
+        _make_test_file(tmp_path / f"file{i}", size_bytes=i)
+    monkeypatch.setattr(pyls.CONFIG, "watch", True)
+    monkeypatch.setattr(pyls._DirectoryWatcher, "_BATCH_SECONDS", 0.01)
+    expected = run_system_ls(tmp_path, list_format=list_format, show_all=True, sort_by_size=sort_by_size)
+    lines = run_pyls_lines(tmp_path, list_format=list_format, show_all=True, sort_by_size=sort_by_size)
+    try:
+        assert _next_output(lines, expected) == expected
+
+        rng = random.Random(0)
+        for step in range(20):
+            # Each step changes the output, otherwise there would be nothing to wait for.
+            path, other_path = (tmp_path / f"file{i}" for i in rng.sample(range(15), 2))
+            if not path.exists():
+                _make_test_file(path, size_bytes=rng.randrange(20))
+            elif step % 3 == 0:
+                path.unlink()
+            elif step % 3 == 1 or not (list_format or sort_by_size):
+                path.rename(other_path)
+            else:
+                with open(path, "ab") as f:
+                    f.write(b"x" * rng.randrange(1, 20))
+
+            expected = run_system_ls(tmp_path, list_format=list_format, show_all=True, sort_by_size=sort_by_size)
+            expected = f"\n{tmp_path}:\n{expected}"
+            assert _next_output(lines, expected) == expected
+    finally:
+        lines.close()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="--watch requires inotify")
+def test_watch_follows_new_and_removed_subdirectories(tmp_path: pathlib.Path, monkeypatch):
+    """ In recursive mode, new subdirectories are listed and watched, and removed ones are no longer watched. """
+    (tmp_path / "old").mkdir()
+    monkeypatch.setattr(pyls.CONFIG, "watch", True)
+    monkeypatch.setattr(pyls._DirectoryWatcher, "_BATCH_SECONDS", 0.01)
+    expected = run_system_ls(tmp_path, recursive=True)
+    lines = run_pyls_lines(tmp_path, recursive=True)
+    try:
+        assert _next_output(lines, expected) == expected
+
+        (tmp_path / "new" / "deeper").mkdir(parents=True)
+        _make_test_file(tmp_path / "new" / "deeper" / "file")
+        (tmp_path / "old").rmdir()
+        # The changed root directory, followed by the new directories
+        expected = "\n" + run_system_ls(tmp_path, recursive=True)
+        assert _next_output(lines, expected) == expected
+
+        _make_test_file(tmp_path / "new" / "deeper" / "other_file")
+        expected = f"\n{tmp_path / 'new' / 'deeper'}:\nfile\nother_file\n"
+        assert _next_output(lines, expected) == expected
+    finally:
+        lines.close()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="--watch requires inotify")
+def test_watch_follows_renamed_subdirectories(tmp_path: pathlib.Path, monkeypatch):
+    """ A renamed subdirectory is watched under its new name only, and no longer listed under the old one. """
+    (tmp_path / "watched" / "old").mkdir(parents=True)
+    _make_test_file(tmp_path / "watched" / "old" / "file")
+    monkeypatch.setattr(pyls.CONFIG, "watch", True)
+    monkeypatch.setattr(pyls._DirectoryWatcher, "_BATCH_SECONDS", 0.01)
+    root = tmp_path / "watched"
+    expected = run_system_ls(root, recursive=True)
+    lines = run_pyls_lines(root, recursive=True)
+    try:
+        assert _next_output(lines, expected) == expected
+
+        (root / "old").rename(root / "new")
+        expected = "\n" + run_system_ls(root, recursive=True)
+        assert _next_output(lines, expected) == expected
+
+        _make_test_file(root / "new" / "other_file")
+        expected = f"\n{root / 'new'}:\nfile\nother_file\n"
+        assert _next_output(lines, expected) == expected
+
+        # Moved out of the listed tree, the directory is not watched any more.
+        (root / "new").rename(tmp_path / "outside")
+        expected = f"\n{root}:\n"
+        assert _next_output(lines, expected) == expected
+        _make_test_file(tmp_path / "outside" / "ignored")
+        _make_test_file(root / "file")
+        expected = f"\n{root}:\nfile\n"
+        assert _next_output(lines, expected) == expected
+    finally:
+        lines.close()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="--watch requires inotify")
+def test_watch_ends_when_the_listed_directory_is_renamed(tmp_path: pathlib.Path, monkeypatch):
+    """ Like a removed directory, a renamed path argument is no longer watched, since its path is gone. """
+    (tmp_path / "listed").mkdir()
+    _make_test_file(tmp_path / "listed" / "file")
+    monkeypatch.setattr(pyls.CONFIG, "watch", True)
+    monkeypatch.setattr(pyls._DirectoryWatcher, "_BATCH_SECONDS", 0.01)
+    lines = run_pyls_lines(tmp_path / "listed")
+    try:
+        assert next(lines) == "file"
+        (tmp_path / "listed").rename(tmp_path / "renamed")
+        _make_test_file(tmp_path / "renamed" / "other_file")
+        assert next(lines, None) is None
+    finally:
+        lines.close()
+
+
+class _CountingDirEntry:
+    """
+    Wraps an os.DirEntry and counts the calls of its stat method in the given counter. Since os.DirEntry caches the
+    stat result, only the first call for each value of follow_symlinks results in a system call and is counted.
+    """
+
+    def __init__(self, dir_entry, counter: collections.Counter):
+        self._dir_entry = dir_entry
+        self._counter = counter
+        self._stat_calls = set()
+        self.name = dir_entry.name
+        self.path = dir_entry.path
+
+    def is_dir(self, *, follow_symlinks=True):
+        return self._dir_entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_symlink(self):
+        return self._dir_entry.is_symlink()
+
+    def stat(self, *, follow_symlinks=True):
+        if follow_symlinks not in self._stat_calls:
+            self._stat_calls.add(follow_symlinks)
+            self._counter[os.path.abspath(self.path)] += 1
+        return self._dir_entry.stat(follow_symlinks=follow_symlinks)
+
+
+@contextlib.contextmanager
+def _count_stat_calls(monkeypatch) -> collections.Counter:
+    """
+    Count the stat calls per (absolute) path made through os.stat, os.lstat and os.DirEntry.stat, as well as the
+    directory reads per path made through os.scandir.
+    """
+    counter = collections.Counter()
+    real_scandir, real_stat, real_lstat = os.scandir, os.stat, os.lstat
+
+    @contextlib.contextmanager
+    def counting_scandir(path="."):
+        counter[("scandir", os.path.abspath(path))] += 1
+        with real_scandir(path) as it:
+            yield (_CountingDirEntry(d, counter) for d in it)
+
+    def counting_stat(path, *args, **kwargs):
+        counter[os.path.abspath(path)] += 1
+        return real_stat(path, *args, **kwargs)
+
+    def counting_lstat(path, *args, **kwargs):
+        counter[os.path.abspath(path)] += 1
+        return real_lstat(path, *args, **kwargs)
+
+    with monkeypatch.context() as m:
+        m.setattr(os, "scandir", counting_scandir)
+        m.setattr(os, "stat", counting_stat)
+        m.setattr(os, "lstat", counting_lstat)
+        yield counter
+
+
+@pytest.mark.parametrize("recursive", [False, True])
+@pytest.mark.parametrize("sort_by_size", [False, True])
+@pytest.mark.parametrize("list_format", [False, True])
+@pytest.mark.parametrize("test_case", ["many_files", "multiple_files_in_nested_directories"])
+def test_each_entry_is_statted_at_most_once(test_base_dir: pathlib.Path, monkeypatch,
+                                            test_case, list_format, sort_by_size, recursive):
+    """ Listing a directory tree must not read any directory or lstat any entry more than once. """
+    path = test_base_dir / test_case
+    with _count_stat_calls(monkeypatch) as counter:
+        run_pyls(path, list_format=list_format, show_all=True, sort_by_size=sort_by_size, recursive=recursive)
+
+    assert max(counter.values(), default=0) <= 1
+
+
+def _make_tree_with_ignored_names(root: pathlib.Path):
+    for d in ("src/node_modules/pkg", "node_modules/pkg", ".cache/x", "docs"):
+        (root / d).mkdir(parents=True)
+    for f in ("src/main.py", "src/main.tmp", "src/.main.tmp", "src/node_modules/pkg/index.js", "docs/a1", "docs/b2",
+              "docs/c3", "docs/*", "docs/[x", "docs/]", "docs/\\]", "docs/a\\", "docs/-", "docs/z", ".hidden.tmp",
+              "README"):
+        _make_test_file(root / f, size_bytes=len(f))
+
+
+@pytest.mark.parametrize("patterns", [["--ignore=node_modules", "--ignore=*.tmp"], ["--hide=.cache", "--hide=*.tmp"],
+                                      ["-I", "[a-b]?", "--hide=node_*"], ["--ignore=.*"], ["--ignore=\\*", "-I[x"],
+                                      ["--ignore=[!a]*"], ["--hide=*", "--ignore=README"],
+                                      ["-I", "[z-a]*", "--hide=[b-a]"], ["--ignore=[-b]?", "-I[!z-a]", "-I[c-]3"],
+                                      ["--ignore=[\\]]"], ["--ignore=a\\", "--hide=[\\"], ["--ignore=[a\\-z]"]])
+@pytest.mark.parametrize("show_all", [False, True])
+def test_ignore_and_hide_match_ls(tmp_path: pathlib.Path, patterns: list, show_all: bool):
+    """ --ignore and --hide exclude the same entries as in ls, and ignored directories are not entered. """
+    _make_tree_with_ignored_names(tmp_path)
+    args = patterns + ["-R"] + (["-a"] if show_all else [])
+    config = pyls.get_configuration_from_command_line_args(args + [str(tmp_path)])
+    config.use_column_layout = False
+    ls_run = subprocess.run(["ls"] + args + [str(tmp_path)], capture_output=True)
+    assert pyls.Lister(config).string() == ls_run.stdout.decode()
+
+
+def test_ignored_entries_are_never_statted(tmp_path: pathlib.Path, monkeypatch):
+    """ The names are matched as they are read, so ignored entries are neither statted nor read as directories. """
+    _make_tree_with_ignored_names(tmp_path)
+    config = pyls.Config(paths=[str(tmp_path)], list_format=True, sort_by_size=True, recursive=True, show_all=True,
+                         ignore_patterns=["node_modules", "*.tmp", ".cache"])
+    with _count_stat_calls(monkeypatch) as counter:
+        output = pyls.Lister(config).string()
+    touched = {key[1] if isinstance(key, tuple) else key for key in counter}
+    assert not [p for p in touched if "node_modules" in p or p.endswith("/main.tmp") or ".cache" in p]
+    # Like in ls, * does not match a leading period.
+    assert ".main.tmp" in output and "main.py" in output and "node_modules" not in output
+
+
+@pytest.mark.parametrize("options", [dict(recursive=True), dict(recursive=True, list_format=True, show_all=True),
+                                     dict(recursive=True, list_format=True, sort_by_size=True, jobs=4),
+                                     dict(recursive=True, list_format=True, stream_chunk_size=2),
+                                     dict(recursive=True, list_format=True, resolve_links=True),
+                                     dict(recursive=True, subtree_totals=True), dict(recursive=True, top=2),
+                                     dict(list_format=True, show_all=True)])
+@pytest.mark.parametrize("max_open_fds", [1, 64])
+def test_fd_relative_traversal_matches_paths(tmp_path: pathlib.Path, options: dict, max_open_fds: int):
+    """ Reading the directories relative to the descriptors of their parents does not change the output. """
+    _make_tree_with_links(tmp_path)
+    _make_tree_with_hard_links(tmp_path / "hard")
+    expected = pyls.Lister(pyls.Config(paths=[str(tmp_path)], **options)).string()
+    config = pyls.Config(paths=[str(tmp_path)], fd_relative=True, max_open_fds=max_open_fds, **options)
+    assert pyls.Lister(config).string() == expected
+
+
+def test_fd_relative_traversal_lists_paths_longer_than_path_max(tmp_path: pathlib.Path):
+    """ The kernel only looks up single names, so trees can be listed below the longest path it accepts. """
+    name = "d" * 200
+    depth = 4096 // len(name) + 2
+    fd = os.open(tmp_path, os.O_RDONLY)
+    try:
+        for _ in range(depth):
+            os.mkdir(name, dir_fd=fd)
+            subdir_fd = os.open(name, os.O_RDONLY, dir_fd=fd)
+            os.close(fd)
+            fd = subdir_fd
+        os.close(os.open("deepest_file", os.O_CREAT | os.O_WRONLY, dir_fd=fd))
+    finally:
+        os.close(fd)
+
+    config = pyls.Config(paths=[str(tmp_path)], recursive=True, list_format=True, fd_relative=True)
+    lines = list(pyls.Lister(config).lines())
+    assert len(lines[-3]) > 4096 and lines[-3].endswith(f"/{name}:") and lines[-2] == "total 0"
+    assert lines[-1].endswith(" deepest_file")
+    with pytest.raises(OSError):
+        pyls.Lister(pyls.Config(paths=[str(tmp_path)], recursive=True, list_format=True)).string()
+
+
+@pytest.mark.parametrize("jobs", [1, 8])
+@pytest.mark.parametrize("max_open_fds", [2, 4])
+def test_fd_relative_traversal_holds_at_most_max_open_fds(test_base_dir: pathlib.Path, monkeypatch, jobs: int,
+                                                           max_open_fds: int):
+    """ No more than max_open_fds descriptors are open at once, including those of the directories being read. """
+    open_fds = set()
+    max_open = 0
+    real_open, real_close = os.open, os.close
+
+    def counting_open(*args, **kwargs):
+        nonlocal max_open
+        fd = real_open(*args, **kwargs)
+        open_fds.add(fd)
+        max_open = max(max_open, len(open_fds))
+        return fd
+
+    def counting_close(fd):
+        open_fds.discard(fd)
+        real_close(fd)
+
+    path = test_base_dir / "multiple_files_in_nested_directories"
+    options = dict(paths=[str(path)], recursive=True, list_format=True, jobs=jobs)
+    expected = pyls.Lister(pyls.Config(**options)).string()
+    monkeypatch.setattr(os, "open", counting_open)
+    monkeypatch.setattr(os, "close", counting_close)
+    config = pyls.Config(fd_relative=True, max_open_fds=max_open_fds, **options)
+    assert pyls.Lister(config).string() == expected
+    assert not open_fds
+    assert 1 < max_open <= max_open_fds
+
+
 @pytest.mark.skip
 @pytest.mark.parametrize("path", [".", "/", pathlib.Path.home()])
 @pytest.mark.parametrize("list_format", [False, True])